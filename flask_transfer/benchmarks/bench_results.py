@@ -0,0 +1,197 @@
+"""
+Latency summaries and JSON result files shared by the benchmarks
+
+A result file records the commit it was run on, so results of two commits
+can be compared with:
+    python -m flask_transfer.benchmarks.bench_results old.json new.json
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__)
+)))
+
+
+def percentile(sorted_values, q):
+    """
+    Linearly interpolated percentile
+
+    Args:
+        sorted_values (list): the values, sorted
+        q (float): the percentile, 0 to 100
+
+    Returns:
+        float: the percentile, None if there are no values
+    """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100
+    low = math.floor(rank)
+    high = math.ceil(rank)
+    return sorted_values[low] + \
+        (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(latencies_ms, seconds=None, errors=0):
+    """
+    Args:
+        latencies_ms (list): one latency per request, in milliseconds
+        seconds (float): the wall time of the run, for the throughput
+        errors (int): requests with an unexpected outcome
+
+    Returns:
+        dict: count, errors, throughput and latency percentiles
+    """
+    values = sorted(latencies_ms)
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'mean_ms': sum(values) / len(values) if values else None,
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+        'max_ms': values[-1] if values else None,
+    }
+    if seconds:
+        summary['throughput_rps'] = len(values) / seconds
+    return summary
+
+
+def git_revision():
+    """
+    Returns:
+        dict: the commit and whether the tree had local changes, None
+            values outside of a git checkout
+    """
+    def git(*args):
+        return subprocess.run(
+            ['git', *args], cwd=REPO_DIR, capture_output=True, text=True,
+            check=True,
+        ).stdout.strip()
+    try:
+        return {
+            'commit': git('rev-parse', 'HEAD'),
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        }
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def write_results(path, benchmark, config, results):
+    """
+    Writes a result file with the commit and machine it was run on
+
+    Args:
+        path (str): the JSON file to write, nothing is written if empty
+        benchmark (str): the benchmark name
+        config (dict): the parameters of the run
+        results (dict): summaries by scenario, e.g. from summarize()
+
+    Returns:
+        dict: the written document
+    """
+    document = {
+        'benchmark': benchmark,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': config,
+        'results': results,
+    }
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    return document
+
+
+def print_results(results, file=sys.stdout):
+    columns = ('count', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms',
+               'p99_ms', 'max_ms')
+    print(f'{"scenario":<16}' + ''.join(f'{c:>16}' for c in columns),
+          file=file)
+    for name, summary in results.items():
+        cells = []
+        for column in columns:
+            value = summary.get(column)
+            if value is None:
+                cells.append(f'{"-":>16}')
+            elif isinstance(value, float):
+                cells.append(f'{value:>16.2f}')
+            else:
+                cells.append(f'{value:>16}')
+        print(f'{name:<16}' + ''.join(cells), file=file)
+
+
+# metrics where a higher value is worse
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'errors')
+
+
+def compare(old, new, threshold=None, file=sys.stdout):
+    """
+    Prints the change of every scenario metric between two result documents
+
+    Args:
+        old (dict): the baseline result document
+        new (dict): the result document to check
+        threshold (float): percentage by which a metric may get worse
+
+    Returns:
+        list: (scenario, metric, change in %) of the metrics that got worse
+            by more than the threshold
+    """
+    print(f'old: {old.get("commit")} ({old.get("created")})', file=file)
+    print(f'new: {new.get("commit")} ({new.get("created")})', file=file)
+    regressions = []
+    for scenario, new_summary in new['results'].items():
+        old_summary = old['results'].get(scenario)
+        if old_summary is None:
+            continue
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            before = old_summary.get(metric)
+            after = new_summary.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            worse = -change if metric not in LOWER_IS_BETTER else change
+            flag = ''
+            if threshold is not None and worse > threshold:
+                regressions.append((scenario, metric, change))
+                flag = '  REGRESSION'
+            print(f'{scenario:<16}{metric:<16}{before:>12.2f} -> '
+                  f'{after:>12.2f}  {change:+7.1f}%{flag}', file=file)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='compare two benchmark result files'
+    )
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument(
+        '--threshold', type=float, default=None,
+        help='exit with status 1 if a metric gets worse by more than this %%',
+    )
+    args = parser.parse_args(argv)
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = compare(old, new, args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
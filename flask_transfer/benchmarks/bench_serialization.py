@@ -0,0 +1,266 @@
+"""
+Per-request overhead of validating, marshalling and encoding with
+flask_restx against the compiled models of worker_fastjson
+
+The model routes are served by a Flask app of their own, declared as
+worker_flask_app declares them, with a handler that returns a canned
+result, so the latency is what the framework adds to each request. The
+restx mode validates with RESTX_VALIDATE and marshals with api.marshal and
+api.marshal_with, the compiled mode with parse_payload and marshal_with.
+Each step is also timed on its own, in microseconds per call.
+
+Usage:
+    python -m flask_transfer.benchmarks.bench_serialization --requests 5000 \
+        --output results/serialization-$(git rev-parse --short HEAD).json
+"""
+import argparse
+import json
+import sys
+import time
+
+from flask import Flask
+from flask_restx import Api, Resource
+
+from flask_transfer.flask_worker import worker_classes_api
+from flask_transfer.flask_worker import worker_fastjson
+
+from . import bench_results
+
+MODES = ('restx', 'compiled')
+
+
+def canned_result(text, models, labels):
+    return {
+        'text': text,
+        'classes': [
+            {
+                'type': model_name,
+                'result': [
+                    {'value': f'label_{i}', 'score': 1 / (i + 1)}
+                    for i in range(labels)
+                ],
+            }
+            for model_name in models
+        ],
+    }
+
+
+def build_app(labels):
+    """
+    Returns:
+        tuple: the app, its api and the request and response models of the
+            /models/ and /models/batch routes
+    """
+    app = Flask(__name__)
+    app.config['RESTX_VALIDATE'] = True
+    api = Api(app)
+    models = {
+        'single': (
+            worker_classes_api.get_classes_body(api),
+            worker_classes_api.get_classes_post_response(api),
+        ),
+        'batch': (
+            worker_classes_api.get_classes_batch_body(api),
+            worker_classes_api.get_classes_batch_post_response(api),
+        ),
+    }
+
+    def handle(route, payload):
+        if route == 'single':
+            return canned_result(payload['text'], payload['classes'], labels)
+        return {'results': [
+            canned_result(text, payload['classes'], labels)
+            for text in payload['texts']
+        ]}
+
+    for mode in MODES:
+        enabled = mode == 'compiled'
+        for route, (request_model, response_model) in models.items():
+            path = f'/{mode}/{route}'
+
+            @api.route(path, endpoint=f'{mode}_{route}')
+            class Route(Resource):
+                @api.expect(request_model, validate=not enabled)
+                @worker_fastjson.marshal_with(
+                    api, response_model, enabled=enabled
+                )
+                def post(self, route=route, request_model=request_model,
+                         enabled=enabled):
+                    return handle(route, worker_fastjson.parse_payload(
+                        api, request_model, enabled=enabled
+                    ))
+    return app, api, models
+
+
+def request_bodies(texts, text_length):
+    text = ('The match was moved to Paris after the vote. ' * text_length)
+    return {
+        'single': {'text': text, 'classes': ['model_a', 'model_b']},
+        'batch': {
+            'texts': [text] * texts, 'classes': ['model_a', 'model_b'],
+        },
+    }
+
+
+def run_requests(client, path, body, requests):
+    """
+    Returns:
+        tuple: the latency of each request in ms, the wall time in seconds,
+            the number of failed requests and the last response body
+    """
+    data = json.dumps(body)
+    latencies = []
+    errors = 0
+    response = None
+    started = time.perf_counter()
+    for _ in range(requests):
+        sent = time.perf_counter()
+        response = client.post(
+            path, data=data, content_type='application/json'
+        )
+        latencies.append((time.perf_counter() - sent) * 1000)
+        if response.status_code != 200:
+            errors += 1
+    return latencies, time.perf_counter() - started, errors, \
+        response.get_json()
+
+
+def time_call(func, repeat):
+    """
+    Returns:
+        float: microseconds per call
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def time_steps(app, api, models, bodies, labels, repeat):
+    """
+    Returns:
+        dict: microseconds per call of each step, by route and mode
+    """
+    steps = {}
+    with app.test_request_context():
+        for route, (request_model, response_model) in models.items():
+            body = bodies[route]
+            payload = api.marshal(body, request_model)
+            if route == 'single':
+                result = canned_result(body['text'], body['classes'], labels)
+            else:
+                result = {'results': [
+                    canned_result(text, body['classes'], labels)
+                    for text in body['texts']
+                ]}
+            data = json.dumps(body).encode()
+            compiled = worker_fastjson.compile_model(api, request_model)
+            marshal_response = worker_fastjson.compile_marshal(response_model)
+            output = api.marshal(result, response_model)
+            steps[route] = {
+                'restx': {
+                    'decode_us': time_call(lambda: json.loads(data), repeat),
+                    'validate_us': time_call(lambda: request_model.validate(
+                        body, format_checker=api.format_checker
+                    ), repeat),
+                    'marshal_request_us': time_call(
+                        lambda: api.marshal(body, request_model), repeat
+                    ),
+                    'marshal_response_us': time_call(
+                        lambda: api.marshal(result, response_model), repeat
+                    ),
+                    'encode_us': time_call(
+                        lambda: json.dumps(output) + '\n', repeat
+                    ),
+                },
+                'compiled': {
+                    'decode_us': time_call(
+                        lambda: worker_fastjson.loads(data), repeat
+                    ),
+                    'validate_us': time_call(
+                        lambda: compiled.validate(body), repeat
+                    ),
+                    'marshal_request_us': time_call(
+                        lambda: compiled.marshal(body), repeat
+                    ),
+                    'marshal_response_us': time_call(
+                        lambda: marshal_response(result), repeat
+                    ),
+                    'encode_us': time_call(
+                        lambda: worker_fastjson.dumps(output), repeat
+                    ),
+                },
+            }
+            if compiled.marshal(body) != payload or \
+                    marshal_response(result) != output:
+                raise RuntimeError(f'The compiled {route} models differ')
+    return steps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='request overhead benchmark, flask_restx against '
+                    'compiled models'
+    )
+    parser.add_argument('-n', '--requests', type=int, default=2000,
+                        help='requests per route and mode')
+    parser.add_argument('--texts', type=int, default=32,
+                        help='texts per batch request')
+    parser.add_argument('--text-length', type=int, default=4,
+                        help='sentences per text')
+    parser.add_argument('--labels', type=int, default=10,
+                        help='classes scored per model')
+    parser.add_argument('--repeat', type=int, default=2000,
+                        help='calls per step when timing the steps')
+    parser.add_argument('--output', default='',
+                        help='JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    app, api, models = build_app(args.labels)
+    bodies = request_bodies(args.texts, args.text_length)
+    client = app.test_client()
+    results = {}
+    outputs = {}
+    for route in models:
+        for mode in MODES:
+            path = f'/{mode}/{route}'
+            # warms up the compiled models and the url map
+            run_requests(client, path, bodies[route], 10)
+            latencies, seconds, errors, output = run_requests(
+                client, path, bodies[route], args.requests
+            )
+            results[f'{route}_{mode}'] = bench_results.summarize(
+                latencies, seconds, errors
+            )
+            outputs[mode, route] = output
+    outputs_match = all(
+        outputs['restx', route] == outputs['compiled', route]
+        for route in models
+    )
+    steps = time_steps(
+        app, api, models, bodies, args.labels, args.repeat
+    )
+
+    config = dict(vars(args))
+    config.update({
+        'orjson': worker_fastjson.orjson is not None,
+        'outputs_match': outputs_match,
+        'steps': steps,
+    })
+    bench_results.write_results(args.output, 'serialization', config, results)
+    bench_results.print_results(results)
+    print()
+    columns = ('decode_us', 'validate_us', 'marshal_request_us',
+               'marshal_response_us', 'encode_us')
+    print(f'{"step":<20}' + ''.join(f'{c:>21}' for c in columns))
+    for route in models:
+        for mode in MODES:
+            print(f'{route + "_" + mode:<20}' + ''.join(
+                f'{steps[route][mode][c]:>21.1f}' for c in columns
+            ))
+    print(f'\norjson: {config["orjson"]}, outputs match: {outputs_match}')
+    return 0 if outputs_match else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
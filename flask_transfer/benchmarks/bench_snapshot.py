@@ -0,0 +1,239 @@
+"""
+Load time and memory of a model loaded with spacy.load and from its snapshot
+
+Each load runs in a fresh process, after spaCy and the language data are
+imported, so the time is what the worker pays for a cold model. The spacy
+mode prunes the pipeline after loading it, as the worker does. The
+processes of a mode stay alive together until their memory is read, so
+the PSS (proportional set size) shows how much of the weights they share.
+
+By default the model is a generated textcat + NER pipeline with static
+vectors; --model benchmarks a model directory instead.
+
+Usage:
+    python -m flask_transfer.benchmarks.bench_snapshot --processes 4 \
+        --output results/snapshot-$(git rev-parse --short HEAD).json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import bench_results
+
+SAMPLE_TEXT = 'The match was moved to Paris after the vote on Tuesday.'
+MODES = ('spacy', 'snapshot')
+
+
+def build_model(path, labels, vector_rows, vector_width, seed=0):
+    """
+    Writes a pipeline with a textcat and a NER with random weights, and
+    `vector_rows` random static vectors
+    """
+    import numpy
+    import spacy
+    from spacy.vectors import Vectors
+
+    rng = numpy.random.default_rng(seed)
+    nlp = spacy.blank('en')
+    textcat = nlp.add_pipe('textcat')
+    for i in range(labels):
+        textcat.add_label(f'label_{i}')
+    ner = nlp.add_pipe('ner')
+    for label in ('PERSON', 'ORG', 'GPE'):
+        ner.add_label(label)
+    nlp.initialize()
+    for _, component in nlp.pipeline:
+        for node in component.model.walk():
+            for param in node.param_names:
+                if node.has_param(param):
+                    array = node.get_param(param)
+                    node.set_param(param, (
+                        rng.standard_normal(array.shape) * 0.1
+                    ).astype(array.dtype))
+    if vector_rows:
+        keys = [nlp.vocab.strings.add(f'word_{i}') for i in range(vector_rows)]
+        nlp.vocab.vectors = Vectors(
+            data=rng.standard_normal(
+                (vector_rows, vector_width)
+            ).astype('float32'),
+            keys=keys,
+        )
+    nlp.to_disk(path)
+
+
+def memory_mb(pid='self'):
+    """
+    Returns:
+        dict: the RSS and PSS of a process, in MB
+    """
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                fields[name.lower() + '_mb'] = int(value.split()[0]) / 1024
+    return fields
+
+
+def measure(mode, path, lang, route):
+    """
+    Loads the model once in this process as the worker would, prints the
+    measures as one JSON line and waits for stdin to close
+    """
+    import spacy
+
+    from flask_transfer.flask_worker.worker_snapshot import (
+        load_snapshot, prune_pipeline,
+    )
+
+    # imports the language data and the registries
+    spacy.blank(lang)(SAMPLE_TEXT)
+    before = memory_mb()
+    started = time.perf_counter()
+    if mode == 'snapshot':
+        nlp = load_snapshot(path)
+    else:
+        nlp = spacy.load(path)
+        prune_pipeline(nlp, route)
+    load_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    doc = nlp(SAMPLE_TEXT)
+    first_doc_ms = (time.perf_counter() - started) * 1000
+    after = memory_mb()
+    print(json.dumps({
+        'load_ms': load_ms,
+        'first_doc_ms': first_doc_ms,
+        'rss_mb': after['rss_mb'] - before['rss_mb'],
+        'cats': doc.cats,
+        'ents': [(e.start_char, e.end_char, e.label_) for e in doc.ents],
+    }), flush=True)
+    sys.stdin.read()
+    return 0
+
+
+def run_mode(mode, path, lang, route, processes):
+    """
+    Starts `processes` processes loading the model one after the other,
+    and reads their memory while all of them hold it
+
+    Returns:
+        list: the measures of each process
+    """
+    children = []
+    measures = []
+    try:
+        for _ in range(processes):
+            child = subprocess.Popen(
+                [sys.executable, '-m', 'flask_transfer.benchmarks.bench_snapshot',
+                 '--measure', mode, path, '--lang', lang, '--route', route],
+                cwd=bench_results.REPO_DIR, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, text=True,
+            )
+            children.append(child)
+            line = child.stdout.readline()
+            if not line:
+                raise RuntimeError(f'Measuring {mode} failed')
+            measures.append(json.loads(line))
+        for child, measure in zip(children, measures):
+            measure['pss_mb'] = memory_mb(child.pid)['pss_mb']
+    finally:
+        for child in children:
+            child.stdin.close()
+            child.wait()
+    return measures
+
+
+def directory_mb(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    ) / 1024 / 1024
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='model load benchmark, spacy.load against snapshots'
+    )
+    parser.add_argument('--model', default='',
+                        help='spaCy model directory, generated if empty')
+    parser.add_argument('--route', default='classes',
+                        help='worker route the snapshot is made for')
+    parser.add_argument('-p', '--processes', type=int, default=4,
+                        help='processes loading the model in each mode')
+    parser.add_argument('--labels', type=int, default=20)
+    parser.add_argument('--vector-rows', type=int, default=100000)
+    parser.add_argument('--vector-width', type=int, default=300)
+    parser.add_argument('--lang', default='en')
+    parser.add_argument('--output', default='',
+                        help='JSON file to write the results to')
+    parser.add_argument('--measure', nargs=2, metavar=('MODE', 'PATH'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        return measure(*args.measure, args.lang, args.route)
+
+    from flask_transfer.flask_worker.worker_snapshot import make_snapshot
+
+    with tempfile.TemporaryDirectory(prefix='bench-snapshot-') as directory:
+        model_path = args.model
+        if not model_path:
+            model_path = os.path.join(directory, 'model')
+            build_model(model_path, args.labels, args.vector_rows,
+                        args.vector_width)
+        snapshot_path = os.path.join(directory, 'snapshot')
+        started = time.perf_counter()
+        snapshot = make_snapshot(model_path, snapshot_path, args.route)
+        snapshot_seconds = time.perf_counter() - started
+        paths = {'spacy': model_path, 'snapshot': snapshot_path}
+        sizes = {mode: directory_mb(paths[mode]) for mode in MODES}
+        measures = {
+            mode: run_mode(
+                mode, paths[mode], args.lang, args.route, args.processes
+            )
+            for mode in MODES
+        }
+
+    results = {}
+    for mode in MODES:
+        items = measures[mode]
+        results[mode] = bench_results.summarize(
+            [m['load_ms'] for m in items]
+        )
+        for name in ('first_doc_ms', 'rss_mb', 'pss_mb'):
+            results[mode][f'mean_{name}'] = \
+                sum(m[name] for m in items) / len(items)
+        results[mode]['disk_mb'] = sizes[mode]
+    spacy_out, snapshot_out = measures['spacy'][0], measures['snapshot'][0]
+    outputs_match = spacy_out['cats'] == snapshot_out['cats'] and \
+        spacy_out['ents'] == snapshot_out['ents']
+
+    config = {
+        name: value for name, value in vars(args).items() if name != 'measure'
+    }
+    config.update({
+        'removed': snapshot['removed'],
+        'exclude': snapshot['exclude'],
+        'snapshot_seconds': snapshot_seconds,
+        'outputs_match': outputs_match,
+    })
+    bench_results.write_results(args.output, 'snapshot', config, results)
+    bench_results.print_results(results)
+    print()
+    columns = ('mean_first_doc_ms', 'mean_rss_mb', 'mean_pss_mb', 'disk_mb')
+    print(f'{"scenario":<16}' + ''.join(f'{c:>20}' for c in columns))
+    for mode in MODES:
+        print(f'{mode:<16}' + ''.join(
+            f'{results[mode][c]:>20.2f}' for c in columns
+        ))
+    print(f'\nremoved components: {snapshot["removed"]}, '
+          f'outputs match: {outputs_match}')
+    return 0 if outputs_match else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+"""
+Load benchmark of the classes worker over HTTP
+
+Runs the worker app on a local port against fake models (see
+flask_transfer.stubs.s3_utils) and sends a seeded, repeatable mix of:
+    single   one loaded model
+    multi    two or three loaded models in one request
+    cold     a model that was not loaded yet, so the request waits for a load
+    unknown  a model that does not exist, answered with a 404
+
+Usage:
+    python -m flask_transfer.benchmarks.bench_worker --requests 2000 \
+        --concurrency 8 --output results/worker-$(git rev-parse --short HEAD).json
+    python -m flask_transfer.benchmarks.bench_results results/old.json results/new.json
+
+Worker settings (FANOUT, MICRO_BATCHING, RESULT_CACHE_SIZE...) are read
+from the environment as usual and recorded in the result file.
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from . import bench_results
+
+WARM_MODELS = {
+    'topic': ['sports', 'politics', 'business', 'science', 'entertainment'],
+    'intent': ['ask', 'complain', 'buy', 'cancel'],
+    'sentiment': ['positive', 'negative', 'neutral'],
+    'language': ['en', 'fr', 'de', 'es', 'it', 'pt'],
+}
+UNKNOWN_MODELS = ['topics', 'intnet', 'sentiments', 'lang', 'tpoic']
+DEFAULT_MIX = 'single=60,multi=25,cold=5,unknown=10'
+EXPECTED_STATUS = {'single': 200, 'multi': 200, 'cold': 200, 'unknown': 404}
+WORDS = (
+    'the a game team vote market price order refund account delivery late '
+    'great terrible support phone email question today yesterday week '
+    'please thanks cancel subscription bill charge player score election '
+    'policy company shares research study film music show new old'
+).split()
+# worker settings recorded with the results
+WORKER_SETTINGS = (
+    'FANOUT', 'FANOUT_WORKERS', 'MICRO_BATCHING', 'MICRO_BATCH_MAX_WAIT_MS',
+    'MICRO_BATCH_MAX_SIZE', 'RESULT_CACHE_SIZE', 'MODEL_CACHE_MAX_MODELS',
+    'LOG_ASYNC', 'SERVER_TIMING', 'PRELOAD_MODELS',
+)
+
+
+def parse_mix(mix):
+    """
+    Example:
+        'single=60,multi=25,cold=5,unknown=10' -> {'single': 60.0, ...}
+    """
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in EXPECTED_STATUS:
+            raise ValueError(f'Unknown request kind: {name}')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def make_texts(rng, count):
+    return [
+        ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 40)))
+        for _ in range(count)
+    ]
+
+
+def plan_requests(seed, count, mix, distinct_texts):
+    """
+    Builds the same request list for the same arguments
+
+    Returns:
+        tuple: the (kind, payload) list and the names of the cold models
+    """
+    rng = random.Random(seed)
+    texts = make_texts(rng, distinct_texts)
+    kinds, weights = zip(*mix.items())
+    warm = sorted(WARM_MODELS)
+    cold_models = []
+    plan = []
+    for _ in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == 'single':
+            models = [rng.choice(warm)]
+        elif kind == 'multi':
+            models = rng.sample(warm, rng.randint(2, 3))
+        elif kind == 'cold':
+            models = [f'cold_{len(cold_models):04d}']
+            cold_models.append(models[0])
+        else:
+            models = [rng.choice(UNKNOWN_MODELS)]
+        plan.append((kind, {'text': rng.choice(texts), 'classes': models}))
+    return plan, cold_models
+
+
+def write_models(model_dir, cost_ms, load_ms, cold_models):
+    from flask_transfer.stubs import s3_utils
+
+    for name, labels in WARM_MODELS.items():
+        s3_utils.write_model(
+            name, labels, cost_ms=cost_ms, load_ms=load_ms, model_dir=model_dir
+        )
+    for name in cold_models:
+        s3_utils.write_model(
+            name, WARM_MODELS['topic'], cost_ms=cost_ms, load_ms=load_ms,
+            model_dir=model_dir,
+        )
+
+
+def serve(model_dir, port, prefork=0):
+    """
+    Serves the worker app on the fake models, in the process started by
+    start_worker
+    """
+    from flask_transfer.stubs import s3_utils
+
+    s3_utils.STUB_MODEL_DIR = model_dir
+    s3_utils.install()
+
+    from flask_transfer.flask_worker import worker_logger
+
+    # one console line per request would dominate the run, the log file
+    # is still written
+    worker_logger.channel_handler.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    if prefork:
+        from flask_transfer.flask_worker import worker_prefork
+        return worker_prefork.main(
+            ['--host', '127.0.0.1', '--port', str(port), '-w', str(prefork)]
+        )
+
+    from werkzeug.serving import make_server
+    from flask_transfer.flask_worker import worker_flask_app
+
+    make_server(
+        '127.0.0.1', port, worker_flask_app.app, threaded=True
+    ).serve_forever()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_worker(model_dir, prefork=0, timeout=120):
+    """
+    Starts the worker in its own process, so that it does not share a GIL
+    with the clients, and waits until its models are preloaded
+
+    Returns:
+        tuple: the worker process and its base URL
+    """
+    port = free_port()
+    env = dict(os.environ)
+    env.setdefault('WORKER_ROUTE', 'classes')
+    env.setdefault('REGISTER_WITH_GATEWAY', 'false')
+    env.setdefault('ELASTIC_APM_ENABLED', 'false')
+    env.setdefault('LOG_FILE', os.path.join(model_dir, 'worker.log'))
+    env.setdefault('PRELOAD_MODELS', ','.join(sorted(WARM_MODELS)))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask_transfer.benchmarks.bench_worker',
+         '--serve', model_dir, '--port', str(port), '--prefork', str(prefork)],
+        cwd=bench_results.REPO_DIR, env=env, stdout=subprocess.DEVNULL,
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Worker exited with status {process.returncode}')
+        try:
+            if requests.get(f'{url}/ready', timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'Worker not ready after {timeout}s')
+
+
+def stop_worker(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def run(url, plan, concurrency):
+    """
+    Sends the planned requests from `concurrency` threads
+
+    Returns:
+        tuple: (kind, status, latency in ms) per request, and the wall time
+    """
+    local = threading.local()
+
+    def send(item):
+        kind, payload = item
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            status = session.post(f'{url}/models/', json=payload).status_code
+        except requests.RequestException:
+            status = None
+        return kind, status, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(send, plan))
+    return outcomes, time.perf_counter() - started
+
+
+def summarize_outcomes(outcomes, seconds):
+    """
+    Returns:
+        dict: the summary of all requests, with the throughput, and of
+            each kind of request
+    """
+    def errors(items):
+        return sum(status != EXPECTED_STATUS[kind] for kind, status, _ in items)
+
+    results = {'all': bench_results.summarize(
+        [latency for _, _, latency in outcomes], seconds, errors(outcomes)
+    )}
+    for kind in sorted({kind for kind, _, _ in outcomes}):
+        items = [outcome for outcome in outcomes if outcome[0] == kind]
+        results[kind] = bench_results.summarize(
+            [latency for _, _, latency in items], errors=errors(items)
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='worker load benchmark')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'request kind weights (default {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--distinct-texts', type=int, default=1000,
+                        help='size of the pool texts are drawn from')
+    parser.add_argument('--cost-ms', type=float, default=1.0,
+                        help='CPU time of a fake model per text')
+    parser.add_argument('--load-ms', type=float, default=200,
+                        help='time to load a fake model')
+    parser.add_argument('--output', default='',
+                        help='JSON file to write the results to')
+    parser.add_argument('--prefork', type=int, default=0,
+                        help='serve with the pre-fork server and this many '
+                             'worker processes, 0 serves from one process')
+    parser.add_argument('--serve', metavar='MODEL_DIR', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve(args.serve, args.port, args.prefork)
+
+    plan, cold_models = plan_requests(
+        args.seed, args.requests, parse_mix(args.mix), args.distinct_texts
+    )
+    with tempfile.TemporaryDirectory(prefix='bench-worker-') as model_dir:
+        write_models(model_dir, args.cost_ms, args.load_ms, cold_models)
+        process, url = start_worker(model_dir, args.prefork)
+        try:
+            outcomes, seconds = run(url, plan, args.concurrency)
+        finally:
+            stop_worker(process)
+
+    results = summarize_outcomes(outcomes, seconds)
+    config = {
+        name: value for name, value in vars(args).items()
+        if name not in ('serve', 'port')
+    }
+    config['worker_settings'] = {
+        name: os.environ[name] for name in WORKER_SETTINGS if name in os.environ
+    }
+    bench_results.write_results(args.output, 'worker', config, results)
+    bench_results.print_results(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
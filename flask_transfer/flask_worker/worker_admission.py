@@ -0,0 +1,261 @@
+import contextlib
+import math
+import os
+import threading
+import time
+
+from .worker_metrics import LATENCY_BUCKETS, REGISTRY
+
+# requests handled at once, 0 is unlimited
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT') or 32)
+# requests waiting for a slot, more are answered with a 429
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE') or 64)
+# seconds a request waits for its slots before it is answered with a 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT') or 5)
+# requests running each model at once, 0 is unlimited
+ADMISSION_MODEL_MAX_IN_FLIGHT = \
+    int(os.getenv('ADMISSION_MODEL_MAX_IN_FLIGHT') or 8)
+# model loads at once, each holds a whole model in memory while it loads
+ADMISSION_MAX_LOADS = int(os.getenv('ADMISSION_MAX_LOADS') or 2)
+# Retry-After sent with the 429 and 503 answers
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER') or 1)
+
+admission_waiting = REGISTRY.gauge(
+    'worker_admission_waiting',
+    'Callers waiting for a slot, by limit',
+    ['limit'],
+)
+admission_wait_seconds = REGISTRY.histogram(
+    'worker_admission_wait_seconds',
+    'Time waited for a slot by the admitted callers, by limit',
+    ['limit'],
+    buckets=LATENCY_BUCKETS,
+)
+admission_rejected = REGISTRY.counter(
+    'worker_admission_rejected_total',
+    'Callers turned away, by limit and reason: queue_full or timeout',
+    ['limit', 'reason'],
+)
+
+
+class AdmissionError(Exception):
+    """
+    No slot was free in time
+
+    Attributes:
+        code (int): 429 when the queue is full, 503 when the wait timed out
+        retry_after (int): seconds after which to retry
+    """
+
+    def __init__(self, message, code, retry_after):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+class Limiter:
+    """
+    Lets at most `limit` callers hold a slot at a time
+
+    Up to `max_queue` more callers wait for a slot, for at most `timeout`
+    seconds. A caller finding the queue full is rejected straight away, with
+    a 429, and one that times out with a 503. A limit of 0 admits everyone.
+    """
+
+    def __init__(self, name, limit, max_queue=ADMISSION_MAX_QUEUE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT,
+                 retry_after=ADMISSION_RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._waiters = dict()
+        self._condition = threading.Condition()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def oldest_wait(self):
+        """
+        Returns:
+            float: seconds the longest waiting caller has waited, 0 if none
+        """
+        with self._condition:
+            if not self._waiters:
+                return 0.0
+            return time.monotonic() - min(self._waiters.values())
+
+    def _reject(self, reason, message, code):
+        admission_rejected.inc(limit=self.name, reason=reason)
+        raise AdmissionError(message, code, self.retry_after)
+
+    def acquire(self, deadline=None):
+        """
+        Takes a slot, waiting for one if none is free
+
+        Args:
+            deadline (float): time.monotonic() after which to give up,
+                `timeout` seconds from now if None, math.inf waits for ever
+
+        Raises:
+            AdmissionError: the queue is full or the deadline passed
+
+        Returns:
+            float: the seconds waited
+        """
+        if self.limit <= 0:
+            return 0.0
+        started = time.monotonic()
+        if deadline is None:
+            deadline = started + self.timeout
+        with self._condition:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                admission_wait_seconds.observe(0, limit=self.name)
+                return 0.0
+            if len(self._waiters) >= self.max_queue:
+                self._reject(
+                    'queue_full', f'Too many requests waiting for {self.name}',
+                    429,
+                )
+            token = object()
+            self._waiters[token] = started
+            admission_waiting.set(len(self._waiters), limit=self.name)
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(
+                            'timeout', f'Timed out waiting for {self.name}',
+                            503,
+                        )
+                    self._condition.wait(
+                        None if remaining == math.inf else remaining
+                    )
+                self.active += 1
+            finally:
+                del self._waiters[token]
+                admission_waiting.set(len(self._waiters), limit=self.name)
+                # a waiter that timed out passes on the slot it was woken for
+                if self.active < self.limit and self._waiters:
+                    self._condition.notify()
+        waited = time.monotonic() - started
+        admission_wait_seconds.observe(waited, limit=self.name)
+        return waited
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def slot(self, deadline=None):
+        """Holds a slot for the with block, see acquire"""
+        self.acquire(deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Admission:
+    """
+    The limits a request passes before it runs
+
+    A request first takes one of the `max_in_flight` request slots, for its
+    whole duration. Once its models are loaded it takes a slot of each
+    model, `model_max_in_flight` per model, so that a burst for one model
+    does not hold every thread. Model slots are taken in name order, so two
+    requests for the same models cannot hold one each and wait for the
+    other, and they share one deadline.
+    """
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+                 model_max_in_flight=ADMISSION_MODEL_MAX_IN_FLIGHT,
+                 max_queue=ADMISSION_MAX_QUEUE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT,
+                 retry_after=ADMISSION_RETRY_AFTER):
+        self.requests = Limiter(
+            'requests', max_in_flight, max_queue, timeout, retry_after
+        )
+        self.model_max_in_flight = model_max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._models = dict()
+        self._lock = threading.Lock()
+
+    def model(self, model_name):
+        """
+        Returns:
+            Limiter: the limiter of a model
+        """
+        with self._lock:
+            limiter = self._models.get(model_name)
+            if limiter is None:
+                limiter = self._models[model_name] = Limiter(
+                    'models', self.model_max_in_flight, self.max_queue,
+                    self.timeout, self.retry_after,
+                )
+            return limiter
+
+    def forget(self, model_name):
+        """Drops the limiter of an unloaded model"""
+        with self._lock:
+            self._models.pop(model_name, None)
+
+    def deadline(self):
+        return time.monotonic() + self.timeout
+
+    def acquire_models(self, model_names, deadline=None):
+        """
+        Takes a slot of each model, see Limiter.acquire
+
+        Raises:
+            AdmissionError: a model had no free slot in time, the slots
+                taken so far are released
+
+        Returns:
+            list: the limiters to pass to release_models
+        """
+        if deadline is None:
+            deadline = self.deadline()
+        held = []
+        try:
+            for model_name in sorted(set(model_names)):
+                limiter = self.model(model_name)
+                limiter.acquire(deadline)
+                held.append(limiter)
+        except AdmissionError:
+            self.release_models(held)
+            raise
+        return held
+
+    def release_models(self, limiters):
+        for limiter in limiters:
+            limiter.release()
+
+    def waiting(self):
+        """
+        Returns:
+            int: the callers waiting for a request or model slot
+        """
+        with self._lock:
+            models = list(self._models.values())
+        return self.requests.waiting + sum(m.waiting for m in models)
+
+    def oldest_wait(self):
+        """
+        Returns:
+            float: seconds the longest waiting caller has waited, 0 if none
+        """
+        with self._lock:
+            models = list(self._models.values())
+        return max(
+            [self.requests.oldest_wait()] + [m.oldest_wait() for m in models]
+        )
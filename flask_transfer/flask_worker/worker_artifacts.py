@@ -0,0 +1,564 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import spacy
+
+import scripts.utils as s3_utils
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+from .worker_snapshot import is_snapshot, load_snapshot
+
+logger = create_logger(__name__)
+
+CURRENT_FILE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# download models through the artifact store instead of s3_utils.LazyModel
+ARTIFACT_STORE = (os.getenv('ARTIFACT_STORE') or 'false').lower() in ('1', 'true')
+ARTIFACT_CACHE_DIR = os.getenv('ARTIFACT_CACHE_DIR') or \
+    os.path.join(CURRENT_FILE_PATH, 'artifact_cache')
+# disk budget of the extracted artifacts, 0 means unbounded
+ARTIFACT_CACHE_MAX_MB = int(os.getenv('ARTIFACT_CACHE_MAX_MB') or 0)
+# artifacts larger than one part are downloaded as parallel ranged GETs
+ARTIFACT_PART_SIZE_MB = int(os.getenv('ARTIFACT_PART_SIZE_MB') or 16)
+ARTIFACT_DOWNLOAD_WORKERS = int(os.getenv('ARTIFACT_DOWNLOAD_WORKERS') or 8)
+# attempts per part before the download fails, finished parts are kept
+ARTIFACT_PART_RETRIES = int(os.getenv('ARTIFACT_PART_RETRIES') or 3)
+
+# <key>.meta.json next to each artifact: {"sha256": ..., "version": ...}
+META_SUFFIX = '.meta.json'
+RECORD_NAME = 'artifact.json'
+# lock files of the version directories, kept outside of them so that a
+# removed directory does not take its lock with it
+LOCK_DIR = '.locks'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+artifact_cache_hits = REGISTRY.counter(
+    'worker_artifact_cache_hits_total',
+    'Model artifacts found in the disk cache with the expected hash',
+    ['model'],
+)
+artifact_cache_misses = REGISTRY.counter(
+    'worker_artifact_cache_misses_total',
+    'Model artifacts downloaded because the disk cache did not hold them',
+    ['model'],
+)
+artifact_download_bytes = REGISTRY.counter(
+    'worker_artifact_download_bytes_total',
+    'Bytes of model artifacts downloaded',
+)
+artifact_download_seconds = REGISTRY.histogram(
+    'worker_artifact_download_seconds',
+    'Time to download and verify a model artifact',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+artifact_hash_mismatches = REGISTRY.counter(
+    'worker_artifact_hash_mismatches_total',
+    'Downloaded artifacts whose SHA-256 did not match their metadata',
+    ['model'],
+)
+artifact_cache_bytes = REGISTRY.gauge(
+    'worker_artifact_cache_bytes',
+    'Disk used by the cached model artifacts',
+)
+
+
+class ArtifactError(Exception):
+    """A model artifact could not be downloaded or verified"""
+
+
+def is_not_found(error):
+    """
+    Args:
+        error (Exception): raised by an S3 client
+
+    Returns:
+        bool: whether the error means the key does not exist
+    """
+    if isinstance(error, FileNotFoundError):
+        return True
+    code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+    return code in ('404', 'NoSuchKey', 'NotFound')
+
+
+def artifact_revision(meta):
+    """
+    Args:
+        meta (dict): the metadata of a published artifact
+
+    Returns:
+        str: what tells a publication apart, its SHA-256, or its version
+            (the ETag if it has none) when it was published without one.
+            A model published again under the same version gets a new
+            revision as long as its content changed.
+    """
+    return str(meta.get('sha256') or meta['version'])
+
+
+def version_dirname(version):
+    """
+    Args:
+        version: the published version of an artifact, e.g. an ETag
+
+    Returns:
+        str: a directory name for the version, with only letters, digits,
+            `.`, `_` and `-`, and never `.`, `..` or a hidden name
+    """
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', str(version))
+    if not name or name.startswith('.'):
+        name = '_' + name
+    return name
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def part_ranges(size, part_size):
+    """
+    Example:
+        part_ranges(10, 4) -> [(0, 3), (4, 7), (8, 9)]
+
+    Returns:
+        list: inclusive (first byte, last byte) of each part
+    """
+    return [
+        (start, min(start + part_size, size) - 1)
+        for start in range(0, size, part_size)
+    ]
+
+
+def safe_extract(tar_path, destination):
+    """Extracts a tarball, refusing members that would land outside of it"""
+    with tarfile.open(tar_path) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(destination, filter='data')
+            return
+        root = os.path.realpath(destination)
+        for member in tar.getmembers():
+            target = os.path.realpath(os.path.join(destination, member.name))
+            if os.path.commonpath([root, target]) != root or \
+                    member.issym() or member.islnk():
+                raise ArtifactError(f'Unsafe path in artifact: {member.name}')
+        tar.extractall(destination)
+
+
+def model_root(path):
+    """
+    Returns:
+        str: the directory holding the pipeline, either `path` or its only
+            subdirectory when the tarball wraps the model in a folder
+    """
+    if os.path.exists(os.path.join(path, 'config.cfg')) or \
+            os.path.exists(os.path.join(path, 'meta.json')):
+        return path
+    entries = [e for e in os.listdir(path) if not e.startswith('.')]
+    if len(entries) == 1 and os.path.isdir(os.path.join(path, entries[0])):
+        return os.path.join(path, entries[0])
+    return path
+
+
+class ArtifactStore:
+    """
+    Downloads model artifacts from S3 into a size-bounded local disk cache
+
+    Artifacts are cached per model and version, where the version comes from
+    the `<key>.meta.json` object written by save_to_s3.py (the ETag when
+    there is none). A cached artifact whose recorded SHA-256 matches the
+    metadata is used without downloading anything.
+
+    Each version has a lock file: downloads take it exclusively, loads take
+    it shared, and evict only removes versions it can lock exclusively that
+    `in_use` does not list.
+
+    Large artifacts are fetched as parallel ranged GETs into a `.part` file.
+    Finished parts are recorded next to it, so a download that fails or is
+    interrupted resumes with the missing parts only. The whole file is
+    checked against the SHA-256 from the metadata before it is extracted.
+
+    `client` is a boto3 S3 client, or anything with the same head_object and
+    get_object methods, e.g. flask_transfer.stubs.s3.LocalS3Client.
+    """
+
+    def __init__(self, client=None, bucket=None, prefix=None,
+                 cache_dir=ARTIFACT_CACHE_DIR,
+                 max_bytes=ARTIFACT_CACHE_MAX_MB * 1024 * 1024,
+                 part_size=ARTIFACT_PART_SIZE_MB * 1024 * 1024,
+                 workers=ARTIFACT_DOWNLOAD_WORKERS,
+                 retries=ARTIFACT_PART_RETRIES, in_use=None):
+        self._client = client
+        self.bucket = bucket or s3_utils.DEFAULT_S3_BUCKET
+        self.prefix = prefix or s3_utils.DEFAULT_S3_PROD_MODEL_DIR
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        # returns the version directories of the loaded models, see evict
+        self.in_use = in_use
+        # metadata of the last verified version of each model, with the
+        # `cache_dir` it was fetched into
+        self.fetched = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import boto3
+                self._client = boto3.client('s3')
+            return self._client
+
+    def key(self, model_name):
+        return f'{self.prefix}/{model_name}.tar.gz'
+
+    def metadata(self, model_name):
+        """
+        Returns:
+            dict: the artifact metadata, with at least `version`, and
+                `sha256` when the artifact was uploaded with a manifest
+        """
+        key = self.key(model_name)
+
+        def read_meta():
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=key + META_SUFFIX
+            )
+            return json.loads(response['Body'].read())
+
+        try:
+            meta = self._retried(key + META_SUFFIX, read_meta)
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+            meta = {}
+        if not meta.get('version') or not meta.get('size'):
+            head = self._retried(key, lambda: self.client.head_object(
+                Bucket=self.bucket, Key=key
+            ))
+            if not meta.get('size'):
+                meta['size'] = head['ContentLength']
+            if not meta.get('version'):
+                meta['version'] = head['ETag'].strip('"')
+        return meta
+
+    def _retried(self, what, call):
+        """
+        Calls `call` up to `retries` times with the backoff of the part
+        downloads, a missing key is not retried
+        """
+        for attempt in range(1, self.retries + 1):
+            try:
+                return call()
+            except Exception as e:
+                if is_not_found(e) or attempt == self.retries:
+                    raise
+                logger.warning(f'Retrying {what} after: {str(e)}')
+                time.sleep(0.1 * 2 ** attempt)
+
+    def _paths(self, model_name, version):
+        directory = os.path.join(self.cache_dir, model_name, version)
+        return {
+            'dir': directory,
+            'model': os.path.join(directory, 'model'),
+            'record': os.path.join(directory, RECORD_NAME),
+            'part': os.path.join(directory, 'artifact.tar.gz.part'),
+            'progress': os.path.join(directory, 'artifact.tar.gz.part.json'),
+            'lock': self._lock_path(directory),
+        }
+
+    def _lock_path(self, directory):
+        model_name, version = os.path.split(
+            os.path.relpath(directory, self.cache_dir)
+        )
+        return os.path.join(
+            self.cache_dir, LOCK_DIR, model_name, version + '.lock'
+        )
+
+    def _cached(self, paths, meta):
+        try:
+            with open(paths['record']) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('sha256') and record.get('sha256') != meta['sha256']:
+            return False
+        return os.path.isdir(paths['model'])
+
+    def fetch(self, model_name):
+        """
+        Returns the local directory of a model, downloading it if the cache
+        does not hold the current version
+
+        Args:
+            model_name (str): the model name
+
+        Raises:
+            ArtifactError: the download failed or its hash did not match
+
+        Returns:
+            str: the directory to pass to spacy.load
+        """
+        with self.fetching(model_name) as path:
+            return path
+
+    @contextlib.contextmanager
+    def fetching(self, model_name):
+        """
+        Fetches a model as `fetch` does, and holds a shared lock on its
+        version for the with block, so that it is not evicted while it is
+        loaded
+
+        Yields:
+            str: the directory to pass to spacy.load
+        """
+        meta = self.metadata(model_name)
+        version = version_dirname(meta['version'])
+        paths = self._paths(model_name, version)
+        os.makedirs(os.path.dirname(paths['lock']), exist_ok=True)
+
+        # one download per artifact, also across pre-forked processes
+        with open(paths['lock'], 'a') as lock:
+            while True:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._download_verified(model_name, version, meta, paths)
+                # flock does not convert the lock atomically, an eviction
+                # may remove the version in between
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if self._cached(paths, meta):
+                    break
+            self.fetched[model_name] = dict(meta, cache_dir=paths['dir'])
+            yield model_root(paths['model'])
+
+        self.evict(keep=paths['dir'])
+
+    def _download_verified(self, model_name, version, meta, paths):
+        """Downloads, verifies and extracts an artifact, unless it is cached"""
+        os.makedirs(paths['dir'], exist_ok=True)
+        if self._cached(paths, meta):
+            artifact_cache_hits.inc(model=model_name)
+            os.utime(paths['record'])
+            logger.info(f'Artifact of {model_name} {version} is cached')
+            return
+
+        artifact_cache_misses.inc(model=model_name)
+        with artifact_download_seconds.time():
+            self._download(model_name, meta, paths)
+            sha256 = file_sha256(paths['part'])
+        if meta.get('sha256') and sha256 != meta['sha256']:
+            artifact_hash_mismatches.inc(model=model_name)
+            self._discard_partial(paths)
+            raise ArtifactError(
+                f'SHA-256 of {model_name} {version} is {sha256}, '
+                f'expected {meta["sha256"]}'
+            )
+        if not meta.get('sha256'):
+            logger.warning(f'No SHA-256 in the metadata of {model_name}, '
+                           f'the artifact is not verified')
+
+        staging = paths['model'] + '.staging'
+        shutil.rmtree(staging, ignore_errors=True)
+        shutil.rmtree(paths['model'], ignore_errors=True)
+        safe_extract(paths['part'], staging)
+        os.replace(staging, paths['model'])
+        self._discard_partial(paths)
+        with open(paths['record'], 'w') as f:
+            json.dump({
+                'model': model_name,
+                'version': version,
+                'sha256': sha256,
+                'size': meta['size'],
+                'fetched_at': time.time(),
+            }, f)
+
+    def description(self, model_name):
+        """
+        Returns:
+            str: the description published with the fetched artifact, None
+                if it has none
+        """
+        return self.fetched.get(model_name, {}).get('description') or None
+
+    def load(self, model_name):
+        """
+        Returns:
+            SpaCy Pipeline: the model, loaded from the disk cache, from its
+                memory-mapped snapshot when it was published as one
+        """
+        with self.fetching(model_name) as path:
+            if is_snapshot(path):
+                return load_snapshot(path)
+            return spacy.load(path)
+
+    def _discard_partial(self, paths):
+        for name in ('part', 'progress'):
+            try:
+                os.remove(paths[name])
+            except FileNotFoundError:
+                pass
+
+    def _download(self, model_name, meta, paths):
+        key = self.key(model_name)
+        size = int(meta['size'])
+        ranges = part_ranges(size, self.part_size) or [(0, -1)]
+        done = set()
+        try:
+            with open(paths['progress']) as f:
+                progress = json.load(f)
+            if progress.get('size') == size and \
+                    progress.get('part_size') == self.part_size and \
+                    os.path.exists(paths['part']):
+                done = set(progress['done'])
+        except (OSError, ValueError):
+            pass
+        if not done:
+            with open(paths['part'], 'wb') as f:
+                f.truncate(size)
+        missing = [i for i in range(len(ranges)) if i not in done]
+        if done:
+            logger.info(f'Resuming download of {model_name}: '
+                        f'{len(done)}/{len(ranges)} parts present')
+        else:
+            logger.info(f'Downloading {model_name} ({size / 2**20:.1f}MB, '
+                        f'{len(ranges)} parts)')
+
+        progress_lock = threading.Lock()
+        fd = os.open(paths['part'], os.O_WRONLY)
+        try:
+            def fetch_part(index):
+                first, last = ranges[index]
+                self._fetch_range(fd, key, first, last)
+                with progress_lock:
+                    done.add(index)
+                    self._write_progress(paths, size, done)
+
+            if len(missing) == 1:
+                fetch_part(missing[0])
+            elif missing:
+                with ThreadPoolExecutor(
+                    max_workers=min(self.workers, len(missing)),
+                    thread_name_prefix='artifact-download',
+                ) as executor:
+                    # list() raises the first failed part
+                    list(executor.map(fetch_part, missing))
+        finally:
+            os.close(fd)
+
+    def _fetch_range(self, fd, key, first, last):
+        for attempt in range(1, self.retries + 1):
+            try:
+                kwargs = {}
+                if last >= first:
+                    kwargs['Range'] = f'bytes={first}-{last}'
+                response = self.client.get_object(
+                    Bucket=self.bucket, Key=key, **kwargs
+                )
+                offset = first
+                body = response['Body']
+                for chunk in iter(lambda: body.read(HASH_CHUNK_SIZE), b''):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                if last >= first and offset != last + 1:
+                    raise ArtifactError(
+                        f'Short read: bytes {first}-{offset - 1} of {first}-{last}'
+                    )
+                artifact_download_bytes.inc(offset - first)
+                return
+            except Exception as e:
+                if attempt == self.retries:
+                    raise ArtifactError(
+                        f'Unable to download bytes {first}-{last}: {str(e)}'
+                    ) from e
+                logger.warning(f'Retrying bytes {first}-{last} after: {str(e)}')
+                time.sleep(0.1 * 2 ** attempt)
+
+    def _write_progress(self, paths, size, done):
+        tmp = paths['progress'] + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({
+                'size': size, 'part_size': self.part_size, 'done': sorted(done)
+            }, f)
+        os.replace(tmp, paths['progress'])
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used artifacts until the cache fits in
+        max_bytes
+
+        Versions whose lock is held, being downloaded or loaded, and those
+        `in_use` returns are not removed.
+
+        Args:
+            keep (str): a version directory that is never removed
+        """
+        keep = {keep}
+        if self.in_use is not None:
+            keep.update(self.in_use())
+        entries = []
+        for model_name in self._listdir(self.cache_dir):
+            for version in self._listdir(os.path.join(self.cache_dir, model_name)):
+                directory = os.path.join(self.cache_dir, model_name, version)
+                try:
+                    used = os.path.getmtime(os.path.join(directory, RECORD_NAME))
+                except OSError:
+                    # a download in progress or abandoned, kept for resuming
+                    used = time.time()
+                entries.append([used, directory, directory_size(directory)])
+        total = sum(size for _, _, size in entries)
+        if self.max_bytes:
+            for used, directory, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if directory in keep:
+                    continue
+                lock_path = self._lock_path(directory)
+                try:
+                    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+                    lock = open(lock_path, 'a')
+                except OSError as e:
+                    logger.warning(f'Unable to lock {directory}: {str(e)}')
+                    continue
+                with lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        # being downloaded or loaded
+                        continue
+                    shutil.rmtree(directory, ignore_errors=True)
+                total -= size
+                logger.info(f'Evicted artifact {directory} '
+                            f'({size / 2**20:.1f}MB)')
+        artifact_cache_bytes.set(total)
+
+    def _listdir(self, path):
+        try:
+            return sorted(
+                e for e in os.listdir(path)
+                if not e.startswith('.') and
+                os.path.isdir(os.path.join(path, e))
+            )
+        except OSError:
+            return []
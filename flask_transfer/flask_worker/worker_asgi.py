@@ -0,0 +1,569 @@
+"""
+ASGI server mode of the worker
+
+Serves the routes and schemas of worker_flask_app from an asyncio event
+loop. Blocking work never runs on the loop: model lookups, downloads and
+loads run on an I/O thread pool, inference on a separately sized inference
+pool, so /health, /ready and GET /models/ answer at once while both are
+busy. Routes without an async handler, e.g. the admin endpoints and the
+Swagger UI, are passed to the Flask app on the I/O pool.
+
+Usage:
+    uvicorn flask_transfer.flask_worker.worker_asgi:app --host 0.0.0.0 --port 5001
+
+or, with the same options:
+    python -m flask_transfer.flask_worker.worker_asgi --port 5001
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import io
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from flask import abort
+from werkzeug.exceptions import HTTPException
+
+from . import worker_flask_app as flask_app
+from . import worker_timing
+from .worker_admission import ADMISSION_RETRY_AFTER, admission_rejected
+from .worker_fastjson import FAST_JSON, compile_marshal, compile_model, \
+    dumps, loads
+from .worker_logger import create_logger
+from .worker_logic import admit
+from .worker_metrics import REGISTRY
+from .worker_stream import STREAM_BATCH_SIZE
+
+logger = create_logger(__name__)
+
+# threads running inference, spaCy holds the GIL for most of it
+ASGI_INFERENCE_WORKERS = int(
+    os.getenv('ASGI_INFERENCE_WORKERS') or os.cpu_count() or 1
+)
+# threads for blocking I/O: S3 lookups, model downloads and loads, and the
+# routes served by the Flask app
+ASGI_IO_WORKERS = int(os.getenv('ASGI_IO_WORKERS') or 16)
+# calls waiting for a thread of a pool, more are answered with a 429
+ASGI_QUEUE_SIZE = int(os.getenv('ASGI_QUEUE_SIZE') or 64)
+
+executor_tasks = REGISTRY.gauge(
+    'worker_asgi_executor_tasks',
+    'Calls submitted to an ASGI executor that have not returned yet',
+    ['executor'],
+)
+
+worker = flask_app.worker
+api = flask_app.api
+WORKER_ROUTE = flask_app.WORKER_ROUTE
+
+_DONE = object()
+
+
+class BoundedExecutor:
+    """
+    A thread pool that async handlers await, holding at most `queue_size`
+    calls in its queue
+
+    The calls run in a copy of the caller's context, so that the stages
+    they time are added to the caller's request. Callers finding the queue
+    full are turned away with a 429, as by worker_admission.
+    """
+
+    def __init__(self, name, workers, queue_size=ASGI_QUEUE_SIZE):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = None
+        self._slots = None
+
+    @property
+    def executor(self):
+        # created on first use so that no threads exist before a fork
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix=self.name
+            )
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Raises:
+            HTTPException: a 429 when the queue is full
+
+        Returns:
+            the result of func(*args, **kwargs), called on a pool thread
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        if self._slots.locked():
+            admission_rejected.inc(limit=self.name, reason='queue_full')
+            abort(429, f'Too many requests waiting for {self.name}',
+                  retry_after=ADMISSION_RETRY_AFTER)
+        async with self._slots:
+            context = contextvars.copy_context()
+            call = functools.partial(context.run, func, *args, **kwargs)
+            executor_tasks.inc(executor=self.name)
+            try:
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executor, call
+                )
+            finally:
+                executor_tasks.dec(executor=self.name)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+inference_pool = BoundedExecutor('inference', ASGI_INFERENCE_WORKERS)
+io_pool = BoundedExecutor('io', ASGI_IO_WORKERS)
+
+
+class BodyReader(io.RawIOBase):
+    """
+    The body of an ASGI request as a blocking binary stream, for threads
+
+    Each read that needs more data waits for the next body message on the
+    event loop, so the body is only received as fast as it is consumed. A
+    client disconnect ends the stream.
+    """
+
+    def __init__(self, receive, loop):
+        super().__init__()
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        if not self._more:
+            return False
+        message = asyncio.run_coroutine_threadsafe(
+            self._receive(), self._loop
+        ).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            return False
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+        return True
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._fill():
+            pass
+        return self._take(len(self._buffer) if size < 0 else size)
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0:
+                end += 1
+                break
+            if 0 <= size <= len(self._buffer) or not self._fill():
+                end = len(self._buffer)
+                break
+        return self._take(end if size < 0 else min(end, size))
+
+
+async def iterate_in_thread(iterable, name='stream'):
+    """
+    Iterates over a blocking iterable in its own thread
+
+    The thread produces at most one item ahead of the consumer. Closing the
+    returned async generator stops the thread and closes the iterable.
+
+    Yields:
+        the items of the iterable
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue(1)
+    stop = threading.Event()
+
+    def put(item):
+        future = asyncio.run_coroutine_threadsafe(items.put(item), loop)
+        while not stop.is_set():
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                pass
+        future.cancel()
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    try:
+        while True:
+            item, error = await items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def query_args(scope):
+    return dict(parse_qsl(scope['query_string'].decode('latin1')))
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return bytes(body)
+
+
+async def send_response(send, status, body, content_type='application/json',
+                        headers=()):
+    """Sends a whole response, with the Server-Timing header if timed"""
+    headers = [
+        (b'content-type', content_type.encode()),
+        (b'content-length', str(len(body)).encode()),
+        *headers,
+    ]
+    timing = worker_timing.finish_header()
+    if timing is not None:
+        headers.append((b'server-timing', timing.encode()))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200, headers=()):
+    body = dumps(data)
+    await send_response(send, status, body, headers=headers)
+
+
+async def send_error(send, error):
+    """Sends an HTTPException as the Flask app would"""
+    data = getattr(error, 'data', None) or {'message': error.description}
+    headers = [
+        (name.lower().encode('latin1'), value.encode('latin1'))
+        for name, value in error.get_headers()
+        if name.lower() == 'retry-after'
+    ]
+    await send_json(send, data, error.code, headers)
+
+
+async def get_models(model_names):
+    """
+    Returns the entries of the requested models, as Worker.get_models
+
+    Loaded models are looked up on the event loop, the others are looked up
+    in the catalog and loaded on the I/O pool.
+
+    Returns:
+        dict: the entry of each distinct model, in request order
+    """
+    models = dict()
+    for model_name in dict.fromkeys(model_names):
+        entry = None
+        if model_name in worker.model_mapping:
+            entry = worker.model_mapping.get(model_name)
+        if entry is None:
+            entry = await io_pool.run(worker.get_model, model_name)
+        models[model_name] = entry
+    return models
+
+
+def model_resource(request_model, response_model, handler, model_field):
+    """
+    Builds an async handler of a model route, see worker_flask_app
+
+    The body is validated against the request schema on the event loop.
+    Then, as in the Flask app, the request slot is taken, the models are
+    resolved by get_models and their slots are taken, waiting on the I/O
+    pool, and the Worker handler runs on the inference pool.
+
+    Args:
+        request_model: the flask_restx model of the request body
+        response_model: the flask_restx model the response is marshalled to
+        handler (callable): the Worker method handling the request
+        model_field (str): the request field listing the models
+
+    Returns:
+        function: the ASGI handler
+    """
+    handler = flask_app.profiler.profiled(handler)
+    compiled = compile_model(api, request_model)
+    marshal_response = compile_marshal(response_model) if FAST_JSON else \
+        functools.partial(api.marshal, fields=response_model)
+
+    async def handle(scope, receive, send):
+        timings = worker_timing.start()
+        body = await read_body(receive)
+        try:
+            try:
+                document = loads(body)
+            except ValueError:
+                abort(400, 'The browser (or proxy) sent a request that this '
+                           'server could not understand.')
+            if FAST_JSON:
+                compiled.validate(document)
+            else:
+                request_model.validate(
+                    document, format_checker=api.format_checker
+                )
+            if timings is not None:
+                timings.add('validate', time.perf_counter() - timings.started)
+            with worker_timing.stage('marshal'):
+                payload = compiled.marshal(document) if FAST_JSON else \
+                    api.marshal(document, request_model)
+            await io_pool.run(admit, worker.admission.requests.acquire)
+            try:
+                models = await get_models(payload[model_field])
+                slots = await io_pool.run(
+                    admit, worker.admission.acquire_models, models
+                )
+                try:
+                    result = await inference_pool.run(
+                        handler, payload, models, admitted=True
+                    )
+                finally:
+                    worker.admission.release_models(slots)
+            finally:
+                worker.admission.requests.release()
+        except HTTPException as e:
+            return await send_error(send, e)
+        finally:
+            if timings is not None:
+                timings.handler_ended = time.perf_counter()
+        await send_json(send, marshal_response(result))
+    return handle
+
+
+async def models_get(scope, receive, send):
+    request_in_time = time.perf_counter()
+    response = worker.worker_put_request()
+    logger.info(f'GET REQUEST '
+                f'dur: {(time.perf_counter() - request_in_time)*1000:.3f}ms')
+    await send_json(send, api.marshal(response, flask_app.services_put_body))
+
+
+async def models_stream(scope, receive, send):
+    try:
+        batch_size = int(query_args(scope).get('batch_size') or STREAM_BATCH_SIZE)
+    except ValueError:
+        return await send_json(send, {'message': 'batch_size must be an integer'}, 400)
+    if batch_size < 1:
+        return await send_json(send, {'message': 'batch_size must be positive'}, 400)
+    body = BodyReader(receive, asyncio.get_running_loop())
+    try:
+        # waits for a request slot, which the stream holds until closed
+        stream = await io_pool.run(
+            worker.handle_stream, body, flask_app.parse_stream_line,
+            batch_size,
+        )
+    except HTTPException as e:
+        return await send_error(send, e)
+    lines = iterate_in_thread(stream, name='stream-output')
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/x-ndjson')]})
+        async for data in lines:
+            await send({'type': 'http.response.body', 'body': data,
+                        'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await lines.aclose()
+        # in case the output thread never started
+        stream.close()
+
+
+async def health(scope, receive, send):
+    await send_response(send, 200, b'Service Up', 'text/html; charset=utf-8')
+
+
+async def ready(scope, receive, send):
+    status = {
+        'ready': worker.ready.is_set(),
+        'loaded': worker.model_mapping.names(),
+        'failed': worker.preload_failed,
+    }
+    await send_json(send, status, 200 if status['ready'] else 503)
+
+
+async def stats(scope, receive, send):
+    await send_json(send, REGISTRY.snapshot())
+
+
+async def metrics(scope, receive, send):
+    await send_response(send, 200, REGISTRY.exposition().encode(),
+                        'text/plain; version=0.0.4')
+
+
+# (method, path): handler, the paths of worker_flask_app
+ROUTES = {
+    ('POST', '/models/'): model_resource(
+        flask_app.request_body, flask_app.post_response,
+        worker.handle_request,
+        'c' if WORKER_ROUTE == 'similarities' else WORKER_ROUTE,
+    ),
+    ('GET', '/models/'): models_get,
+    ('GET', '/health'): health,
+    ('GET', '/ready'): ready,
+    ('GET', '/stats'): stats,
+    ('GET', '/metrics'): metrics,
+}
+if flask_app.batch_request_body is not None:
+    ROUTES[('POST', '/models/batch')] = model_resource(
+        flask_app.batch_request_body, flask_app.batch_post_response,
+        worker.handle_batch_request, WORKER_ROUTE,
+    )
+    ROUTES[('POST', '/models/stream')] = models_stream
+if WORKER_ROUTE == 'similarities':
+    ROUTES[('POST', '/models/search')] = model_resource(
+        flask_app.search_request_body, flask_app.search_post_response,
+        worker.handle_search_request, 'c',
+    )
+
+
+def wsgi_environ(scope, body):
+    """
+    Returns:
+        dict: the WSGI environ of an ASGI HTTP request
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else \
+            'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """
+    Returns:
+        tuple: the status code, headers and body of a WSGI response
+    """
+    response = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [int(status.split()[0]), headers]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        close = getattr(result, 'close', None)
+        if close is not None:
+            close()
+    status, headers = response
+    return status, [
+        (name.lower().encode('latin1'), value.encode('latin1'))
+        for name, value in headers
+    ], body
+
+
+async def flask_fallback(scope, receive, send):
+    """Serves a request with the Flask app, on the I/O pool"""
+    body = await read_body(receive)
+    try:
+        status, headers, body = await io_pool.run(
+            call_wsgi, flask_app.app, wsgi_environ(scope, body)
+        )
+    except HTTPException as e:
+        return await send_error(send, e)
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            logger.info(
+                f'ASGI worker: {ASGI_INFERENCE_WORKERS} inference threads, '
+                f'{ASGI_IO_WORKERS} I/O threads'
+            )
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            inference_pool.shutdown()
+            io_pool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(scope, receive, send)
+    if scope['type'] != 'http':
+        return
+    handler = ROUTES.get((scope['method'], scope['path']), flask_fallback)
+    try:
+        await handler(scope, receive, send)
+    except Exception as e:
+        logger.error(f'{scope["method"]} {scope["path"]} failed: {str(e)}')
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ASGI server of the worker')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, lifespan='on')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
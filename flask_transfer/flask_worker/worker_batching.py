@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# micro-batching of concurrent single-text requests, off by default
+MICRO_BATCHING = (os.getenv('MICRO_BATCHING') or 'false').lower() in ('1', 'true')
+# how long the first queued text may wait for others to join its batch
+MICRO_BATCH_MAX_WAIT_MS = float(os.getenv('MICRO_BATCH_MAX_WAIT_MS') or 5)
+# the largest batch passed to the model at once
+MICRO_BATCH_MAX_SIZE = int(os.getenv('MICRO_BATCH_MAX_SIZE') or 32)
+
+queue_depth = REGISTRY.gauge(
+    'worker_batch_queue_depth',
+    'Texts waiting to be batched',
+    ['model'],
+)
+batch_size = REGISTRY.histogram(
+    'worker_batch_size',
+    'Number of texts per micro-batch',
+    ['model'],
+)
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-text requests to a model into batches
+
+    Texts are queued by `get_results`. A background thread takes up to
+    `max_batch` texts, waiting at most `max_wait_ms` after the oldest one
+    arrived, runs them through the model with a single nlp.pipe, and hands
+    each result back to the thread that queued the text. If the batch fails,
+    its texts are run again one at a time.
+    """
+
+    def __init__(self, model_name, batch_model,
+                 max_wait_ms=MICRO_BATCH_MAX_WAIT_MS,
+                 max_batch=MICRO_BATCH_MAX_SIZE):
+        self.model_name = model_name
+        self.batch_model = batch_model
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, text):
+        """
+        Queues a text for the next batch
+
+        Args:
+            text (str): the text to be passed to the model
+
+        Returns:
+            concurrent.futures.Future: resolves to the formatted model output
+        """
+        future = Future()
+        with self._cond:
+            stopped = self._stopped
+            if not stopped:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(
+                        target=self._run,
+                        name=f'micro-batch-{self.model_name}',
+                        daemon=True,
+                    )
+                    self._thread.start()
+                self._queue.append((time.monotonic(), text, future))
+                queue_depth.set(len(self._queue), model=self.model_name)
+                self._cond.notify()
+        if stopped:
+            # e.g. the model was evicted while this request held it
+            future.set_result(self.batch_model([text])[0])
+        return future
+
+    @property
+    def depth(self):
+        """The number of texts waiting for a batch"""
+        return len(self._queue)
+
+    def get_results(self, text):
+        """Same signature as model_formatter's get_results"""
+        return self.submit(text).result()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._stopped:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            deadline = self._queue[0][0] + self.max_wait
+            while len(self._queue) < self.max_batch and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [
+                self._queue.popleft()
+                for _ in range(min(self.max_batch, len(self._queue)))
+            ]
+            queue_depth.set(len(self._queue), model=self.model_name)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            futures = [future for _, _, future in batch]
+            texts = [text for _, text, _ in batch]
+            batch_size.observe(len(texts), model=self.model_name)
+            try:
+                results = self.batch_model(texts, batch_size=len(texts))
+            except Exception as e:
+                logger.error(f'Batch of {len(texts)} failed for '
+                             f'{self.model_name}: {str(e)}')
+                if len(texts) == 1:
+                    futures[0].set_exception(e)
+                else:
+                    self._run_singly(texts, futures)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def _run_singly(self, texts, futures):
+        """
+        Runs the texts of a failed batch one at a time, so that only the
+        requests whose text fails get the error
+        """
+        for text, future in zip(texts, futures):
+            try:
+                future.set_result(self.batch_model([text], batch_size=1)[0])
+            except Exception as e:
+                future.set_exception(e)
+
+    def stop(self):
+        """
+        Stops the background thread once the queue is drained
+
+        Texts submitted afterwards are run directly, without batching.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        queue_depth.remove(model=self.model_name)
@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+
+import scripts.utils as s3_utils
+from .worker_logger import create_logger
+from .worker_metrics import LATENCY_BUCKETS, REGISTRY
+
+logger = create_logger(__name__)
+
+# seconds between background refreshes of the model index
+CATALOG_TTL = float(os.getenv('CATALOG_TTL') or 300)
+# seconds an unknown model name is remembered as unknown
+CATALOG_NEGATIVE_TTL = float(os.getenv('CATALOG_NEGATIVE_TTL') or 60)
+# minimum seconds between two refreshes triggered by a lookup miss
+CATALOG_MIN_REFRESH_INTERVAL = float(
+    os.getenv('CATALOG_MIN_REFRESH_INTERVAL') or 30
+)
+
+catalog_lookup_seconds = REGISTRY.histogram(
+    'worker_catalog_lookup_seconds',
+    'Time to check whether a model is in the catalog, including refreshes '
+    'caused by misses',
+    buckets=LATENCY_BUCKETS,
+)
+catalog_refresh_seconds = REGISTRY.histogram(
+    'worker_catalog_refresh_seconds',
+    'Time to list the models in S3 and the local model dir',
+    buckets=LATENCY_BUCKETS,
+)
+catalog_refresh_failures = REGISTRY.counter(
+    'worker_catalog_refresh_failures_total',
+    'Catalog refreshes that could not list the S3 models',
+)
+catalog_models = REGISTRY.gauge(
+    'worker_catalog_models',
+    'Models in the catalog',
+    ['source'],
+)
+
+
+def model_name_from_key(key):
+    """
+    Extracts the model name from an S3 key
+
+    Example:
+        'prod_models/topic.tar.gz' -> 'topic'
+
+    Args:
+        key (str): The S3 key of a model artifact
+
+    Returns:
+        str: The model name
+    """
+    return key.split('/')[1].split('.')[0]
+
+
+class ModelCatalog:
+    """
+    In-memory index of the models available in S3 and in the local model dir
+
+    The index is refreshed in the background every `ttl` seconds. A lookup
+    miss only lists the bucket if the index is empty or older than
+    `min_refresh_interval`, and names that are not found are remembered for
+    `negative_ttl` seconds so that repeated requests for unknown models are
+    answered from memory.
+    """
+
+    def __init__(self, local_model_dir, ttl=CATALOG_TTL,
+                 negative_ttl=CATALOG_NEGATIVE_TTL,
+                 min_refresh_interval=CATALOG_MIN_REFRESH_INTERVAL):
+        self.local_model_dir = local_model_dir
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.s3_models = frozenset()
+        self.local_models = frozenset()
+        self.refreshed_at = None
+        self._unknown = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # called after each background refresh
+        self.on_refresh = []
+
+    def _list_s3_models(self):
+        return frozenset(
+            model_name_from_key(key) for key in s3_utils.scrape_bucket()
+        )
+
+    def _list_local_models(self):
+        try:
+            return frozenset(os.listdir(self.local_model_dir))
+        except OSError:
+            return frozenset()
+
+    def refresh(self):
+        """
+        Rebuilds the index from S3 and the local model dir
+
+        A failed S3 listing keeps the previous S3 index so that a transient
+        outage does not make every model unknown.
+
+        Returns:
+            bool: True if the S3 listing succeeded
+        """
+        with self._refresh_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        ok = True
+        with catalog_refresh_seconds.time():
+            try:
+                s3_models = self._list_s3_models()
+            except Exception as e:
+                logger.error(f'Unable to list S3 models: {str(e)}')
+                catalog_refresh_failures.inc()
+                s3_models = self.s3_models
+                ok = False
+            local_models = self._list_local_models()
+
+        with self._lock:
+            self.s3_models = s3_models
+            self.local_models = local_models
+            self.refreshed_at = time.monotonic()
+            self._unknown.clear()
+        catalog_models.set(len(s3_models), source='s3')
+        catalog_models.set(len(local_models), source='local')
+
+        logger.info(f'Catalog refreshed: {len(s3_models)} S3 models, '
+                    f'{len(local_models)} local models')
+        return ok
+
+    def _age(self):
+        if self.refreshed_at is None:
+            return None
+        return time.monotonic() - self.refreshed_at
+
+    def _known(self, model_name):
+        return model_name in self.s3_models or \
+            model_name in self.local_models
+
+    def contains(self, model_name):
+        """
+        Checks whether a model can be loaded from S3 or the local model dir
+
+        Args:
+            model_name (str): The model to look up
+
+        Returns:
+            bool: True if the model is in the index
+        """
+        with catalog_lookup_seconds.time():
+            return self._contains(model_name)
+
+    def _contains(self, model_name):
+        if self._known(model_name):
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            expires = self._unknown.get(model_name)
+            if expires is not None:
+                if expires > now:
+                    return False
+                del self._unknown[model_name]
+
+        # a miss only refreshes the index if it is empty or stale enough,
+        # and concurrent misses share a single refresh
+        with self._refresh_lock:
+            age = self._age()
+            if age is None or age > self.min_refresh_interval:
+                self._refresh()
+        if self._known(model_name):
+            return True
+
+        with self._lock:
+            self._unknown[model_name] = now + self.negative_ttl
+        return False
+
+    def models(self):
+        """
+        Returns:
+            list: Sorted names of all models in the index
+        """
+        return sorted(self.s3_models | self.local_models)
+
+    def invalidate(self, model_name=None):
+        """
+        Forgets cached lookups so that the next lookup sees the latest models
+
+        The index is marked stale, so the next miss lists the bucket again.
+
+        Args:
+            model_name (str): Only forget the negative entry for this model.
+                If None, all negative entries are forgotten.
+        """
+        with self._lock:
+            if model_name is None:
+                self._unknown.clear()
+            else:
+                self._unknown.pop(model_name, None)
+            self.refreshed_at = None
+        logger.info(f'Catalog invalidated: {model_name or "all models"}')
+
+    def _refreshed(self):
+        for callback in self.on_refresh:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f'Catalog refresh callback failed: {str(e)}')
+
+    def _run(self):
+        self.refresh()
+        self._refreshed()
+        while not self._stop.wait(self.ttl):
+            self.refresh()
+            self._refreshed()
+
+    def start(self):
+        """Starts the background refresh thread if it is not running"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='model-catalog', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background refresh thread"""
+        self._stop.set()
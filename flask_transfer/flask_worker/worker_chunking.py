@@ -0,0 +1,202 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .worker_metrics import REGISTRY
+
+# texts longer than this many characters are classified in chunks, 0 is off
+CHUNK_THRESHOLD_CHARS = int(os.getenv('CHUNK_THRESHOLD_CHARS') or 0)
+# sentences: whole sentences packed into chunks, tokens: fixed token windows
+CHUNK_MODE = os.getenv('CHUNK_MODE') or 'sentences'
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS') or 256)
+# tokens repeated at the start of the next window in tokens mode
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS') or 32)
+# combines the chunk scores of a class: mean, max or weighted
+CHUNK_REDUCER = os.getenv('CHUNK_REDUCER') or 'weighted'
+# threads running the chunks of a text, shared by all models
+CHUNK_WORKERS = int(os.getenv('CHUNK_WORKERS') or 4)
+
+text_chunks = REGISTRY.histogram(
+    'worker_text_chunks',
+    'Chunks per text classified in chunks',
+    buckets=tuple(2 ** i for i in range(12)),
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def chunk_executor():
+    # created on first use so that no threads exist before a fork
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=CHUNK_WORKERS, thread_name_prefix='chunks'
+            )
+        return _executor
+
+
+def _forget_executor():
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+
+
+# the threads of the parent do not exist in a forked process
+os.register_at_fork(after_in_child=_forget_executor)
+
+
+def reduce_mean(scores, weights):
+    return {
+        label: sum(s[label] for s in scores) / len(scores)
+        for label in scores[0]
+    }
+
+
+def reduce_max(scores, weights):
+    return {label: max(s[label] for s in scores) for label in scores[0]}
+
+
+def reduce_weighted(scores, weights):
+    total = sum(weights)
+    return {
+        label: sum(s[label] * w for s, w in zip(scores, weights)) / total
+        for label in scores[0]
+    }
+
+
+# reducers by name, each takes the cats of every chunk and the chunk lengths
+REDUCERS = {
+    'mean': reduce_mean,
+    'max': reduce_max,
+    'weighted': reduce_weighted,
+}
+
+
+def split_segments(text, max_length):
+    """
+    Cuts a text into pieces of at most max_length characters, at the last
+    line break or space when there is one, as nlp.make_doc refuses longer
+    texts
+
+    Yields:
+        str: the pieces, which join back into the text
+    """
+    while len(text) > max_length:
+        cut = max(text.rfind('\n', 0, max_length), text.rfind(' ', 0, max_length))
+        cut = cut + 1 if cut > 0 else max_length
+        yield text[:cut]
+        text = text[cut:]
+    if text:
+        yield text
+
+
+class TextChunker:
+    """
+    Classifies long texts as the combined scores of their chunks
+
+    Texts up to `threshold` characters are left to the model as they are.
+    Longer ones are tokenized and cut into chunks of at most `max_tokens`
+    tokens, either whole sentences packed together (found by spaCy's
+    rule-based Sentencizer, a sentence longer than a chunk is cut into
+    windows) or overlapping token windows. The chunks are run with nlp.pipe
+    on a thread pool, in up to CHUNK_WORKERS groups, and the scores of each
+    class are combined by a reducer:
+        mean      every chunk counts the same
+        max       the highest score of any chunk
+        weighted  the mean weighted by the number of tokens of each chunk
+    """
+
+    def __init__(self, nlp, threshold=CHUNK_THRESHOLD_CHARS, mode=CHUNK_MODE,
+                 max_tokens=CHUNK_MAX_TOKENS, overlap=CHUNK_OVERLAP_TOKENS,
+                 reducer=CHUNK_REDUCER, workers=CHUNK_WORKERS):
+        if mode not in ('sentences', 'tokens'):
+            raise ValueError(f'Unknown chunk mode: {mode}')
+        if reducer not in REDUCERS:
+            raise ValueError(
+                f'Unknown chunk reducer: {reducer}, use one of {sorted(REDUCERS)}'
+            )
+        if not 0 <= overlap < max_tokens:
+            raise ValueError('The chunk overlap must be smaller than a chunk')
+        self.nlp = nlp
+        self.threshold = threshold
+        self.mode = mode
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.reduce = REDUCERS[reducer]
+        self.workers = workers
+        self._sentencizer = None
+        if mode == 'sentences':
+            from spacy.pipeline import Sentencizer
+            self._sentencizer = Sentencizer()
+
+    def applies(self, text):
+        return self.threshold > 0 and len(text) > self.threshold
+
+    def _windows(self, start, end, step):
+        while True:
+            yield start, min(start + self.max_tokens, end)
+            if start + self.max_tokens >= end:
+                return
+            start += step
+
+    def split(self, text):
+        """
+        Returns:
+            list: the chunks of the text, as Docs that nlp.pipe does not
+                tokenize again
+        """
+        chunks = []
+        for segment in split_segments(text, self.nlp.max_length):
+            doc = self.nlp.make_doc(segment)
+            if self.mode == 'tokens':
+                step = self.max_tokens - self.overlap
+                spans = self._windows(0, len(doc), step)
+            else:
+                spans = self._pack_sentences(self._sentencizer(doc))
+            chunks.extend(doc[start:end].as_doc() for start, end in spans)
+        return [chunk for chunk in chunks if len(chunk)]
+
+    def _pack_sentences(self, doc):
+        start = end = 0
+        for sentence in doc.sents:
+            if sentence.end - start <= self.max_tokens:
+                end = sentence.end
+                continue
+            if end > start:
+                yield start, end
+            start = sentence.start
+            if sentence.end - start > self.max_tokens:
+                # a sentence longer than a chunk is cut into windows
+                *windows, (start, _) = self._windows(
+                    start, sentence.end, self.max_tokens
+                )
+                yield from windows
+            end = sentence.end
+        if end > start:
+            yield start, end
+
+    def _run(self, chunks):
+        return [doc.cats for doc in self.nlp.pipe(chunks)]
+
+    def cats(self, text):
+        """
+        Returns:
+            dict: the combined score of each class, as in Doc.cats
+        """
+        chunks = self.split(text)
+        if not chunks:
+            return self.nlp(text).cats
+        text_chunks.observe(len(chunks))
+        groups = min(self.workers, len(chunks))
+        if groups <= 1:
+            scores = self._run(chunks)
+        else:
+            size = -(-len(chunks) // groups)
+            futures = [
+                chunk_executor().submit(self._run, chunks[i:i + size])
+                for i in range(0, len(chunks), size)
+            ]
+            scores = [cats for future in futures for cats in future.result()]
+        return self.reduce(scores, [len(chunk) for chunk in chunks])
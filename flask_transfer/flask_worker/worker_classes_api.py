@@ -113,3 +113,120 @@ def get_classes_post_response(api):
         }
     )
     return classes_post_response
+
+
+def get_classes_batch_body(api, max_texts=None, max_n_process=None):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the body of a POST to /classes/batch
+
+    Example:
+    {
+        "texts": [
+            "I wonder what this sentence is about",
+            "And what about this one"
+        ],
+        "classes": ["topic", "subtopic"],
+        "min_confidence": 0.1,
+        "max_classes": 3,
+        "batch_size": 64,
+        "n_process": 1
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+        max_texts (int): the most texts a request may have, unbounded if
+            None
+        max_n_process (int): the largest n_process a request may ask for,
+            unbounded if None
+
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+    classes_batch_body = {
+        "texts": fields.List(
+            fields.String(
+                example="I wonder what this sentence is about"
+            ),
+            required=True,
+            description="The texts to be classified",
+            max_items=max_texts,
+        ),
+        "classes": fields.List(
+            fields.String(
+                example="intent"
+            ),
+            required=True,
+            description="The type(s) of classification to be performed",
+        ),
+        "min_confidence": fields.Float(
+            required=False,
+            example=0.1,
+            default=0,
+        ),
+        "max_classes": fields.Integer(
+            required=False,
+            example=3,
+            default=10,
+        ),
+        "batch_size": fields.Integer(
+            required=False,
+            description="The number of texts passed to the model at once",
+            example=64,
+            min=1,
+            max=10000,
+        ),
+        "n_process": fields.Integer(
+            required=False,
+            description="The number of processes used by the model, "
+                        "at most the worker's MAX_N_PROCESS",
+            example=1,
+            min=1,
+            max=max_n_process,
+        ),
+    }
+    return api.model('classes_batch_body', classes_batch_body)
+
+
+def get_classes_batch_post_response(api):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the response of a POST to /classes/batch, one
+    /classes/ response per input text, in input order
+
+    Example:
+    {
+        "results": [
+            {
+                "classes": [
+                    {
+                        "type": "topic",
+                        "result": [
+                            {
+                                "value": "new",
+                                "score": 0.75
+                            }
+                        ]
+                    }
+                ],
+                "text": "I wonder what this sentence is about"
+            }
+        ]
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+    classes_batch_post_response = api.model(
+        'classes_batch_post_response',
+        {
+            "results": fields.List(
+                fields.Nested(get_classes_post_response(api))
+            ),
+        }
+    )
+    return classes_batch_post_response
@@ -125,3 +125,124 @@ def get_entities_post_response(api):
         }
     )
     return entities_post_response
+
+
+def get_entities_batch_body(api, max_texts=None, max_n_process=None):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the body of a POST to /entities/batch
+
+    Example:
+    {
+        "texts": [
+            "A specific name like James could be an entity",
+            "So could Mary"
+        ],
+        "entities": ["name"],
+        "min_confidence": 0.1,
+        "min_length": 2,
+        "batch_size": 64,
+        "n_process": 1
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+        max_texts (int): the most texts a request may have, unbounded if
+            None
+        max_n_process (int): the largest n_process a request may ask for,
+            unbounded if None
+
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+    entities_batch_body = {
+        "texts": fields.List(
+            fields.String(
+                example="A specific name like James could be an entity"
+            ),
+            required=True,
+            description="The texts from which entities will be extracted",
+            max_items=max_texts,
+        ),
+        "entities": fields.List(
+            fields.String(
+                example="name"
+            ),
+            required=True,
+            description="The type(s) of entities to be detected",
+        ),
+        "min_confidence": fields.Float(
+            required=False,
+            description="The minimum acceptable level of confidence for entities",
+            example=0.1,
+            default=0,
+        ),
+        "min_length": fields.Integer(
+            required=False,
+            description="The minimum acceptable number of characters for returned entities",
+            example=2,
+            default=1,
+        ),
+        "batch_size": fields.Integer(
+            required=False,
+            description="The number of texts passed to the model at once",
+            example=64,
+            min=1,
+            max=10000,
+        ),
+        "n_process": fields.Integer(
+            required=False,
+            description="The number of processes used by the model, "
+                        "at most the worker's MAX_N_PROCESS",
+            example=1,
+            min=1,
+            max=max_n_process,
+        ),
+    }
+    return api.model('entities_batch_body', entities_batch_body)
+
+
+def get_entities_batch_post_response(api):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the response of a POST to /entities/batch, one
+    /entities/ response per input text, in input order
+
+    Example:
+    {
+        "results": [
+            {
+                "entities": [
+                    {
+                        "type": "name",
+                        "result": [
+                            {
+                                "value": "James",
+                                "score": 0.75,
+                                "start_char": 21,
+                                "end_char": 26
+                            }
+                        ]
+                    }
+                ],
+                "text": "A specific name like James could be an entity"
+            }
+        ]
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+    entities_batch_post_response = api.model(
+        'entities_batch_post_response',
+        {
+            "results": fields.List(
+                fields.Nested(get_entities_post_response(api))
+            ),
+        }
+    )
+    return entities_batch_post_response
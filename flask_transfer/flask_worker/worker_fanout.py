@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .worker_logger import create_logger
+
+logger = create_logger(__name__)
+
+# run the models of a multi-model request together, off by default
+FANOUT = (os.getenv('FANOUT') or 'false').lower() in ('1', 'true')
+# threads running the models of one request concurrently
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS') or 4)
+
+
+def tokenizer_signature(nlp):
+    """
+    Identifies the tokenization of a pipeline
+
+    Pipelines with the same signature split any text into the same tokens,
+    so a text only needs to be tokenized once for all of them.
+
+    Args:
+        nlp (SpaCy Pipeline): the loaded pipeline
+
+    Returns:
+        str: the language and a digest of the tokenizer rules
+    """
+    try:
+        rules = nlp.tokenizer.to_bytes(exclude=['vocab'])
+        return f'{nlp.lang}-{hashlib.sha1(rules).hexdigest()}'
+    except Exception as e:
+        logger.error(f'Unable to read tokenizer rules: {str(e)}')
+        # never shared with another pipeline
+        return f'unshared-{id(nlp)}'
+
+
+def doc_from_tokens(nlp, words, spaces, norms):
+    """
+    Builds a Doc in the vocab of `nlp` from already split tokens
+
+    Tokenizer exceptions set the norm of a token, e.g. "ca" is "can", which
+    the lexemes of a new Doc do not know, so the norms are copied as well.
+    """
+    from spacy.tokens import Doc
+    doc = Doc(nlp.vocab, words=words, spaces=spaces)
+    for token, norm in zip(doc, norms):
+        if token.norm_ != norm:
+            token.norm_ = norm
+    return doc
+
+
+def run_pipeline(nlp, doc):
+    """Runs every pipeline component of `nlp` over an already tokenized doc"""
+    for _, component in nlp.pipeline:
+        doc = component(doc)
+    return doc
+
+
+class FanOut:
+    """
+    Runs several models over one text
+
+    Models whose tokenizers share a signature reuse a single tokenization,
+    each getting its own Doc in its own vocab, with the same tokens and
+    norms as its own tokenizer would give. The pipelines then run
+    concurrently on a thread pool instead of one after another.
+    """
+
+    def __init__(self, workers=FANOUT_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # created on first use so that no threads exist before a fork
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='fanout'
+                )
+            return self._executor
+
+    def _run(self, entry, doc):
+        return entry['format_doc'](run_pipeline(entry['nlp'], doc))
+
+    def run(self, text, entries):
+        """
+        Args:
+            text (str): the text to be passed to the models
+            entries (list): (model name, model_mapping entry) pairs
+
+        Returns:
+            dict: the formatted output of each model, by model name
+        """
+        groups = {}
+        for model_name, entry in entries:
+            if 'tokenizer_signature' not in entry:
+                entry['tokenizer_signature'] = tokenizer_signature(entry['nlp'])
+            groups.setdefault(entry['tokenizer_signature'], []).append(
+                (model_name, entry)
+            )
+
+        futures = {}
+        for group in groups.values():
+            first_name, first_entry = group[0]
+            doc = first_entry['nlp'].make_doc(text)
+            if len(group) > 1:
+                words = [token.text for token in doc]
+                spaces = [bool(token.whitespace_) for token in doc]
+                norms = [token.norm_ for token in doc]
+            futures[first_name] = self.executor.submit(
+                self._run, first_entry, doc
+            )
+            for model_name, entry in group[1:]:
+                shared = doc_from_tokens(
+                    entry['nlp'], words, spaces, norms
+                )
+                futures[model_name] = self.executor.submit(
+                    self._run, entry, shared
+                )
+        return {
+            model_name: future.result()
+            for model_name, future in futures.items()
+        }
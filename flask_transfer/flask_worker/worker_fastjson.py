@@ -0,0 +1,435 @@
+import functools
+import json
+import os
+import re
+
+from flask import Response, current_app, request
+from flask_restx import fields, marshal
+from flask_restx.errors import abort as restx_abort
+from flask_restx.utils import unpack
+from jsonschema.validators import validator_for
+
+from .worker_timing import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# validate and marshal payloads and responses with models compiled once,
+# and encode JSON with orjson when it is installed
+FAST_JSON = (os.getenv('FAST_JSON') or 'true').lower() in ('1', 'true')
+
+# JSON schema keywords that only document a field
+_ANNOTATIONS = {'description', 'example', 'default', 'title', 'readOnly'}
+_TYPES = {
+    'string': lambda value: type(value) is str,
+    'integer': lambda value: type(value) is int,
+    'number': lambda value: type(value) is int or type(value) is float,
+    'boolean': lambda value: type(value) is bool,
+    'array': lambda value: type(value) is list,
+    'object': lambda value: type(value) is dict,
+    'null': lambda value: value is None,
+}
+
+
+def dumps(data):
+    """
+    Returns:
+        bytes: the data as JSON, followed by a newline as flask_restx does
+    """
+    if FAST_JSON and orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            pass
+    return json.dumps(data).encode() + b'\n'
+
+
+def loads(data):
+    """
+    Raises:
+        ValueError: the data is not JSON, as json.loads
+    """
+    if FAST_JSON and orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # json also reads NaN and integers beyond 64 bits
+            pass
+    return json.loads(data)
+
+
+def _all(checks):
+    checks = tuple(checks)
+    if len(checks) == 1:
+        return checks[0]
+    return lambda value: all(check(value) for check in checks)
+
+
+def compile_check(schema):
+    """
+    Compiles the JSON schema keywords that flask_restx models use for
+    request bodies into a predicate
+
+    The predicate is stricter than jsonschema, e.g. 1.0 is not an integer,
+    so data it rejects may still be valid, but data it accepts is.
+
+    Args:
+        schema (dict): a JSON schema, e.g. model.__schema__
+
+    Returns:
+        function: the predicate, None if the schema uses other keywords
+    """
+    checks = []
+    for keyword, value in schema.items():
+        if keyword in _ANNOTATIONS:
+            continue
+        if keyword == 'type':
+            if value not in _TYPES:
+                return None
+            checks.append(_TYPES[value])
+        elif keyword == 'required':
+            required = tuple(value)
+            checks.append(lambda data: type(data) is not dict or all(
+                name in data for name in required
+            ))
+        elif keyword == 'properties':
+            properties = []
+            for name, property_schema in value.items():
+                check = compile_check(property_schema)
+                if check is None:
+                    return None
+                properties.append((name, check))
+            checks.append(lambda data, properties=tuple(properties): (
+                type(data) is not dict or all(
+                    check(data[name]) for name, check in properties
+                    if name in data
+                )
+            ))
+        elif keyword == 'items' and isinstance(value, dict):
+            check = compile_check(value)
+            if check is None:
+                return None
+            checks.append(lambda data, check=check: (
+                type(data) is not list or all(check(item) for item in data)
+            ))
+        elif keyword in ('minimum', 'maximum'):
+            bound = value
+            compare = (lambda a, b: a >= b) if keyword == 'minimum' else \
+                (lambda a, b: a <= b)
+            checks.append(lambda data, bound=bound, compare=compare: (
+                not _TYPES['number'](data) or compare(data, bound)
+            ))
+        elif keyword in ('minLength', 'maxLength', 'minItems', 'maxItems'):
+            kind = str if keyword.endswith('Length') else list
+            bound = value
+            compare = (lambda a, b: a >= b) if keyword.startswith('min') else \
+                (lambda a, b: a <= b)
+            checks.append(lambda data, kind=kind, bound=bound, compare=compare: (
+                type(data) is not kind or compare(len(data), bound)
+            ))
+        elif keyword == 'enum':
+            options = tuple(value)
+            checks.append(lambda data, options=options: any(
+                type(data) is type(option) and data == option
+                for option in options
+            ))
+        elif keyword == 'pattern':
+            pattern = re.compile(value)
+            checks.append(lambda data, pattern=pattern: (
+                type(data) is not str or pattern.search(data) is not None
+            ))
+        else:
+            return None
+    if not checks:
+        return lambda data: True
+    return _all(checks)
+
+
+def _field_default(field):
+    """
+    Returns:
+        the output of Raw.output for a missing value, or _NO_DEFAULT if it
+            can change between calls
+    """
+    default = field.default
+    if callable(default):
+        return _NO_DEFAULT
+    return field.format(default) if default else default
+
+
+_NO_DEFAULT = object()
+# field types with a format() of one builtin call
+_SCALARS = {
+    fields.String: str,
+    fields.Integer: int,
+    fields.Float: float,
+    fields.Boolean: bool,
+}
+
+
+def _is_simple(key, field):
+    # keys that get_value looks up differently from dict.get
+    return (
+        isinstance(key, str) and '.' not in key and not hasattr(dict, key)
+        and field.attribute is None and getattr(field, 'mask', None) is None
+        and _field_default(field) is not _NO_DEFAULT
+    )
+
+
+def _scalar_list(key, field, convert, default):
+    """Formats a List of scalars as List.output does"""
+    def format_list(value, obj):
+        if any(type(item) is dict for item in value):
+            return field.output(key, obj)
+        return [default if item is None else convert(item) for item in value]
+    return format_list
+
+
+def _nested_list(field, nested_marshal):
+    """Formats a List of Nested as List.output does"""
+    container = field.container
+    if container.allow_null:
+        none = lambda: None  # noqa: E731
+    elif container.default is not None:
+        none = lambda: container.default  # noqa: E731
+    else:
+        none = lambda: marshal(None, container.nested)  # noqa: E731
+
+    def format_list(value, obj):
+        return [none() if item is None else nested_marshal(item)
+                for item in value]
+    return format_list
+
+
+_compiled_marshals = dict()
+
+
+def _is_wildcard(field):
+    # wildcards and dicts of fields change how the whole model is marshalled
+    if isinstance(field, type):
+        return issubclass(field, fields.Wildcard)
+    return isinstance(field, (fields.Wildcard, dict))
+
+
+def compile_marshal(model):
+    """
+    Compiles a flask_restx model into a function returning the same output
+    as flask_restx.marshal(data, model)
+
+    The generated function builds the output dict of a dict in one
+    expression. Data of other types, fields with an attribute, a mask or a
+    callable default, and unknown field types are left to flask_restx.
+
+    Args:
+        model (flask_restx.Model): the model, or a dict of fields
+
+    Returns:
+        function: the marshal function
+    """
+    compiled = _compiled_marshals.get(id(model))
+    if compiled is not None:
+        return compiled[1]
+    if any(_is_wildcard(field) for field in model.values()):
+        compiled = functools.partial(marshal, fields=model)
+        _compiled_marshals[id(model)] = (model, compiled)
+        return compiled
+
+    namespace = {'_marshal': marshal, '_model': model}
+    lines = [
+        'def marshal_model(obj):',
+        '    if type(obj) is not dict:',
+        '        return _marshal(obj, _model)',
+        '    get = obj.get',
+    ]
+    items = []
+    for i, (key, field) in enumerate(model.items()):
+        field = fields.Raw() if field is None else field
+        if isinstance(field, type):
+            field = field()
+        value = f'v{i}'
+        namespace[f'_f{i}'] = field
+        simple = _is_simple(key, field)
+        if simple:
+            lines.append(f'    {value} = get({key!r})')
+            namespace[f'_d{i}'] = _field_default(field)
+        kind = type(field)
+        if simple and kind in _SCALARS:
+            namespace[f'_c{i}'] = _SCALARS[kind]
+            expression = f'(_d{i} if {value} is None else _c{i}({value}))'
+        elif simple and kind is fields.Raw:
+            expression = f'(_d{i} if {value} is None else {value})'
+        elif simple and kind is fields.List and \
+                type(field.container) in _SCALARS and \
+                field.container.attribute is None and \
+                _field_default(field.container) is not _NO_DEFAULT:
+            namespace[f'_l{i}'] = _scalar_list(
+                key, field, _SCALARS[type(field.container)],
+                _field_default(field.container),
+            )
+            namespace[f'_d{i}'] = field.default
+            expression = (
+                f'(_l{i}({value}, obj) if type({value}) is list else '
+                f'_d{i} if {value} is None else _f{i}.output({key!r}, obj))'
+            )
+        elif simple and kind is fields.List and \
+                type(field.container) is fields.Nested and \
+                field.container.attribute is None and \
+                not field.container.skip_none:
+            namespace[f'_l{i}'] = _nested_list(
+                field, compile_marshal(field.container.nested)
+            )
+            namespace[f'_d{i}'] = field.default
+            expression = (
+                f'(_l{i}({value}, obj) if type({value}) is list else '
+                f'_d{i} if {value} is None else _f{i}.output({key!r}, obj))'
+            )
+        elif simple and kind is fields.Nested and not field.skip_none:
+            namespace[f'_n{i}'] = compile_marshal(field.nested)
+            if field.allow_null:
+                none = 'None'
+            elif field.default is not None:
+                namespace[f'_d{i}'] = field.default
+                none = f'_d{i}'
+            else:
+                none = f'_n{i}(None)'
+            expression = f'({none} if {value} is None else _n{i}({value}))'
+        else:
+            expression = f'_f{i}.output({key!r}, obj)'
+        items.append(f'{key!r}: {expression}')
+    lines.append('    return {' + ', '.join(items) + '}')
+    exec('\n'.join(lines), namespace)
+    compiled = namespace['marshal_model']
+    # keeps the model alive, so that its id is not reused
+    _compiled_marshals[id(model)] = (model, compiled)
+    return compiled
+
+
+class CompiledModel:
+    """
+    A flask_restx model compiled once into a validator and a marshaller
+
+    validate() gives the same answers and the same 400 errors as
+    Model.validate, which builds a new jsonschema validator on every call.
+    Data that passes the compiled predicate of compile_check is valid
+    without running jsonschema at all, the rest is checked by a jsonschema
+    validator built once.
+    """
+
+    def __init__(self, api, model):
+        self.api = api
+        self.model = model
+        schema = model.__schema__
+        self._check = compile_check(schema)
+        self._validator = None
+        if '"$ref"' not in json.dumps(schema):
+            self._validator = validator_for(schema)(
+                schema, format_checker=api.format_checker
+            )
+        self.marshal = compile_marshal(model)
+
+    def validate(self, data):
+        """
+        Raises:
+            HTTPException: a 400 with the errors of each invalid field
+        """
+        if self._check is not None and self._check(data):
+            return
+        if self._validator is None:
+            # nested models need the definitions of the api
+            self.model.validate(data, self.api.refresolver, self.api.format_checker)
+            return
+        if self._validator.is_valid(data):
+            return
+        restx_abort(
+            400, message='Input payload validation failed',
+            errors=dict(
+                self.model.format_error(e)
+                for e in self._validator.iter_errors(data)
+            ),
+        )
+
+    def load(self, data):
+        """
+        Returns:
+            dict: the validated data, marshalled to the model
+        """
+        with stage('validate'):
+            self.validate(data)
+        with stage('marshal'):
+            return self.marshal(data)
+
+
+_compiled_models = dict()
+
+
+def compile_model(api, model):
+    """
+    Returns:
+        CompiledModel: the compiled model, compiled once per api and model
+    """
+    key = (id(api), id(model))
+    compiled = _compiled_models.get(key)
+    if compiled is None:
+        compiled = _compiled_models[key] = CompiledModel(api, model)
+    return compiled
+
+
+def request_json():
+    """
+    Returns:
+        the JSON body of the current request, with the errors of
+            request.get_json()
+    """
+    if not request.is_json:
+        return request.get_json()
+    try:
+        return loads(request.get_data(cache=True))
+    except ValueError as e:
+        return request.on_json_loading_failed(e)
+
+
+def parse_payload(api, model, enabled=FAST_JSON):
+    """
+    The body of the current request validated against a model and
+    marshalled to it, as RESTX_VALIDATE and api.marshal(api.payload, model)
+
+    Returns:
+        dict: the payload
+    """
+    if not enabled:
+        with stage('marshal'):
+            return api.marshal(api.payload, model)
+    return compile_model(api, model).load(request_json())
+
+
+def marshal_with(api, model, enabled=FAST_JSON):
+    """
+    Decorates a resource method as api.marshal_with(model), marshalling its
+    response with the compiled model and encoding it with dumps
+
+    The response model is documented by api.marshal_with, which also
+    serves the requests that send a mask (the X-Fields header).
+    """
+    def decorator(method):
+        documented = api.marshal_with(model)(method)
+        if not enabled:
+            return documented
+        marshal_model = compile_marshal(model)
+
+        @functools.wraps(documented)
+        def wrapper(*args, **kwargs):
+            if request.headers.get(current_app.config['RESTX_MASK_HEADER']):
+                return documented(*args, **kwargs)
+            response = method(*args, **kwargs)
+            if isinstance(response, Response):
+                return response
+            data, code, headers = unpack(response)
+            return Response(
+                dumps(marshal_model(data)), code, headers,
+                mimetype='application/json',
+            )
+        return wrapper
+    return decorator
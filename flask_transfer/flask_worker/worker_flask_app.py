@@ -1,24 +1,35 @@
-from flask import Flask
+from flask import Flask, Response, abort, request
 from flask_restx import Api, Resource
 from elasticapm.contrib.flask import ElasticAPM
 import pyfiglet
+import hmac
 import os
-import requests
-from datetime import datetime
-import hashlib
+import time
 
 from . import worker_classes_api
 from . import worker_entities_api
 from . import worker_similarities_api
 from . import worker_services_api
 from . import worker_logic
+from . import worker_timing
+from .worker_fastjson import FAST_JSON, compile_model, marshal_with, parse_payload
 from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+from .worker_profiler import SampledProfiler
+from .worker_registration import RegistrationAgent
+from .worker_reload import MODEL_RELOAD_WAIT_TIMEOUT
+from .worker_stream import STREAM_BATCH_SIZE
 
 logger = create_logger(__name__)
 
 # options: classes, entities, similarities
-WORKER_ROUTE = 'classes'
+WORKER_ROUTE = os.getenv('WORKER_ROUTE') or 'classes'
 URL = os.getenv('WORKER_URL') or 'http://<worker_ip>:5001'
+REGISTER_WITH_GATEWAY = \
+    (os.getenv('REGISTER_WITH_GATEWAY') or 'true').lower() in ('1', 'true')
+# set by worker_prefork: models are loaded in this (master) process, and
+# background threads are left to the forked worker processes
+PREFORK = (os.getenv('WORKER_PREFORK') or 'false').lower() in ('1', 'true')
 # TITLE CARD
 title = f"{WORKER_ROUTE.title()} Worker API"
 version = "1.0"
@@ -33,25 +44,34 @@ app = Flask(__name__)
 ElasticAPM(app)
 
 # environment variable to determine whether to include mock workers
-adminkey = os.getenv('ADMINKEY') or '<admin-key>'
+ADMINKEY = os.getenv('ADMINKEY')
+adminkey = ADMINKEY or '<admin-key>'
 gateway_url = os.getenv('GATEWAY_URL') or 'http://<gateway_ip>:5000/worker'
 
 # create worker instance
-worker = worker_logic.Worker(url=URL, route=WORKER_ROUTE)
-
-try:
-    # submit put to gateway to make service available
-    worker_put_request = worker.worker_put_request()
-    headers = {'adminkey': adminkey}
-    response = requests.put(url=gateway_url, json=worker_put_request, headers=headers)
-    response.raise_for_status()
-    logger.info(f'Successfully connected to gateway at: {gateway_url}')
-except Exception:
+worker = worker_logic.Worker(
+    url=URL, route=WORKER_ROUTE,
+    preload_async=not PREFORK, start_background=not PREFORK,
+)
+
+# register with the gateway in the background, retrying until it answers,
+# then heartbeat the current models and load
+registration = RegistrationAgent(gateway_url, adminkey, worker.worker_put_request)
+worker.on_models_changed.append(registration.announce)
+if not REGISTER_WITH_GATEWAY:
     logger.info('Not connecting to gateway')
+elif not PREFORK:
+    registration.start()
+
+
+def post_fork():
+    """Called in each pre-forked worker process before it serves requests"""
+    worker.after_fork()
 
 # Expand the Swagger UI when it is loaded: list or full
 app.config['SWAGGER_UI_DOC_EXPANSION'] = 'list'
-# Globally enable validating
+# Globally enable validating, the model routes validate with compiled
+# models instead when FAST_JSON is on
 app.config['RESTX_VALIDATE'] = True
 # Enable or disable the mask field, by default X-Fields
 app.config['RESTX_MASK_SWAGGER'] = False
@@ -60,18 +80,46 @@ app.config['ERROR_404_HELP'] = False
 
 api = Api(app, version=version, title=title, description=str(description),)
 
+# samples requests under cProfile once enabled on /profiling/start
+profiler = SampledProfiler()
+
+
+@app.before_request
+def start_timing():
+    worker_timing.start()
+
+
+@app.after_request
+def add_server_timing(response):
+    return worker_timing.finish(response)
+
 # routes
 models_ns = api.namespace("models", description="Data Science Models")
 
+batch_request_body = None
+batch_post_response = None
 if WORKER_ROUTE == 'classes':
     request_body = worker_classes_api.get_classes_body(api)
     post_response = worker_classes_api.get_classes_post_response(api)
+    batch_request_body = worker_classes_api.get_classes_batch_body(
+        api, max_texts=worker_logic.MAX_BATCH_TEXTS,
+        max_n_process=worker_logic.MAX_N_PROCESS,
+    )
+    batch_post_response = worker_classes_api.get_classes_batch_post_response(api)
 elif WORKER_ROUTE == 'entities':
     request_body = worker_entities_api.get_entities_body(api)
     post_response = worker_entities_api.get_entities_post_response(api)
+    batch_request_body = worker_entities_api.get_entities_batch_body(
+        api, max_texts=worker_logic.MAX_BATCH_TEXTS,
+        max_n_process=worker_logic.MAX_N_PROCESS,
+    )
+    batch_post_response = worker_entities_api.get_entities_batch_post_response(api)
 elif WORKER_ROUTE == 'similarities':
     request_body = worker_similarities_api.get_similarities_body(api)
     post_response = worker_similarities_api.get_similarities_post_response(api)
+    search_request_body = worker_similarities_api.get_similarities_search_body(api)
+    search_post_response = worker_similarities_api.get_similarities_search_response(api)
+    references_put_body = worker_similarities_api.get_similarities_references_body(api)
 else:
     raise ValueError(f'Invalid WORKER_ROUTE value: {WORKER_ROUTE}')
 
@@ -79,40 +127,186 @@ else:
 services_put_body = worker_services_api.get_services_put_body(api)
 
 
+def require_admin():
+    """
+    Aborts with a 401 unless the request carries the admin key, and with a
+    404 if no ADMINKEY is set, as the default key is public
+    """
+    if not ADMINKEY:
+        abort(404)
+    key = request.headers.get('adminkey') or ''
+    if not hmac.compare_digest(key.encode(), ADMINKEY.encode()):
+        abort(401, 'Invalid admin key')
+
+
+def require_single_process():
+    """
+    Aborts with a 409 under the pre-fork server, where a change of the
+    worker state would only reach the process that answers the request
+    """
+    if PREFORK:
+        abort(409, 'Not available with the pre-fork server, restart it '
+                   'to apply the change to every worker process')
+
+
 @models_ns.route("/")
 class Models(Resource):
     """GET a list of all models, and POST to get model handling"""
-    @api.expect(request_body)
-    @api.marshal_with(post_response)
+    @api.expect(request_body, validate=not FAST_JSON)
+    @marshal_with(api, post_response)
     @api.response(404, 'No such model')
+    @api.response(503, 'Model is loading or failed to load')
+    @worker_timing.timed_handler
+    @profiler.profiled
     def post(self):
         """Request model output handling for something"""
 
-        request_in_time = datetime.now()
+        # the worker logs one structured record per request
+        payload = parse_payload(api, request_body)
+        return worker.handle_request(payload)
+
+    @api.marshal_with(services_put_body)
+    def get(self):
+        """Get list of available models for this worker"""
 
-        payload = api.marshal(api.payload, request_body)
-        response = worker.handle_request(payload)
+        request_in_time = time.perf_counter()
 
-        logger.info(f"POST text hash: {hashlib.sha256(response['text'].encode()).hexdigest()}")
-        logger.info(f'POST REQUEST t: {request_in_time}, en: {datetime.now()}, '\
-             f'dur: {(datetime.now() - request_in_time).total_seconds()*1000}ms')
-        logger.info(f'POST Classes detected: {response["classes"]}')
+        response = worker.worker_put_request()
 
+        logger.info(f'GET REQUEST '\
+             f'dur: {(time.perf_counter() - request_in_time)*1000:.3f}ms')
 
         return response
 
-    @api.marshal_with(services_put_body)
+
+@models_ns.route("/reload")
+class ModelsReload(Resource):
+    """POST to reload loaded models without downtime, GET the reload states"""
+    @api.doc(params={
+        'model': 'The model to reload, by default every loaded model '
+                 'that has a new published version',
+        'wait': 'true answers once the reloads are done, or after '
+                'MODEL_RELOAD_WAIT_TIMEOUT seconds, with their states',
+    })
+    @api.response(200, 'Reloads done')
+    @api.response(202, 'Reloads started, or not done when the wait ended')
+    @api.response(401, 'Invalid admin key')
+    @api.response(404, 'Model is not loaded')
+    @api.response(409, 'Not available with the pre-fork server')
+    def post(self):
+        """Reload models in the background and swap them in (admin only)"""
+        require_admin()
+        require_single_process()
+        model_name = request.args.get('model')
+        if model_name:
+            if model_name not in worker.model_mapping:
+                abort(404, f'Model {model_name} is not loaded')
+            worker.reloader.reload(model_name)
+            model_names = [model_name]
+        else:
+            model_names = worker.check_versions()
+        if (request.args.get('wait') or 'false').lower() in ('1', 'true'):
+            worker.reloader.wait(model_names, MODEL_RELOAD_WAIT_TIMEOUT)
+            status = worker.reloader.status()
+            status = {name: status[name] for name in model_names}
+            done = all(s['state'] != 'reloading' for s in status.values())
+            return status, 200 if done else 202
+        return {'reloading': model_names}, 202
+
+    @api.response(401, 'Invalid admin key')
     def get(self):
-        """Get list of available models for this worker"""
+        """The state of the last reload of each model (admin only)"""
+        require_admin()
+        return worker.reloader.status(), 200
 
-        request_in_time = datetime.now()
 
-        response = worker.worker_put_request()
+def parse_stream_line(document):
+    """Validates one line of a stream as the body of a POST to /models/"""
+    if FAST_JSON:
+        compiled = compile_model(api, request_body)
+        compiled.validate(document)
+        return compiled.marshal(document)
+    request_body.validate(document, format_checker=api.format_checker)
+    return api.marshal(document, request_body)
 
-        logger.info(f'GET REQUEST st: {request_in_time}, en: {datetime.now()}, '\
-             f'dur: {(datetime.now() - request_in_time).total_seconds()*1000}ms')
 
-        return response
+if batch_request_body is not None:
+    @models_ns.route("/batch")
+    class ModelsBatch(Resource):
+        """POST many texts to get model handling in one request"""
+        @api.expect(batch_request_body, validate=not FAST_JSON)
+        @marshal_with(api, batch_post_response)
+        @api.response(400, 'Invalid body, e.g. too many texts')
+        @api.response(404, 'No such model')
+        @api.response(503, 'Model is loading or failed to load')
+        @worker_timing.timed_handler
+        @profiler.profiled
+        def post(self):
+            """Request model output handling for a batch of texts"""
+            payload = parse_payload(api, batch_request_body)
+            return worker.handle_batch_request(payload)
+
+    @models_ns.route("/stream")
+    class ModelsStream(Resource):
+        """POST newline-delimited JSON requests, results are streamed back"""
+        @api.doc(params={'batch_size': 'Lines passed to the models at once'})
+        @api.response(200, 'One NDJSON line per input line, in input order')
+        @api.response(400, 'Invalid batch_size')
+        @api.response(429, 'Too many requests waiting')
+        @api.response(503, 'No request slot freed in time')
+        def post(self):
+            """
+            Request model output handling for a stream of texts
+
+            Each line of the application/x-ndjson body is a /models/
+            request body, with an optional id returned with its result.
+            Lines that fail get an {"line", "error": {"code", "message"}}
+            line instead.
+            """
+            try:
+                batch_size = int(
+                    request.args.get('batch_size') or STREAM_BATCH_SIZE
+                )
+            except ValueError:
+                abort(400, 'batch_size must be an integer')
+            if batch_size < 1:
+                abort(400, 'batch_size must be positive')
+            return Response(
+                worker.handle_stream(
+                    request.stream, parse_stream_line, batch_size
+                ),
+                mimetype='application/x-ndjson',
+            )
+
+
+if WORKER_ROUTE == 'similarities':
+    @models_ns.route("/search")
+    class ModelsSearch(Resource):
+        """POST one text to score it against the reference texts of models"""
+        @api.expect(search_request_body, validate=not FAST_JSON)
+        @marshal_with(api, search_post_response)
+        @api.response(404, 'No such model or no reference texts')
+        @api.response(503, 'Model is loading or failed to load')
+        @worker_timing.timed_handler
+        @profiler.profiled
+        def post(self):
+            """Request the reference texts most similar to a text"""
+            payload = parse_payload(api, search_request_body)
+            return worker.handle_search_request(payload)
+
+    @models_ns.route("/references")
+    class ModelsReferences(Resource):
+        """PUT the reference texts searched for a model"""
+        @api.expect(references_put_body)
+        @api.response(401, 'Invalid admin key')
+        @api.response(409, 'Not available with the pre-fork server')
+        def put(self):
+            """Replace the reference texts of a model (admin only)"""
+            require_admin()
+            require_single_process()
+            payload = api.marshal(api.payload, references_put_body)
+            worker.set_references(payload['type'], payload['texts'])
+            return {'type': payload['type'], 'texts': len(payload['texts'])}, 200
 
 
 @app.route('/health', methods=['GET'])
@@ -120,5 +314,95 @@ def health():
     return 'Service Up', 200
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check, 503 until the preloaded models are warmed up"""
+    status = {
+        'ready': worker.ready.is_set(),
+        'loaded': worker.model_mapping.names(),
+        'failed': worker.preload_failed,
+    }
+    return status, 200 if status['ready'] else 503
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Current values of the worker metrics, e.g. micro-batch queue depth"""
+    return REGISTRY.snapshot(), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """The worker metrics in the Prometheus text format"""
+    return Response(
+        REGISTRY.exposition(), mimetype='text/plain; version=0.0.4'
+    )
+
+
+@app.route('/catalog/invalidate', methods=['POST'])
+def invalidate_catalog():
+    """Forget cached model lookups, optionally for a single ?model=<name>"""
+    require_admin()
+    require_single_process()
+    worker.catalog.invalidate(request.args.get('model'))
+    return 'Catalog invalidated', 200
+
+
+@app.route('/profiling/start', methods=['POST'])
+def start_profiling():
+    """
+    Profiles a share of the model requests, ?sample_rate=<0-1> (default
+    0.01), and ?reset=true drops the stats aggregated so far
+    """
+    require_admin()
+    require_single_process()
+    try:
+        sample_rate = float(request.args.get('sample_rate') or 0.01)
+    except ValueError:
+        abort(400, 'sample_rate must be a number')
+    if not 0 <= sample_rate <= 1:
+        abort(400, 'sample_rate must be between 0 and 1')
+    reset = (request.args.get('reset') or 'false').lower() in ('1', 'true')
+    profiler.start(sample_rate, reset=reset)
+    return profiler.status(), 200
+
+
+@app.route('/profiling/stop', methods=['POST'])
+def stop_profiling():
+    """Stops profiling, the aggregated stats can still be downloaded"""
+    require_admin()
+    require_single_process()
+    profiler.stop()
+    return profiler.status(), 200
+
+
+@app.route('/profiling/profile', methods=['GET'])
+def download_profile():
+    """
+    The aggregated profile as a pstats file, or with ?format=text the top
+    ?limit=<n> functions sorted by ?sort=<key> (default cumulative)
+    """
+    require_admin()
+    if request.args.get('format') == 'text':
+        try:
+            text = profiler.text(
+                sort=request.args.get('sort') or 'cumulative',
+                limit=int(request.args.get('limit') or 50),
+            )
+        except (KeyError, ValueError) as e:
+            abort(400, f'Invalid sort or limit: {str(e)}')
+        if text is None:
+            abort(404, 'No profiled requests')
+        return Response(text, mimetype='text/plain')
+    data = profiler.dump()
+    if data is None:
+        abort(404, 'No profiled requests')
+    return Response(
+        data, mimetype='application/octet-stream',
+        headers={'Content-Disposition':
+                 f'attachment; filename={WORKER_ROUTE}-worker.prof'},
+    )
+
+
 if __name__ == "__main__":
     app.run(debug=True)
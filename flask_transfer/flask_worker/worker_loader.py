@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from .worker_admission import ADMISSION_MAX_LOADS, AdmissionError, Limiter
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# seconds a request waits for a load started by another request,
+# 0 answers with a 503 straight away
+MODEL_LOAD_WAIT_TIMEOUT = float(os.getenv('MODEL_LOAD_WAIT_TIMEOUT') or 30)
+# seconds a failed load is remembered before the model is tried again
+MODEL_LOAD_FAILURE_TTL = float(os.getenv('MODEL_LOAD_FAILURE_TTL') or 30)
+# Retry-After sent to requests that gave up waiting for a load
+MODEL_LOAD_RETRY_AFTER = int(os.getenv('MODEL_LOAD_RETRY_AFTER') or 5)
+
+loads_in_flight = REGISTRY.gauge(
+    'worker_model_loads_in_flight',
+    'Models currently being loaded',
+)
+load_failures = REGISTRY.counter(
+    'worker_model_load_failures_total',
+    'Failed model loads',
+    ['model'],
+)
+load_seconds = REGISTRY.histogram(
+    'worker_model_load_seconds',
+    'Time to download and load a model',
+    ['model'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+load_waits = REGISTRY.counter(
+    'worker_model_load_waits_total',
+    'Requests that waited on a load started by another request',
+    ['model'],
+)
+
+
+class ModelLoadError(Exception):
+    """
+    A model could not be loaded
+
+    Attributes:
+        retry_after (int): seconds until the load may be tried again
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelLoader:
+    """
+    Runs at most one load per model at a time
+
+    The first caller for a model runs `load_fn(model_name)`. Concurrent
+    callers for the same model wait up to `wait_timeout` seconds for that
+    load instead of starting their own. A failed load is remembered for
+    `failure_ttl` seconds, during which callers fail fast without retrying.
+    At most `max_loads` models load at once, as each needs the memory of a
+    whole model while it loads, and further loads wait up to `wait_timeout`
+    seconds for their turn.
+    """
+
+    def __init__(self, load_fn, wait_timeout=MODEL_LOAD_WAIT_TIMEOUT,
+                 failure_ttl=MODEL_LOAD_FAILURE_TTL,
+                 retry_after=MODEL_LOAD_RETRY_AFTER,
+                 max_loads=ADMISSION_MAX_LOADS):
+        self.load_fn = load_fn
+        self.wait_timeout = wait_timeout
+        self.failure_ttl = failure_ttl
+        self.retry_after = retry_after
+        self.limiter = Limiter(
+            'loads', max_loads, timeout=wait_timeout, retry_after=retry_after
+        )
+        self._in_flight = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def load(self, model_name, deadline=None):
+        """
+        Loads a model, or waits for the load already in flight
+
+        Args:
+            model_name (str): the model to load
+            deadline (float): time.monotonic() after which to stop waiting
+                for a load slot, `wait_timeout` from now if None
+
+        Raises:
+            ModelLoadError: the load failed recently, failed now, or did not
+                finish within `wait_timeout`, or too many models are loading
+
+        Returns:
+            the value returned by `load_fn`
+        """
+        with self._lock:
+            failure = self._failures.get(model_name)
+            if failure is not None:
+                expires, message = failure
+                remaining = expires - time.monotonic()
+                if remaining > 0:
+                    raise ModelLoadError(message, int(remaining) + 1)
+                del self._failures[model_name]
+
+            future = self._in_flight.get(model_name)
+            owner = future is None
+            if owner:
+                future = self._in_flight[model_name] = Future()
+
+        if not owner:
+            return self._wait(model_name, future)
+
+        try:
+            self.limiter.acquire(deadline)
+        except AdmissionError as e:
+            # busy, not failed: the next request tries again
+            error = ModelLoadError(
+                f'Model {model_name} is waiting for other models to load',
+                e.retry_after,
+            )
+            with self._lock:
+                del self._in_flight[model_name]
+            future.set_exception(error)
+            raise error
+        loads_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            result = self.load_fn(model_name)
+        except Exception as e:
+            message = f'Unable to load model {model_name}: {str(e)}'
+            logger.error(message)
+            load_failures.inc(model=model_name)
+            error = ModelLoadError(message, int(self.failure_ttl) + 1)
+            with self._lock:
+                self._failures[model_name] = (
+                    time.monotonic() + self.failure_ttl, message
+                )
+                del self._in_flight[model_name]
+            future.set_exception(error)
+            raise error
+        finally:
+            loads_in_flight.dec()
+            self.limiter.release()
+        load_seconds.observe(time.perf_counter() - start, model=model_name)
+
+        with self._lock:
+            del self._in_flight[model_name]
+        future.set_result(result)
+        return result
+
+    def _wait(self, model_name, future):
+        load_waits.inc(model=model_name)
+        try:
+            return future.result(timeout=self.wait_timeout or 0)
+        except TimeoutError:
+            raise ModelLoadError(
+                f'Model {model_name} is loading', self.retry_after
+            )
+
+    def loading(self):
+        """
+        Returns:
+            list: names of the models currently being loaded
+        """
+        with self._lock:
+            return list(self._in_flight)
+
+    def forget_failure(self, model_name):
+        """Allows a failed model to be loaded again straight away"""
+        with self._lock:
+            self._failures.pop(model_name, None)
@@ -1,7 +1,33 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import random
+
+from .worker_metrics import REGISTRY
+
+LOG_FILE = os.getenv('LOG_FILE') or 'worker.log'
+# the log file is rotated at this size, keeping LOG_BACKUP_COUNT old files
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES') or 50 * 1024 * 1024)
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT') or 5)
+# write records from a background thread instead of the request thread
+LOG_ASYNC = (os.getenv('LOG_ASYNC') or 'true').lower() in ('1', 'true')
+# records waiting for the background thread, newer records are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE') or 10000)
+# share of request records that include the full model results
+LOG_RESULTS_SAMPLE_RATE = float(os.getenv('LOG_RESULTS_SAMPLE_RATE') or 0.01)
+
+log_records_dropped = REGISTRY.counter(
+    'worker_log_records_dropped_total',
+    'Log records dropped because the log queue was full',
+)
 
 # create file handler which logs even debug messages
-file_handler = logging.FileHandler('worker.log')
+file_handler = logging.handlers.RotatingFileHandler(
+    LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+)
 file_handler.setLevel(logging.DEBUG)
 
 # create console handler with a higher log level
@@ -15,12 +41,114 @@ file_handler.setFormatter(formatter)
 channel_handler.setFormatter(formatter)
 
 
+def process_log_file(pid):
+    """
+    Returns:
+        str: LOG_FILE with the process id before its extension, e.g.
+            worker.1234.log
+    """
+    root, ext = os.path.splitext(LOG_FILE)
+    return f'{root}.{pid}{ext}'
+
+
+def reopen_log_file():
+    """
+    Points the file handler of a forked child at a file of its own
+
+    Rotating one file from several processes loses records and rotates it
+    once per process, so pre-forked workers each write their own file.
+    """
+    file_handler.close()
+    file_handler.baseFilename = os.path.abspath(process_log_file(os.getpid()))
+
+
+os.register_at_fork(after_in_child=reopen_log_file)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener, dropping them when the queue is full"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+queue_handler = None
+queue_listener = None
+
+
+def start_listener():
+    """
+    Starts the thread writing the queued records to the file and console
+
+    Also called in the child after a fork, where the parent's listener
+    thread does not exist and its queue may have been left locked.
+    """
+    global queue_listener
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_listener = logging.handlers.QueueListener(
+        queue_handler.queue, file_handler, channel_handler,
+        respect_handler_level=True,
+    )
+    queue_listener.start()
+
+
+def stop_listener():
+    """Writes the queued records and stops the listener thread"""
+    if queue_listener is not None and queue_listener._thread is not None:
+        queue_listener.stop()
+
+
+if LOG_ASYNC:
+    queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    start_listener()
+    os.register_at_fork(after_in_child=start_listener)
+    atexit.register(stop_listener)
+    handlers = (queue_handler,)
+else:
+    handlers = (file_handler, channel_handler)
+
+
 def create_logger(logger_name, logger_level=logging.DEBUG):
     logger = logging.getLogger(logger_name)
     logger.setLevel(logger_level)
 
-    # add the handlers to the logger
-    logger.addHandler(file_handler)
-    logger.addHandler(channel_handler)
+    # add the handlers to the logger, once however often it is created
+    for handler in handlers:
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
 
     return logger
+
+
+request_logger = create_logger('worker.requests')
+
+
+def sample_results():
+    """
+    Returns:
+        bool: whether the next request record should include its results
+    """
+    return LOG_RESULTS_SAMPLE_RATE > 0 and \
+        random.random() < LOG_RESULTS_SAMPLE_RATE
+
+
+def log_request(kind, duration_ms, results=None, **fields):
+    """
+    Logs one structured line per request
+
+    Args:
+        kind (str): the kind of request, e.g. classes or batch
+        duration_ms (float): the time spent handling the request
+        results (callable): returns the results to log, only called for a
+            sample of LOG_RESULTS_SAMPLE_RATE of the requests
+        **fields: other JSON serialisable fields, e.g. models and text digest
+    """
+    if not request_logger.isEnabledFor(logging.INFO):
+        return
+    record = {'kind': kind, 'duration_ms': round(duration_ms, 3), **fields}
+    if results is not None and sample_results():
+        record['results'] = results()
+    request_logger.info(json.dumps(record, default=str))
@@ -1,42 +1,225 @@
 import os
 import json
 from flask import abort
+from werkzeug.exceptions import HTTPException
 import sys 
-from datetime import datetime
-import hashlib
+import functools
+import gc
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import scripts.utils as s3_utils
-from .worker_logger import create_logger
+from .worker_admission import Admission, AdmissionError
+from .worker_artifacts import (
+    ARTIFACT_STORE, ArtifactStore, artifact_revision,
+)
+from .worker_batching import MICRO_BATCHING, MicroBatcher
+from .worker_catalog import ModelCatalog
+from .worker_chunking import CHUNK_THRESHOLD_CHARS, TextChunker
+from .worker_fanout import FANOUT, FanOut
+from .worker_loader import ModelLoader, ModelLoadError
+from .worker_logger import create_logger, log_request
+from .worker_metrics import LATENCY_BUCKETS, REGISTRY
+from .worker_model_cache import ModelCache, estimate_model_size
+from .worker_reload import MODEL_AUTO_RELOAD, ModelReloader
+from .worker_result_cache import ResultCache, text_digest
+from .worker_similarities import (
+    EMBEDDING_CACHE_SIZE, DEFAULT_TOP_K, ReferenceIndex, format_vector,
+    pair_scores, read_reference_texts, stack_vectors,
+)
+from .worker_snapshot import prune_pipeline
+from .worker_stream import (
+    STREAM_BATCH_SIZE, ClosingIterator, batched, encode_lines, error_line, http_error_line,
+    in_thread, parse_lines, read_lines, stream_lines,
+)
+from .worker_timing import stage
 
 CURRENT_FILE_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_LOCAL_MODEL_DIR = os.path.join(CURRENT_FILE_PATH, 'models', '')
+# defaults for batch requests, see nlp.pipe
+DEFAULT_BATCH_SIZE = int(os.getenv('BATCH_SIZE') or 64)
+DEFAULT_N_PROCESS = int(os.getenv('N_PROCESS') or 1)
+# the most processes a batch request may ask for, each is a fork of the worker
+MAX_N_PROCESS = int(os.getenv('MAX_N_PROCESS') or 1)
+MAX_BATCH_TEXTS = int(os.getenv('MAX_BATCH_TEXTS') or 10000)
+# comma separated models loaded and warmed up at startup
+PRELOAD_MODELS = [
+    m.strip() for m in (os.getenv('PRELOAD_MODELS') or '').split(',')
+    if m.strip()
+]
+PRELOAD_WORKERS = int(os.getenv('PRELOAD_WORKERS') or 4)
+WARMUP_ITERATIONS = int(os.getenv('WARMUP_ITERATIONS') or 3)
+# remove the components the route does not use from loaded pipelines, as
+# snapshots are when they are made, see worker_snapshot.prune_pipeline
+PRUNE_PIPELINE = \
+    (os.getenv('PRUNE_PIPELINE') or 'false').lower() in ('1', 'true')
+# spans group read by format_entities when the pipeline has a spancat
+SPANS_KEY = os.getenv('SPANS_KEY') or 'sc'
+WARMUP_TEXTS = [
+    'Warm up',
+    'A slightly longer sentence used to warm up the model before serving.',
+]
 
 logger = create_logger(__name__)
 
+requests_in_flight = REGISTRY.gauge(
+    'worker_requests_in_flight',
+    'Requests currently being handled',
+)
+request_seconds = REGISTRY.histogram(
+    'worker_request_seconds',
+    'Time to handle a request, from validated payload to response',
+    ['handler'],
+    buckets=LATENCY_BUCKETS,
+)
+inference_seconds = REGISTRY.histogram(
+    'worker_inference_seconds',
+    'Time spent running a model: single texts, nlp.pipe batches, or '
+    'concurrent fan-out over several models',
+    ['model', 'mode'],
+    buckets=LATENCY_BUCKETS,
+)
+request_batch_texts = REGISTRY.histogram(
+    'worker_request_batch_texts',
+    'Texts per batch request',
+    buckets=tuple(2 ** i for i in range(15)),
+)
 
 
 
-def model_formatter(nlp):
+
+def format_cat_scores(cats):
+    """
+    Args:
+        cats (dict): the score of each class, e.g. Doc.cats
+
+    Returns:
+        list: a {'value', 'score'} dict per class
+    """
+    return [{'value': v, 'score': s} for (v, s) in cats.items()]
+
+
+def format_cats(doc):
+    """
+    Formats the TextCat output of a processed Doc
+
+    Args:
+        doc (SpaCy Doc): a Doc processed by a TextCat pipeline
+
+    Returns:
+        list: a {'value', 'score'} dict per class
+    """
+    return format_cat_scores(doc.cats)
+
+
+def format_entities(doc):
+    """
+    Formats the entities of a processed Doc
+
+    Spans of a spancat (doc.spans[SPANS_KEY]) carry the spancat scores.
+    Otherwise doc.ents is used, and as the NER does not score its entities
+    each of them gets a score of 1.
+
+    Args:
+        doc (SpaCy Doc): a Doc processed by a NER or spancat pipeline
+
+    Returns:
+        list: a {'value', 'score', 'start_char', 'end_char'} dict per entity
+    """
+    group = doc.spans.get(SPANS_KEY)
+    scores = group.attrs.get('scores') if group is not None else None
+    if scores is not None:
+        return [
+            {
+                'value': span.text,
+                'score': float(score),
+                'start_char': span.start_char,
+                'end_char': span.end_char,
+            }
+            for span, score in zip(group, scores)
+        ]
+    return [
+        {
+            'value': ent.text,
+            'score': 1.0,
+            'start_char': ent.start_char,
+            'end_char': ent.end_char,
+        }
+        for ent in doc.ents
+    ]
+
+
+# formats a processed Doc for each worker route
+ROUTE_FORMATTERS = {
+    'classes': format_cats,
+    'entities': format_entities,
+    'similarities': format_vector,
+}
+
+
+def model_formatter(nlp, format_doc=format_cats, chunker=None):
     """
     Formats SpaCy TextCat output to Gateway Classifier Format
 
     Args:
         nlp (SpaCy Pipeline): Must hace a trained TextCat in the pipeline
+        format_doc (callable): formats a processed Doc, e.g. format_entities
+        chunker (TextChunker): classifies long texts in chunks, if set
 
     Returns (callable): function that returns formatted textcat output
     """
     def get_results(text):
-        doc = nlp(text)
-        results = [{'value': v, 'score': s} for (v, s) in doc.cats.items()]
-        return results
+        if chunker is not None and chunker.applies(text):
+            return format_cat_scores(chunker.cats(text))
+        return format_doc(nlp(text))
     return get_results
 
 
+def batch_model_formatter(nlp, format_doc=format_cats, chunker=None):
+    """
+    Formats SpaCy TextCat output to Gateway Classifier Format for many texts
+
+    Docs are formatted as nlp.pipe yields them, so only the formatted output
+    of the batch is held in memory, not the Docs.
+
+    Args:
+        nlp (SpaCy Pipeline): Must hace a trained TextCat in the pipeline
+        format_doc (callable): formats a processed Doc, e.g. format_entities
+        chunker (TextChunker): classifies long texts in chunks, if set
+
+    Returns (callable): function that returns formatted textcat output for
+        each text, in input order
+    """
+    def get_batch_results(texts, batch_size=DEFAULT_BATCH_SIZE,
+                          n_process=DEFAULT_N_PROCESS):
+        long_texts = set()
+        if chunker is not None:
+            long_texts = {i for i, text in enumerate(texts) if chunker.applies(text)}
+        if not long_texts:
+            docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+            return [format_doc(doc) for doc in docs]
+        # long texts are piped as chunks, the others together
+        short = [i for i in range(len(texts)) if i not in long_texts]
+        results = [None] * len(texts)
+        docs = nlp.pipe(
+            [texts[i] for i in short], batch_size=batch_size,
+            n_process=n_process,
+        )
+        for i, doc in zip(short, docs):
+            results[i] = format_doc(doc)
+        for i in sorted(long_texts):
+            results[i] = format_cat_scores(chunker.cats(texts[i]))
+        return results
+    return get_batch_results
+
+
 def filter_min_confidence(results, min_confidence=0.1):
     try:
         return list(filter(lambda i: i['score'] > min_confidence, results))
     except Exception:
-        results
+        return results
 
 
 def filter_max_classes(results, max_classes=3):
@@ -47,19 +230,266 @@ def filter_max_classes(results, max_classes=3):
     return results
 
 
+def filter_results(results, min_confidence, max_classes):
+    """
+    Sorts model output by score and applies the request filters
+
+    Args:
+        results (list): formatted model output
+        min_confidence (float): scores at or below this value are dropped
+        max_classes (int): maximum number of classes to keep
+
+    Returns:
+        list: the filtered results, highest score first
+    """
+    results = sorted(results, key=lambda i: i['score'], reverse=True)
+    results = filter_min_confidence(results, min_confidence)
+    results = filter_max_classes(results, max_classes)
+    return results
+
+
+def filter_entities(results, min_confidence=0, min_length=1):
+    """
+    Applies the entities request filters in a single pass
+
+    Args:
+        results (list): formatted entities, in text order
+        min_confidence (float): scores below this value are dropped
+        min_length (int): entities with fewer characters are dropped
+
+    Returns:
+        list: the entities that pass both filters, in text order
+    """
+    min_confidence = min_confidence or 0
+    min_length = min_length or 0
+    return [
+        entity for entity in results
+        if entity['score'] >= min_confidence
+        and entity['end_char'] - entity['start_char'] >= min_length
+    ]
+
+
+def track_request(handler):
+    """
+    Counts the calls of a request handler that have not returned yet, and
+    times every call
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            request_seconds.observe(
+                time.perf_counter() - start, handler=handler.__name__
+            )
+            requests_in_flight.dec()
+    return wrapper
+
+
+def admit(acquire, *args):
+    """
+    Calls an acquire method of worker_admission in the queue stage of the
+    request, aborting with its 429 or 503
+    """
+    try:
+        with stage('queue'):
+            return acquire(*args)
+    except AdmissionError as e:
+        abort(e.code, str(e), retry_after=e.retry_after)
+
+
+def admitted(handler):
+    """
+    Decorates a Worker request handler, called with (request, models), to
+    pass the admission limits, see worker_admission.Admission
+
+    The request slot is held while the models are loaded, unless they are
+    passed in, and the slots of the models while the handler runs. A caller
+    that already holds both, in this order, passes `admitted=True`, as the
+    ASGI app does so that no inference thread waits for a slot.
+    """
+    @functools.wraps(handler)
+    def wrapper(self, request, models=None, admitted=False):
+        if admitted:
+            with self.reloader.in_use(models.values()):
+                return handler(self, request, models)
+        admit(self.admission.requests.acquire)
+        try:
+            if models is None:
+                models = self.get_models(request[self.model_field])
+            slots = admit(self.admission.acquire_models, models)
+            try:
+                # a reloaded model is released once its requests are done
+                with self.reloader.in_use(models.values()):
+                    return handler(self, request, models)
+            finally:
+                self.admission.release_models(slots)
+        finally:
+            self.admission.requests.release()
+    return wrapper
+
+
+def timed_model(model_name, mode, model):
+    """
+    Wraps a model function to observe its duration in inference_seconds
+
+    Args:
+        model_name (str): the model name
+        mode (str): single or batch
+        model (function): model_formatter or batch_model_formatter output
+
+    Returns:
+        function: the model function, timed
+    """
+    @functools.wraps(model)
+    def timed(*args, **kwargs):
+        with inference_seconds.time(model=model_name, mode=mode):
+            return model(*args, **kwargs)
+    return timed
+
+
+def model_version(nlp, revision=None):
+    """
+    Args:
+        nlp (SpaCy Pipeline): the loaded pipeline
+        revision (str): the revision of the published artifact, if known,
+            see worker_artifacts.artifact_revision
+
+    Returns:
+        str: the version from the pipeline meta, 'unknown' if it has none,
+            followed by +<revision>, so that two artifacts of one pipeline
+            version are told apart
+    """
+    try:
+        version = str(nlp.meta.get('version') or 'unknown')
+    except Exception:
+        version = 'unknown'
+    if revision:
+        version = f'{version}+{revision}'
+    return version
+
+
 class Worker:
 
-    def __init__(self, url, route, model_mapping={}):
+    def __init__(self, url, route, model_mapping=None, preload_async=True,
+                 start_background=True):
         self.url = url
         logger.info(f'Initializing using URL:{url}')
         self.route = route
         logger.info(f'Initializing using route: {route}')
+        # the request field listing the models
+        self.model_field = 'c' if route == 'similarities' else route
+        self.admission = Admission()
         logger.info(f"S3 bucket for downloading models : "
                     f"{s3_utils.DEFAULT_S3_BUCKET}")
-        self.model_mapping = {} 
-        self.models_in_s3 = []
-        self.local_models = []
-        logger.info(f'Loaded models: {list(model_mapping)}')
+        self.model_mapping = ModelCache()
+        self.model_mapping.on_evict.append(self._on_model_evicted)
+        self.loader = ModelLoader(self._load_model)
+        # parallel, resumable and verified downloads into a disk cache
+        self.artifacts = ArtifactStore(in_use=self._artifact_dirs) \
+            if ARTIFACT_STORE else None
+        if route == 'similarities':
+            # the outputs of a similarities model are text embeddings
+            self.result_cache = ResultCache(
+                EMBEDDING_CACHE_SIZE, name='embeddings'
+            )
+        else:
+            self.result_cache = ResultCache()
+        # reference texts of each similarities model, see handle_search_request
+        self.references = dict()
+        self.fanout = FanOut()
+        # called with (model_name, entry) when a model is loaded or evicted
+        self.on_models_changed = []
+        self.catalog = ModelCatalog(DEFAULT_LOCAL_MODEL_DIR)
+        # new versions are loaded next to the old ones and swapped in
+        self.reloader = ModelReloader(self.reload_model, self.has_new_version)
+        if MODEL_AUTO_RELOAD:
+            self.catalog.on_refresh.append(self.check_versions)
+        if start_background:
+            self.catalog.start()
+
+        # models named in model_mapping or PRELOAD_MODELS are served from
+        # the first request, the worker is ready once they are warmed up
+        self.preload_models = list(dict.fromkeys(
+            list(model_mapping or []) + PRELOAD_MODELS
+        ))
+        self.preload_failed = []
+        self.ready = threading.Event()
+        if not self.preload_models:
+            self.ready.set()
+        elif preload_async:
+            threading.Thread(
+                target=self.preload, args=(self.preload_models,),
+                name='model-preload', daemon=True,
+            ).start()
+        else:
+            self.preload(self.preload_models)
+        logger.info(f'Preloading models: {self.preload_models}')
+
+    def after_fork(self):
+        """
+        Prepares a forked worker process to serve requests
+
+        Thread pools and micro-batcher threads of the parent do not exist in
+        the child, so they are replaced, and background threads are started.
+        """
+        self.fanout = FanOut()
+        for model_name, entry in self.model_mapping.items():
+            if 'batcher' in entry:
+                batcher = MicroBatcher(model_name, entry['batch_model'])
+                entry['batcher'] = batcher
+                entry['model'] = batcher.get_results
+        self.catalog.start()
+
+    def preload(self, model_names, workers=PRELOAD_WORKERS):
+        """
+        Loads, pins and warms up models in parallel, then marks the worker ready
+
+        Args:
+            model_names (list): the models to preload
+            workers (int): the number of models loaded at once
+
+        Returns:
+            list: the models that failed to load
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self._preload_model, model_names)
+            failed = [
+                name for name, ok in zip(model_names, results) if not ok
+            ]
+        self.preload_failed = failed
+        self.ready.set()
+        logger.info(f'Worker ready, loaded models: {list(self.model_mapping)}'
+                    f', failed: {failed}')
+        return failed
+
+    def _preload_model(self, model_name):
+        try:
+            self.model_mapping.pin(model_name)
+            # preloads wait for their turn to load however long it takes
+            entry = self.loader.load(model_name, deadline=math.inf)
+            self.warm_up(entry)
+            return True
+        except Exception as e:
+            self.model_mapping.unpin(model_name)
+            logger.error(f'Unable to preload model {model_name}: {str(e)}')
+            return False
+
+    def warm_up(self, entry, iterations=WARMUP_ITERATIONS):
+        """
+        Runs a few inferences so that the first request does not pay for
+        lazy initialisation
+
+        Args:
+            entry (dict): the model_mapping entry of the model
+            iterations (int): the number of inferences per warm up text
+        """
+        for _ in range(iterations):
+            for text in WARMUP_TEXTS:
+                entry['model'](text)
+        entry['batch_model'](WARMUP_TEXTS)
 
     def worker_put_request(self):
         """
@@ -82,86 +512,747 @@ class Worker:
         """
         # base request
         models_info = list()
-        for model in self.model_mapping:
+        for model, entry in self.model_mapping.items():
             models_info.append({
                 'id': model,
-                'description': self.model_mapping[model]['description']
+                'description': entry['description']
             })
 
         # format request
         request = {
             'url': self.url,
             'route': self.route,
-            'models': models_info
+            'models': models_info,
+            'load': self.load(),
         }
 
         # add models here
         logger.info(f'Returning models: {[d["id"] for d in request["models"]]}')
         return request
 
-    def handle_request(self, request):
+    def load(self):
+        """
+        Current load figures, sent to the gateway with every heartbeat
+
+        Returns:
+            dict: in-flight requests, queued texts, models being loaded,
+                loaded models and their estimated memory, requests waiting
+                for admission and the longest wait so far
+        """
+        entries = self.model_mapping.items()
+        return {
+            'in_flight': requests_in_flight.value(),
+            'queue_depth': sum(
+                entry['batcher'].depth for _, entry in entries
+                if 'batcher' in entry
+            ),
+            'loading': len(self.loader.loading()),
+            'loaded_models': len(entries),
+            'model_memory_bytes': self.model_mapping.total_bytes,
+            'waiting': self.admission.waiting(),
+            'wait_ms': int(self.admission.oldest_wait() * 1000),
+        }
+
+    def _models_changed(self, model_name, entry):
+        for callback in self.on_models_changed:
+            try:
+                callback(model_name, entry)
+            except Exception as e:
+                logger.error(f'Model change callback failed: {str(e)}')
+
+    def get_model(self, model_name):
+        """
+        Returns the loaded model entry, loading the model if needed
+
+        Args:
+            model_name (str): the model to load
+
+        Returns:
+            dict: the model_mapping entry of the model
+        """
+        # checking if the model is loaded, or present in s3 or locally
+        if model_name not in self.model_mapping:
+            with stage('catalog'):
+                known = self.catalog.contains(model_name)
+            if not known:
+                abort(404, f'No such model: {model_name}')
+
+        entry = self.model_mapping.get(model_name)
+        if entry is None:
+
+            # one load per model at a time, other requests wait for it
+            try:
+                with stage('load'):
+                    entry = self.loader.load(model_name)
+            except ModelLoadError as e:
+                abort(503, str(e), retry_after=e.retry_after)
+
+        return entry
+
+    def get_models(self, model_names):
+        """
+        Returns:
+            dict: the entry of each distinct model, in request order, see
+                get_model
+        """
+        return {
+            model_name: self.get_model(model_name)
+            for model_name in dict.fromkeys(model_names)
+        }
+
+    def _load_model(self, model_name):
+        """
+        Downloads a model, adds it to model_mapping and returns its entry
+
+        Only called by self.loader, so never twice at once for one model.
+        """
+        # a load that finished just before this one started
+        entry = self.model_mapping.peek(model_name)
+        if entry is not None:
+            return entry
+
+        entry, size = self._build_entry(model_name)
+        # outputs of a previously loaded copy of the model are stale
+        self.result_cache.invalidate_model(model_name)
+        self.model_mapping.put(model_name, entry, size=size)
+        logger.info(
+            f'Loaded models: {list(self.model_mapping)}'
+        )
+        self._models_changed(model_name, entry)
+        return entry
+
+    def _build_entry(self, model_name):
+        """
+        Downloads and loads a model into a new model_mapping entry, without
+        adding it to model_mapping
+
+        Returns:
+            tuple: the entry and the estimated size of the model in bytes
+        """
+        description = None
+        revision = None
+        artifact_dir = None
+        if self.artifacts is not None:
+            nlp = self.artifacts.load(model_name)
+            description = self.artifacts.description(model_name)
+            fetched = self.artifacts.fetched[model_name]
+            revision = artifact_revision(fetched)
+            artifact_dir = fetched.get('cache_dir')
+        else:
+            nlp = s3_utils.LazyModel(model_name)
+        if PRUNE_PIPELINE:
+            removed = prune_pipeline(nlp, self.route)
+            if removed:
+                logger.info(f'Removed unused components of {model_name}: '
+                            f'{removed}')
+        format_doc = ROUTE_FORMATTERS[self.route]
+        chunker = None
+        if self.route == 'classes' and CHUNK_THRESHOLD_CHARS > 0:
+            # long texts are classified as the combined scores of chunks
+            chunker = TextChunker(nlp)
+        entry = {
+            'nlp': nlp,
+            'model': timed_model(
+                model_name, 'single', model_formatter(nlp, format_doc, chunker)
+            ),
+            'batch_model': timed_model(
+                model_name, 'batch',
+                batch_model_formatter(nlp, format_doc, chunker),
+            ),
+            'format_doc': format_doc,
+            'chunker': chunker,
+            'description': description or s3_utils.get_description(model_name),
+            # keys the cached outputs of the model
+            'version': model_version(nlp, revision),
+            'revision': revision,
+            # not evicted from the artifact cache while the model is loaded
+            'artifact_dir': artifact_dir,
+        }
+        if MICRO_BATCHING:
+            # concurrent single texts share one nlp.pipe call
+            batcher = MicroBatcher(model_name, entry['batch_model'])
+            entry['batcher'] = batcher
+            entry['model'] = batcher.get_results
+        if self.route == 'similarities' and model_name not in self.references:
+            texts = read_reference_texts(model_name)
+            if texts is not None:
+                self.references[model_name] = ReferenceIndex(texts)
+        return entry, estimate_model_size(nlp)
+
+    def _artifact_dirs(self):
+        """
+        Returns:
+            set: the artifact cache directories of the loaded models
+        """
+        return {
+            entry['artifact_dir'] for _, entry in self.model_mapping.items()
+            if entry.get('artifact_dir')
+        }
+
+    def published_version(self, model_name):
+        """
+        Returns:
+            str: the revision of the artifact published for a model, see
+                worker_artifacts.artifact_revision, None if it cannot be
+                told without loading the model
+        """
+        if self.artifacts is None:
+            return None
+        return artifact_revision(self.artifacts.metadata(model_name))
+
+    def has_new_version(self, model_name):
+        """
+        Returns:
+            bool: True if a loaded model was published again since it was
+                loaded
+        """
+        entry = self.model_mapping.peek(model_name)
+        if entry is None or entry.get('revision') is None:
+            return False
+        published = self.published_version(model_name)
+        return published is not None and published != entry['revision']
+
+    def check_versions(self):
+        """
+        Starts reloading the loaded models that have a new version, called
+        after each catalog refresh
+
+        Returns:
+            list: the models being reloaded
+        """
+        return self.reloader.check(self.model_mapping.names())
+
+    def reload_model(self, model_name):
+        """
+        Replaces a loaded model with a newly loaded copy, e.g. of a new
+        version, without a moment where it is not served
+
+        The new copy is loaded next to the old one, taking a load slot, and
+        warmed up. It is then swapped in: requests looking the model up from
+        then on get it, while the requests already holding the old copy
+        finish on it. The cached outputs of the model are dropped, and once
+        the old copy has no requests left its micro-batcher is stopped and
+        it is collected.
+
+        Raises:
+            ValueError: the model is not loaded
+
+        Returns:
+            dict: the versions swapped, `from` and `to`
+        """
+        if model_name not in self.model_mapping:
+            raise ValueError(f'Model {model_name} is not loaded')
+        # a reload is not waited for by a request, so it waits for its turn
+        # to load however long it takes
+        with self.loader.limiter.slot(deadline=math.inf):
+            entry, size = self._build_entry(model_name)
+        try:
+            self.warm_up(entry)
+            previous = self.model_mapping.replace(model_name, entry, size)
+        except Exception:
+            self._release_entry(model_name, entry)
+            raise
+        if previous is None:
+            self._release_entry(model_name, entry)
+            raise ValueError(f'Model {model_name} was unloaded while it '
+                             f'was reloaded')
+        versions = {'from': previous['version'], 'to': entry['version']}
+        logger.info(f'Swapped model {model_name} {versions["from"]} for '
+                    f'{versions["to"]}')
+        self._models_changed(model_name, entry)
+        self._release_outputs(model_name)
+
+        if not self.reloader.drain(previous):
+            logger.warning(f'Requests still use the previous {model_name} '
+                           f'after {self.reloader.drain_timeout}s, '
+                           f'releasing it')
+        self._release_entry(model_name, previous)
+        # outputs the last requests on the previous copy cached meanwhile
+        self._release_outputs(model_name)
+        del previous
+        gc.collect()
+        return versions
+
+    def _release_outputs(self, model_name):
+        self.result_cache.invalidate_model(model_name)
+        references = self.references.get(model_name)
+        if references is not None:
+            references.release()
+
+    def _release_entry(self, model_name, entry):
+        """Stops the threads of an entry that is no longer served"""
+        batcher = entry.get('batcher')
+        if batcher is not None:
+            batcher.stop()
+
+    def _on_model_evicted(self, model_name, entry):
+        self._release_entry(model_name, entry)
+        self.admission.forget(model_name)
+        self._release_outputs(model_name)
+        self._models_changed(model_name, entry)
+
+    def run_model(self, model_name, entry, text, digest):
+        """
+        Returns the raw model output for a text, from the result cache if
+        possible
+
+        Args:
+            model_name (str): the model name
+            entry (dict): the model_mapping entry of the model
+            text (str): the text to be passed to the model
+            digest (str): text_digest of the text
+
+        Returns:
+            list: the formatted model output, not sorted or filtered
+        """
+        if not self.result_cache.enabled:
+            return entry['model'](text)
+        output = self.result_cache.get(digest, model_name, entry['version'])
+        if output is None:
+            output = entry['model'](text)
+            self.result_cache.put(digest, model_name, entry['version'], output)
+        return output
+
+    def run_models(self, entries, text, digest):
+        """
+        Returns the raw output of several models for a text
+
+        Outputs missing from the result cache are computed by self.fanout,
+        which tokenizes the text once and runs the models concurrently.
+
+        Args:
+            entries (list): (model name, model_mapping entry) pairs
+            text (str): the text to be passed to the models
+            digest (str): text_digest of the text
+
+        Returns:
+            list: the formatted output of each model, in input order
+        """
+        outputs = dict()
+        if self.result_cache.enabled:
+            for model_name, entry in entries:
+                output = self.result_cache.get(
+                    digest, model_name, entry['version']
+                )
+                if output is not None:
+                    outputs[model_name] = output
+        missing = [(n, e) for (n, e) in entries if n not in outputs]
+        if len(missing) == 1:
+            model_name, entry = missing[0]
+            outputs[model_name] = entry['model'](text)
+        elif missing:
+            # the models run concurrently, each is observed with the time
+            # the request waited for all of them
+            start = time.perf_counter()
+            outputs.update(self.fanout.run(text, missing))
+            elapsed = time.perf_counter() - start
+            for model_name, _ in missing:
+                inference_seconds.observe(
+                    elapsed, model=model_name, mode='fanout'
+                )
+        if self.result_cache.enabled:
+            for model_name, entry in missing:
+                self.result_cache.put(
+                    digest, model_name, entry['version'], outputs[model_name]
+                )
+        return [outputs[model_name] for model_name, _ in entries]
+
+    def run_batch_model(self, model_name, entry, texts, digests, **kwargs):
+        """
+        Returns the raw model output for each text, only passing the texts
+        missing from the result cache to the model
+
+        Args:
+            model_name (str): the model name
+            entry (dict): the model_mapping entry of the model
+            texts (list): the texts to be passed to the model
+            digests (list): text_digest of each text, None if the cache is off
+            kwargs: passed to the batch model, e.g. batch_size
+
+        Returns:
+            list: the formatted model output for each text, in input order
+        """
+        if not self.result_cache.enabled:
+            return entry['batch_model'](texts, **kwargs)
+        version = entry['version']
+        outputs = [
+            self.result_cache.get(digest, model_name, version)
+            for digest in digests
+        ]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            results = entry['batch_model'](
+                [texts[i] for i in missing], **kwargs
+            )
+            for i, output in zip(missing, results):
+                outputs[i] = output
+                self.result_cache.put(digests[i], model_name, version, output)
+        return outputs
+
+    def filter_output(self, output, request):
+        """
+        Applies the filters of the request to a raw model output
+
+        Args:
+            output (list): the formatted model output
+            request (dict): the request, holding the filter values
+
+        Returns:
+            list: the filtered output
+        """
+        if self.route == 'entities':
+            return filter_entities(
+                output, request['min_confidence'], request['min_length']
+            )
+        return filter_results(
+            output, request['min_confidence'], request['max_classes']
+        )
+
+    @track_request
+    @admitted
+    def handle_request(self, request, models):
         """
         Logic for handling a request (i.e. passing to model)
 
         Args:
             request (dict): the request to be handled
+            models (dict): the entries of the requested models, see
+                get_models
 
         Returns:
             dict: the response in the correct format
         """
+        if self.route == 'similarities':
+            return self._handle_similarity_request(request, models)
+
+        request_in_time = time.perf_counter()
+
+        digest = text_digest(request['text'])
 
-        request_in_time = datetime.now()
+        # the models were loaded by admitted
+        entries = list(models.items())
+        # fan-out runs whole pipelines, long texts are chunked per model
+        chunked = any(
+            entry.get('chunker') is not None
+            and entry['chunker'].applies(request['text'])
+            for _, entry in entries
+        )
+        with stage('inference'):
+            if FANOUT and len(entries) > 1 and not chunked:
+                results = self.run_models(entries, request['text'], digest)
+            else:
+                results = [
+                    self.run_model(model_name, entry, request['text'], digest)
+                    for model_name, entry in entries
+                ]
+        results = dict(zip([model_name for model_name, _ in entries], results))
 
-        # determine which model to use
         outputs = list()
-        for model_name in request['classes']:
-
-            # checking if the model is present in loaded models list
-            if model_name not in self.model_mapping:
-
-                # checking if the model is present in s3 models list
-                self.models_in_s3 = \
-                    [ f.split('/')[1].split('.')[0] for f in 
-                      s3_utils.scrape_bucket() ]
-                
-                if model_name not in self.models_in_s3 and \
-                    model_name not in os.listdir(DEFAULT_LOCAL_MODEL_DIR):
-                
-                    abort(404, f'No such model: {model_name}')
-                
-                else:
-
-                    # downloading the model if present in s3
-                    try:
-                        model = model_formatter(s3_utils.LazyModel(model_name))
-                        self.model_mapping[model_name] = {
-                            'model': model,
-                            'description': s3_utils.get_description(model_name)
-                        }
-                        logger.info(
-                            f'Loaded models: {list(self.model_mapping)}'
-                        )
-                    except Exception as e:
-                        logger.error(
-                            f'Unable to load model {model_name}: {str(e)}'
-                        )
-
-            model = self.model_mapping[model_name]['model']
-            output = model(request['text'])
-            output = sorted(output, key=lambda i: i['score'], reverse=True)
-            output = filter_min_confidence(output, request['min_confidence'])
-            output = filter_max_classes(output, request['max_classes'])
-            outputs.append({'type': model_name, 'result': output})
+        with stage('filter'):
+            for model_name in request[self.route]:
+                output = self.filter_output(results[model_name], request)
+                outputs.append({'type': model_name, 'result': output})
         response = {
             'text': request['text'],
-            'classes': outputs,
+            self.route: outputs,
+        }
+
+        log_request(
+            self.route, (time.perf_counter() - request_in_time) * 1000,
+            results=lambda: response[self.route],
+            models=request[self.route], text_sha256=digest,
+        )
+
+        return response
+
+    @track_request
+    @admitted
+    def handle_batch_request(self, request, models):
+        """
+        Logic for handling a batch request (i.e. passing many texts to models)
+
+        Each requested model runs once over the whole batch with nlp.pipe.
+
+        Args:
+            request (dict): the batch request to be handled
+            models (dict): the entries of the requested models, see
+                get_models
+
+        Returns:
+            dict: the response in the correct format
+        """
+
+        request_in_time = time.perf_counter()
+
+        texts = request['texts']
+        request_batch_texts.observe(len(texts))
+        batch_size = request.get('batch_size') or DEFAULT_BATCH_SIZE
+        n_process = min(
+            request.get('n_process') or DEFAULT_N_PROCESS, MAX_N_PROCESS
+        )
+
+        digests = None
+        if self.result_cache.enabled:
+            digests = [text_digest(text) for text in texts]
+
+        outputs = [list() for _ in texts]
+        for model_name in request[self.route]:
+            entry = models[model_name]
+            with stage('inference'):
+                results = self.run_batch_model(
+                    model_name, entry, texts, digests,
+                    batch_size=batch_size, n_process=n_process
+                )
+            with stage('filter'):
+                for text_outputs, output in zip(outputs, results):
+                    output = self.filter_output(output, request)
+                    text_outputs.append({'type': model_name, 'result': output})
+        response = {
+            'results': [
+                {'text': text, self.route: text_outputs}
+                for text, text_outputs in zip(texts, outputs)
+            ],
+        }
+
+        log_request(
+            f'{self.route}_batch', (time.perf_counter() - request_in_time) * 1000,
+            results=lambda: response['results'],
+            models=request[self.route], texts=len(texts),
+        )
+
+        return response
+
+    def handle_stream(self, stream, parse, batch_size=STREAM_BATCH_SIZE):
+        """
+        Handles an NDJSON stream of requests, one /models/ request per line
+
+        Reading and parsing lines, running the models over batches of lines,
+        and writing the response run concurrently, with a bounded number of
+        batches between them, so memory does not grow with the stream. An
+        invalid line or a failed model is reported on that line's response
+        line and the stream goes on.
+
+        The stream holds a request slot from this call until the returned
+        iterator is exhausted or closed, see `admitted`. Without a free slot
+        it aborts with a 429 or 503 before the response starts.
+
+        Args:
+            stream: the binary request body
+            parse (callable): validates a decoded line and returns the
+                request, raising an HTTPException if it is invalid
+            batch_size (int): lines passed to the models at once
+
+        Returns:
+            iterator: the NDJSON response lines as bytes, in input order
+        """
+        admit(self.admission.requests.acquire)
+        return ClosingIterator(
+            self._stream(stream, parse, batch_size),
+            self.admission.requests.release,
+        )
+
+    def _stream(self, stream, parse, batch_size):
+        request_in_time = time.perf_counter()
+        batches = in_thread(
+            batched(parse_lines(read_lines(stream), parse), batch_size),
+            name='stream-reader',
+        )
+        outputs = in_thread(
+            (self.run_stream_batch(batch, batch_size) for batch in batches),
+            name='stream-inference',
+        )
+        lines = errors = 0
+        try:
+            for data, batch_lines, batch_errors in outputs:
+                lines += batch_lines
+                errors += batch_errors
+                yield data
+        except Exception as e:
+            logger.error(f'Stream failed after {lines} lines: {str(e)}')
+            yield encode_lines([error_line(None, 500, 'Stream failed')])
+        finally:
+            outputs.close()
+            stream_lines.inc(lines - errors, outcome='ok')
+            stream_lines.inc(errors, outcome='error')
+            log_request(
+                f'{self.route}_stream',
+                (time.perf_counter() - request_in_time) * 1000,
+                lines=lines, errors=errors,
+            )
+
+    def run_stream_batch(self, documents, batch_size=STREAM_BATCH_SIZE):
+        """
+        Runs each requested model once over the texts of a batch of lines
+
+        Args:
+            documents (list): (line number, id, request, error line) tuples,
+                see worker_stream.parse_lines
+            batch_size (int): passed to nlp.pipe
+
+        Returns:
+            tuple: the NDJSON response lines, the number of lines and the
+                number of error lines
+        """
+        errors = dict()
+        lines_by_model = dict()
+        for i, (number, _, request, error) in enumerate(documents):
+            if error is not None:
+                errors[i] = error
+                continue
+            for model_name in dict.fromkeys(request[self.route]):
+                lines_by_model.setdefault(model_name, []).append(i)
+
+        outputs = dict()
+        for model_name, indices in lines_by_model.items():
+            try:
+                entry = self.get_model(model_name)
+                texts = [documents[i][2]['text'] for i in indices]
+                digests = None
+                if self.result_cache.enabled:
+                    digests = [text_digest(text) for text in texts]
+                # each batch of a stream takes a slot of the model
+                with self.admission.model(model_name).slot(), \
+                        self.reloader.in_use([entry]):
+                    results = self.run_batch_model(
+                        model_name, entry, texts, digests, batch_size=batch_size
+                    )
+            except HTTPException as e:
+                for i in indices:
+                    errors.setdefault(i, http_error_line(documents[i][0], e))
+                continue
+            except AdmissionError as e:
+                for i in indices:
+                    errors.setdefault(i, error_line(
+                        documents[i][0], e.code, str(e),
+                        retry_after=e.retry_after,
+                    ))
+                continue
+            except Exception as e:
+                logger.error(f'Stream batch of {model_name} failed: {str(e)}')
+                for i in indices:
+                    errors.setdefault(i, error_line(
+                        documents[i][0], 500, f'Model {model_name} failed'
+                    ))
+                continue
+            for i, output in zip(indices, results):
+                outputs[i, model_name] = output
+
+        responses = list()
+        for i, (number, request_id, request, _) in enumerate(documents):
+            if i in errors:
+                response = errors[i]
+            else:
+                response = {
+                    'line': number,
+                    'text': request['text'],
+                    self.route: [
+                        {
+                            'type': model_name,
+                            'result': self.filter_output(
+                                outputs[i, model_name], request
+                            ),
+                        }
+                        for model_name in request[self.route]
+                    ],
+                }
+            if request_id is not None:
+                response['id'] = request_id
+            responses.append(response)
+        return encode_lines(responses), len(responses), len(errors)
+
+    def _handle_similarity_request(self, request, models):
+        """
+        Scores the similarity of texts a and b with each model in c
+
+        Both texts are embedded in one batch per model, and embeddings are
+        cached per (text digest, model, version).
+        """
+        request_in_time = time.perf_counter()
+
+        texts = [request['a'], request['b']]
+        digests = [text_digest(text) for text in texts]
+        outputs = list()
+        for model_name in dict.fromkeys(request['c']):
+            entry = models[model_name]
+            with stage('inference'):
+                vectors = self.run_batch_model(
+                    model_name, entry, texts, digests
+                )
+            score = pair_scores(
+                stack_vectors(vectors[:1]), stack_vectors(vectors[1:])
+            )[0]
+            outputs.append({
+                'type': model_name, 'result': [{'score': float(score)}]
+            })
+        response = {
+            'a': request['a'],
+            'b': request['b'],
+            'c': outputs,
         }
 
-        logger.info(f"text hash: {hashlib.sha256(response['text'].encode()).hexdigest()}")
+        log_request(
+            self.route, (time.perf_counter() - request_in_time) * 1000,
+            results=lambda: response['c'],
+            models=request['c'], text_sha256=digests,
+        )
+
+        return response
 
-        logger.info(f'st: {request_in_time}, en: {datetime.now()}, '\
-             f'dur: {(datetime.now() - request_in_time).total_seconds()*1000}ms')
+    def set_references(self, model_name, texts):
+        """
+        Replaces the reference texts searched by handle_search_request
+
+        The embedding matrix is built on the next search.
+
+        Args:
+            model_name (str): the similarities model
+            texts (list): the reference texts
+        """
+        self.references[model_name] = ReferenceIndex(texts)
+        logger.info(f'{len(texts)} reference texts set for {model_name}')
+
+    @track_request
+    @admitted
+    def handle_search_request(self, request, models):
+        """
+        Scores one text against every reference text of each model in c
+
+        Replaces one pairwise request per reference text with a single
+        matrix-vector product per model.
+
+        Args:
+            request (dict): the search request to be handled
+            models (dict): the entries of the requested models, see
+                get_models
+
+        Returns:
+            dict: the best matches of each model, best first
+        """
+        request_in_time = time.perf_counter()
+
+        text = request['text']
+        digest = text_digest(text)
+        top_k = request.get('top_k') or DEFAULT_TOP_K
+        outputs = list()
+        for model_name in dict.fromkeys(request['c']):
+            references = self.references.get(model_name)
+            if references is None:
+                abort(404, f'No reference texts for model: {model_name}')
+            entry = models[model_name]
+            with stage('inference'):
+                query = self.run_model(model_name, entry, text, digest)
+            with stage('search'):
+                matches = references.search(entry, query, top_k)
+            outputs.append({'type': model_name, 'result': matches})
+        response = {
+            'text': text,
+            'c': outputs,
+        }
 
-        logger.info(f'Classes detected: {response["classes"]}')
+        log_request(
+            'search', (time.perf_counter() - request_in_time) * 1000,
+            results=lambda: response['c'],
+            models=request['c'], text_sha256=digest,
+        )
 
         return response
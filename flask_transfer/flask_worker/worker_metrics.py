@@ -0,0 +1,287 @@
+import contextlib
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+# seconds, for latencies from a millisecond to a minute
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60,
+)
+
+
+class Metric:
+    """
+    Base class of a named metric with optional labels
+
+    Values are kept per combination of label values, e.g. one value per model.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        """
+        Returns:
+            dict: the current value for each combination of label values
+        """
+        with self._lock:
+            return {
+                key: self._copy(value) for key, value in self._values.items()
+            }
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. a number of requests"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, e.g. a queue depth"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, e.g. batch sizes"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0
+                }
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the with block, on a monotonic clock"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _copy(self, value):
+        return {
+            'buckets': list(value['buckets']),
+            'sum': value['sum'],
+            'count': value['count'],
+        }
+
+
+class Registry:
+    """Holds every metric of the worker by name"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(
+                    name, documentation, labelnames, **kwargs
+                )
+            elif not isinstance(metric, cls):
+                raise ValueError(f'Metric {name} is a {metric.type}')
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def add_collector(self, collector):
+        """
+        Registers a function called before the metrics are read, to update
+        values that are only worth computing when asked for, e.g. memory use
+        """
+        self._collectors.append(collector)
+
+    def metrics(self):
+        for collector in self._collectors:
+            collector()
+        with self._lock:
+            return list(self._metrics.values())
+
+    def reset_locks(self):
+        """
+        Replaces every lock, called in a forked child
+
+        A lock held by another thread of the parent at fork time would
+        otherwise stay locked forever in the child.
+        """
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._lock = threading.Lock()
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric as a JSON friendly dict
+
+        Example:
+        {
+            "worker_batch_queue_depth": {
+                "type": "gauge",
+                "values": {"model=topic": 3}
+            }
+        }
+
+        Returns:
+            dict: the metric values, keyed by metric name
+        """
+        snapshot = {}
+        for metric in self.metrics():
+            values = {}
+            for key, value in metric.collect().items():
+                label = ','.join(
+                    f'{name}={v}' for name, v in zip(metric.labelnames, key)
+                )
+                if isinstance(value, dict):
+                    value = dict(value, buckets=dict(zip(
+                        (str(b) for b in metric.buckets), value['buckets']
+                    )))
+                values[label] = value
+            snapshot[metric.name] = {'type': metric.type, 'values': values}
+        return snapshot
+
+    def exposition(self):
+        """
+        Returns every metric in the Prometheus text exposition format
+
+        Example:
+            # HELP worker_batch_queue_depth Texts waiting for a micro-batch
+            # TYPE worker_batch_queue_depth gauge
+            worker_batch_queue_depth{model="topic"} 3
+
+        Returns:
+            str: the text served on /metrics
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for key, value in sorted(metric.collect().items()):
+                labels = list(zip(metric.labelnames, key))
+                if not isinstance(value, dict):
+                    lines.append(
+                        f'{metric.name}{format_labels(labels)} '
+                        f'{format_value(value)}'
+                    )
+                    continue
+                for bound, count in zip(metric.buckets, value['buckets']):
+                    le = labels + [('le', format_value(bound))]
+                    lines.append(
+                        f'{metric.name}_bucket{format_labels(le)} {count}'
+                    )
+                lines.append(f'{metric.name}_sum{format_labels(labels)} '
+                             f'{format_value(value["sum"])}')
+                lines.append(f'{metric.name}_count{format_labels(labels)} '
+                             f'{value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    """
+    Args:
+        labels (list): (name, value) pairs
+
+    Returns:
+        str: the labels as {name="value",...}, empty if there are none
+    """
+    if not labels:
+        return ''
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"')
+         .replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def resident_memory_bytes():
+    """
+    Returns:
+        int: the resident memory of this process, 0 if unavailable
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# the registry shared by all worker modules
+REGISTRY = Registry()
+os.register_at_fork(after_in_child=REGISTRY.reset_locks)
+
+process_memory = REGISTRY.gauge(
+    'worker_process_resident_memory_bytes',
+    'Resident memory of the worker process',
+)
+REGISTRY.add_collector(lambda: process_memory.set(resident_memory_bytes()))
@@ -0,0 +1,288 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# budgets of the loaded model cache, 0 means unbounded
+MODEL_CACHE_MAX_MODELS = int(os.getenv('MODEL_CACHE_MAX_MODELS') or 0)
+MODEL_CACHE_MAX_MB = float(os.getenv('MODEL_CACHE_MAX_MB') or 0)
+# eviction policy: lru or lfu
+MODEL_CACHE_POLICY = (os.getenv('MODEL_CACHE_POLICY') or 'lru').lower()
+# comma separated models that are never evicted
+MODEL_CACHE_PINNED = [
+    m.strip() for m in (os.getenv('MODEL_CACHE_PINNED') or '').split(',')
+    if m.strip()
+]
+
+cache_hits = REGISTRY.counter(
+    'worker_model_cache_hits_total',
+    'Requests for a model that was already loaded',
+    ['model'],
+)
+cache_misses = REGISTRY.counter(
+    'worker_model_cache_misses_total',
+    'Requests for a model that was not loaded',
+    ['model'],
+)
+cache_loads = REGISTRY.counter(
+    'worker_model_cache_loads_total',
+    'Models added to the cache',
+    ['model'],
+)
+cache_evictions = REGISTRY.counter(
+    'worker_model_cache_evictions_total',
+    'Models evicted from the cache',
+    ['model'],
+)
+cache_models = REGISTRY.gauge(
+    'worker_model_cache_models',
+    'Models currently loaded',
+)
+cache_bytes = REGISTRY.gauge(
+    'worker_model_cache_bytes',
+    'Estimated memory of the loaded models',
+)
+model_memory = REGISTRY.gauge(
+    'worker_model_memory_bytes',
+    'Estimated memory of each loaded model',
+    ['model'],
+)
+
+
+def estimate_model_size(nlp):
+    """
+    Estimates the memory held by a SpaCy pipeline
+
+    Counts the weights of every component model and the vectors table.
+    Tokenizer, vocab strings and Python objects are not counted.
+
+    Args:
+        nlp (SpaCy Pipeline): the loaded pipeline
+
+    Returns:
+        int: the estimated size in bytes, 0 if it cannot be estimated
+    """
+    size = 0
+    try:
+        seen = set()
+        for _, component in nlp.pipeline:
+            model = getattr(component, 'model', None)
+            if model is None or not hasattr(model, 'walk'):
+                continue
+            for node in model.walk():
+                if node.id in seen:
+                    continue
+                seen.add(node.id)
+                for name in node.param_names:
+                    if node.has_param(name):
+                        size += node.get_param(name).nbytes
+        vectors = getattr(nlp.vocab.vectors, 'data', None)
+        if vectors is not None:
+            size += vectors.nbytes
+    except Exception as e:
+        logger.error(f'Unable to estimate model size: {str(e)}')
+    return size
+
+
+class ModelCache:
+    """
+    Loaded models bounded by a model count and/or memory budget
+
+    Each entry is a model_mapping dict with its estimated size in `size`.
+    When a budget is exceeded the least recently used (`lru`) or least
+    frequently used (`lfu`) unpinned model is evicted and the `on_evict`
+    callbacks are called with its name and entry.
+
+    Iterating and indexing only peek at the entries. `get` is the lookup
+    used to serve requests: it counts hits/misses and updates recency.
+    """
+
+    def __init__(self, max_models=MODEL_CACHE_MAX_MODELS,
+                 max_bytes=MODEL_CACHE_MAX_MB * 1024 * 1024,
+                 policy=MODEL_CACHE_POLICY, pinned=MODEL_CACHE_PINNED):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f'Invalid model cache policy: {policy}')
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pinned = set(pinned)
+        self.on_evict = []
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, model_name):
+        return model_name in self._entries
+
+    def __getitem__(self, model_name):
+        return self._entries[model_name]
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def names(self):
+        with self._lock:
+            return list(self._entries)
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def peek(self, model_name):
+        """
+        Returns:
+            dict: the model entry, or None if the model is not loaded
+        """
+        return self._entries.get(model_name)
+
+    @property
+    def total_bytes(self):
+        return self._bytes
+
+    def get(self, model_name):
+        """
+        Looks up a model to serve a request
+
+        Args:
+            model_name (str): the model to look up
+
+        Returns:
+            dict: the model entry, or None if the model is not loaded
+        """
+        with self._lock:
+            entry = self._entries.get(model_name)
+            if entry is None:
+                cache_misses.inc(model=model_name)
+                return None
+            self._entries.move_to_end(model_name)
+            entry['hits'] += 1
+            entry['last_used'] = time.monotonic()
+        cache_hits.inc(model=model_name)
+        return entry
+
+    def put(self, model_name, entry, size=0):
+        """
+        Adds a loaded model, evicting others if a budget is exceeded
+
+        Args:
+            model_name (str): the model name
+            entry (dict): the model_mapping entry
+            size (int): the estimated size of the model in bytes
+        """
+        entry['size'] = size
+        entry['hits'] = 0
+        entry['last_used'] = time.monotonic()
+        with self._lock:
+            previous = self._entries.pop(model_name, None)
+            if previous is not None:
+                self._bytes -= previous['size']
+            self._entries[model_name] = entry
+            self._bytes += size
+            model_memory.set(size, model=model_name)
+            evicted = self._evict(keep=model_name)
+            self._update_gauges()
+        cache_loads.inc(model=model_name)
+        logger.info(f'Cached model {model_name} ({size / 2**20:.1f}MB), '
+                    f'{len(self._entries)} models, '
+                    f'{self._bytes / 2**20:.1f}MB in total')
+        for name, old_entry in evicted:
+            self._notify_evicted(name, old_entry)
+
+    def replace(self, model_name, entry, size=0):
+        """
+        Swaps the entry of a loaded model for a new one, e.g. a new version
+
+        Requests looking the model up from now on get the new entry. The
+        previous entry keeps its usage counts for the eviction policy, and
+        is not passed to the `on_evict` callbacks: it is the caller's to
+        release.
+
+        Returns:
+            dict: the previous entry, or None if the model is no longer
+                loaded, in which case the new entry is not added either
+        """
+        with self._lock:
+            previous = self._entries.get(model_name)
+            if previous is None:
+                return None
+            self.put(model_name, entry, size)
+            entry['hits'] = previous['hits']
+        return previous
+
+    def pop(self, model_name):
+        """
+        Removes a model from the cache, even if it is pinned
+
+        Returns:
+            dict: the removed entry, or None if it was not loaded
+        """
+        with self._lock:
+            entry = self._entries.pop(model_name, None)
+            if entry is not None:
+                self._bytes -= entry['size']
+                model_memory.remove(model=model_name)
+            self._update_gauges()
+        if entry is not None:
+            self._notify_evicted(model_name, entry)
+        return entry
+
+    def pin(self, model_name):
+        self.pinned.add(model_name)
+
+    def unpin(self, model_name):
+        self.pinned.discard(model_name)
+
+    def _over_budget(self):
+        if self.max_models and len(self._entries) > self.max_models:
+            return True
+        if self.max_bytes and self._bytes > self.max_bytes:
+            return True
+        return False
+
+    def _victim(self, keep):
+        candidates = [
+            name for name in self._entries
+            if name != keep and name not in self.pinned
+        ]
+        if not candidates:
+            return None
+        if self.policy == 'lfu':
+            # min keeps the first (least recent) of equally used models
+            return min(candidates, key=lambda name: self._entries[name]['hits'])
+        return candidates[0]
+
+    def _evict(self, keep):
+        evicted = []
+        while self._over_budget():
+            victim = self._victim(keep)
+            if victim is None:
+                logger.warning('Model cache over budget but every other '
+                               'model is pinned')
+                break
+            entry = self._entries.pop(victim)
+            self._bytes -= entry['size']
+            model_memory.remove(model=victim)
+            cache_evictions.inc(model=victim)
+            evicted.append((victim, entry))
+        return evicted
+
+    def _notify_evicted(self, model_name, entry):
+        logger.info(f'Evicted model {model_name}')
+        for callback in self.on_evict:
+            try:
+                callback(model_name, entry)
+            except Exception as e:
+                logger.error(f'Eviction callback failed for {model_name}: '
+                             f'{str(e)}')
+
+    def _update_gauges(self):
+        cache_models.set(len(self._entries))
+        cache_bytes.set(self._bytes)
@@ -0,0 +1,261 @@
+"""
+Pre-fork server for the worker
+
+The master process imports the app, which loads and warms up the configured
+models (PRELOAD_MODELS) before any request is served. It then forks N worker
+processes that serve requests on a shared listening socket. The model memory
+is shared copy-on-write between the workers, and each of them has its own GIL.
+
+Usage:
+    PRELOAD_MODELS=topic,intent python -m flask_transfer.flask_worker.worker_prefork \
+        --workers 4 --host 0.0.0.0 --port 5001
+"""
+import argparse
+import gc
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+from .worker_logger import create_logger
+
+logger = create_logger(__name__)
+
+# seconds between two updates of a worker's load in the shared load table
+LOAD_REPORT_INTERVAL = float(os.getenv('LOAD_REPORT_INTERVAL') or 1)
+
+LOAD_FIELDS = (
+    'in_flight', 'queue_depth', 'loading', 'loaded_models',
+    'model_memory_bytes', 'waiting', 'wait_ms',
+)
+# load figures that add up across workers, the others are per worker
+SUMMED_LOAD_FIELDS = ('in_flight', 'queue_depth', 'loading', 'waiting')
+
+
+def memory_usage(pid):
+    """
+    Reads the memory usage of a process from /proc/<pid>/smaps_rollup
+
+    Pss counts shared pages divided by the number of processes sharing them,
+    so the Pss of all workers adds up to their real memory use.
+
+    Args:
+        pid (int): the process id
+
+    Returns:
+        dict: Rss, Pss, Shared_* and Private_* in kB, empty if unavailable
+    """
+    usage = dict()
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    usage[parts[0].rstrip(':')] = int(parts[1])
+    except OSError:
+        pass
+    return usage
+
+
+class LoadTable:
+    """
+    Load figures of each worker process in anonymous shared memory
+
+    Created before the workers are forked. Each worker writes its own slot,
+    the master reads all of them to report the load of the whole server.
+    """
+    _slot = struct.Struct(f'{len(LOAD_FIELDS)}q')
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._memory = mmap.mmap(-1, self._slot.size * workers)
+
+    def write(self, index, load):
+        values = [int(load.get(field) or 0) for field in LOAD_FIELDS]
+        self._slot.pack_into(self._memory, index * self._slot.size, *values)
+
+    def clear(self, index):
+        self.write(index, {})
+
+    def read(self, index):
+        values = self._slot.unpack_from(self._memory, index * self._slot.size)
+        return dict(zip(LOAD_FIELDS, values))
+
+    def totals(self):
+        """
+        Returns:
+            dict: the summed in-flight, queued and loading figures and the
+                largest per-worker model figures, which are shared pages
+        """
+        loads = [self.read(i) for i in range(self.workers)]
+        return {
+            field: (sum if field in SUMMED_LOAD_FIELDS else max)(
+                load[field] for load in loads
+            )
+            for field in LOAD_FIELDS
+        }
+
+
+class PreforkServer:
+    """
+    Forks, supervises and stops the worker processes
+
+    Worker processes that exit are replaced. SIGTERM or SIGINT stops the
+    workers, letting them finish their in-flight requests.
+    """
+
+    def __init__(self, app_module, host, port, workers, backlog=2048,
+                 memory_report_interval=0):
+        self.app_module = app_module
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.memory_report_interval = memory_report_interval
+        self.socket = socket.create_server((host, port), backlog=backlog)
+        self.socket.set_inheritable(True)
+        self.load_table = LoadTable(workers)
+        self.children = dict()
+        self.stopping = False
+        # held while forking so that no master thread holds a worker lock
+        # that the child would inherit in a locked state
+        self.fork_lock = threading.Lock()
+
+    def spawn(self, index):
+        with self.fork_lock:
+            pid = os.fork()
+        if pid == 0:
+            try:
+                self._serve(index)
+            finally:
+                os._exit(0)
+        self.children[pid] = index
+        logger.info(f'Started worker process {index}, pid {pid}')
+
+    def _serve(self, index):
+        from werkzeug.serving import make_server
+
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.app_module.post_fork()
+
+        def report_load():
+            while True:
+                self.load_table.write(index, self.app_module.worker.load())
+                time.sleep(LOAD_REPORT_INTERVAL)
+
+        threading.Thread(
+            target=report_load, name='load-report', daemon=True
+        ).start()
+
+        server = make_server(
+            self.host, self.port, self.app_module.app, threaded=True,
+            fd=self.socket.fileno(),
+        )
+        signal.signal(
+            signal.SIGTERM,
+            lambda *_: threading.Thread(target=server.shutdown).start(),
+        )
+        server.serve_forever()
+
+    def registration_payload(self):
+        """The gateway PUT body, with the load of all worker processes"""
+        with self.fork_lock:
+            payload = self.app_module.worker.worker_put_request()
+        payload['load'] = self.load_table.totals()
+        return payload
+
+    def stop(self, *_):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def report_memory(self):
+        for pid, index in sorted(self.children.items(), key=lambda c: c[1]):
+            usage = memory_usage(pid)
+            logger.info(f'Worker process {index} (pid {pid}): '
+                        f'rss {usage.get("Rss", 0) / 1024:.0f}MB, '
+                        f'pss {usage.get("Pss", 0) / 1024:.0f}MB, '
+                        f'shared {(usage.get("Shared_Clean", 0) + usage.get("Shared_Dirty", 0)) / 1024:.0f}MB, '
+                        f'private {(usage.get("Private_Clean", 0) + usage.get("Private_Dirty", 0)) / 1024:.0f}MB')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        registration = self.app_module.registration
+        if self.app_module.REGISTER_WITH_GATEWAY:
+            registration.payload_fn = self.registration_payload
+            registration.start()
+
+        last_report = time.monotonic()
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.5)
+                if self.memory_report_interval and \
+                        time.monotonic() - last_report > self.memory_report_interval:
+                    self.report_memory()
+                    last_report = time.monotonic()
+                continue
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            self.load_table.clear(index)
+            if not self.stopping:
+                logger.error(f'Worker process {index} (pid {pid}) exited '
+                             f'with status {status}, restarting it')
+                self.spawn(index)
+
+        registration.stop()
+        self.socket.close()
+        logger.info('All worker processes stopped')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pre-fork worker server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument(
+        '-w', '--workers', type=int,
+        default=int(os.getenv('PREFORK_WORKERS') or os.cpu_count() or 1),
+        help='number of worker processes',
+    )
+    parser.add_argument(
+        '--memory-report-interval', type=float, default=0,
+        help='seconds between logs of per-worker memory, 0 disables them',
+    )
+    args = parser.parse_args(argv)
+
+    # the app loads and warms up the models synchronously in this process
+    # and leaves background threads to the forked workers
+    os.environ['WORKER_PREFORK'] = 'true'
+    # objects created while loading are frozen below instead of being
+    # scanned (and their pages dirtied) by the collector in every worker
+    gc.disable()
+    from . import worker_flask_app
+    gc.freeze()
+    gc.enable()
+
+    server = PreforkServer(
+        worker_flask_app, args.host, args.port, args.workers,
+        memory_report_interval=args.memory_report_interval,
+    )
+    logger.info(f'Serving on {args.host}:{args.port} with {args.workers} '
+                f'worker processes')
+    server.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import tempfile
+import threading
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# share of requests profiled at startup, 0 until enabled by an admin
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE') or 0)
+
+profiled_requests = REGISTRY.counter(
+    'worker_profiled_requests_total',
+    'Requests run under the sampling profiler',
+)
+
+
+class SampledProfiler:
+    """
+    Runs a share of the requests under cProfile and aggregates their stats
+
+    Only one request is profiled at a time: a sampled request that arrives
+    while another one is profiled runs normally. The aggregated stats are
+    kept until reset().
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.requests = 0
+        self._stats = None
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+
+    def start(self, sample_rate, reset=False):
+        if reset:
+            self.reset()
+        self.sample_rate = sample_rate
+        logger.info(f'Profiling {sample_rate:.2%} of requests')
+
+    def stop(self):
+        self.sample_rate = 0
+        logger.info('Profiling stopped')
+
+    def reset(self):
+        with self._lock:
+            self._stats = None
+            self.requests = 0
+
+    def status(self):
+        return {
+            'sample_rate': self.sample_rate,
+            'profiled_requests': self.requests,
+        }
+
+    def _sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profiled(self, handler):
+        """Decorates a request handler to profile a sample of its calls"""
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not self._sampled() or not self._profiling.acquire(blocking=False):
+                return handler(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(handler, *args, **kwargs)
+            finally:
+                self._profiling.release()
+                self._add(profile)
+        return wrapper
+
+    def _add(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.requests += 1
+        profiled_requests.inc()
+
+    def dump(self):
+        """
+        Returns:
+            bytes: the aggregated stats in the pstats file format, for
+                snakeviz or pstats.Stats(path), or None if nothing was profiled
+        """
+        with self._lock:
+            if self._stats is None:
+                return None
+            with tempfile.NamedTemporaryFile(suffix='.prof') as f:
+                self._stats.dump_stats(f.name)
+                return f.read()
+
+    def text(self, sort='cumulative', limit=50):
+        """
+        Returns:
+            str: the `limit` top functions by `sort`, or None if nothing was
+                profiled
+        """
+        with self._lock:
+            if self._stats is None:
+                return None
+            stream = io.StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats(sort).print_stats(limit)
+            return stream.getvalue()
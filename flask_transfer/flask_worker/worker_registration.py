@@ -0,0 +1,123 @@
+import os
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# seconds between two heartbeats once registered
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL') or 30)
+# seconds before a PUT to the gateway is abandoned
+GATEWAY_TIMEOUT = float(os.getenv('GATEWAY_TIMEOUT') or 5)
+# bounds of the exponential backoff after a failed PUT
+GATEWAY_RETRY_MIN = float(os.getenv('GATEWAY_RETRY_MIN') or 1)
+GATEWAY_RETRY_MAX = float(os.getenv('GATEWAY_RETRY_MAX') or 60)
+
+registrations = REGISTRY.counter(
+    'worker_gateway_registrations_total',
+    'PUT requests sent to the gateway',
+    ['status'],
+)
+
+
+class RegistrationAgent:
+    """
+    Keeps the worker registered with the gateway from a background thread
+
+    The agent PUTs `payload_fn()` to the gateway, retrying with exponential
+    backoff and jitter until it succeeds, and then again every
+    `interval` seconds as a heartbeat. `announce` sends the next PUT straight
+    away, e.g. when a model was loaded or evicted.
+    """
+
+    def __init__(self, gateway_url, adminkey, payload_fn,
+                 interval=HEARTBEAT_INTERVAL, timeout=GATEWAY_TIMEOUT,
+                 retry_min=GATEWAY_RETRY_MIN, retry_max=GATEWAY_RETRY_MAX):
+        self.gateway_url = gateway_url
+        self.adminkey = adminkey
+        self.payload_fn = payload_fn
+        self.interval = interval
+        self.timeout = timeout
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.registered = False
+        self.session = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _new_session(self):
+        # one pooled, keep-alive connection to the gateway
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'adminkey': self.adminkey})
+        return session
+
+    def register(self):
+        """
+        Sends one PUT to the gateway
+
+        Returns:
+            bool: True if the gateway accepted the registration
+        """
+        if self.session is None:
+            self.session = self._new_session()
+        try:
+            response = self.session.put(
+                url=self.gateway_url, json=self.payload_fn(),
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            registrations.inc(status='failed')
+            if self.registered:
+                logger.error(f'Heartbeat to gateway failed: {str(e)}')
+            else:
+                logger.info(f'Not connected to gateway yet: {str(e)}')
+            self.registered = False
+            return False
+
+        registrations.inc(status='ok')
+        if not self.registered:
+            logger.info(f'Successfully connected to gateway at: '
+                        f'{self.gateway_url}')
+        self.registered = True
+        return True
+
+    def _run(self):
+        backoff = self.retry_min
+        while not self._stop.is_set():
+            if self.register():
+                backoff = self.retry_min
+                delay = self.interval
+            else:
+                delay = backoff * random.uniform(0.5, 1.5)
+                backoff = min(backoff * 2, self.retry_max)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def announce(self, *args):
+        """Sends the next PUT now instead of at the next heartbeat"""
+        self._wake.set()
+
+    def start(self):
+        """Starts the background thread if it is not running"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='gateway-registration', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread after its current PUT"""
+        self._stop.set()
+        self._wake.set()
@@ -0,0 +1,182 @@
+import contextlib
+import os
+import threading
+import time
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# reload loaded models when a catalog refresh finds a new published version.
+# Off by default under the pre-fork server, where each worker process would
+# load a private copy and no longer share the preloaded one
+MODEL_AUTO_RELOAD = (
+    os.getenv('MODEL_AUTO_RELOAD') or
+    ('false' if (os.getenv('WORKER_PREFORK') or '').lower() in ('1', 'true')
+     else 'true')
+).lower() in ('1', 'true')
+# seconds a replaced model waits for its in-flight requests before it is
+# released anyway, the requests still finish on it
+MODEL_RELOAD_DRAIN_TIMEOUT = \
+    float(os.getenv('MODEL_RELOAD_DRAIN_TIMEOUT') or 60)
+# seconds POST /models/reload?wait=true waits for the reloads before it
+# answers with the states they are in
+MODEL_RELOAD_WAIT_TIMEOUT = \
+    float(os.getenv('MODEL_RELOAD_WAIT_TIMEOUT') or 120)
+
+reloads = REGISTRY.counter(
+    'worker_model_reloads_total',
+    'Model reloads, by outcome: swapped or failed',
+    ['model', 'outcome'],
+)
+reload_seconds = REGISTRY.histogram(
+    'worker_model_reload_seconds',
+    'Time to reload a model, from loading the new version to releasing '
+    'the old one',
+    ['model'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+reloads_in_flight = REGISTRY.gauge(
+    'worker_model_reloads_in_flight',
+    'Models currently being reloaded',
+)
+
+
+class ModelReloader:
+    """
+    Reloads loaded models in the background, one reload per model at a time
+
+    `reload_fn(model_name)` loads the new version next to the old one,
+    swaps it in, releases the old one once drained and returns a dict of
+    the `from` and `to` versions.
+    `check_fn(model_name)` tells whether a newer version was published.
+
+    Requests count themselves on the entries they use with `in_use`, so that
+    a replaced entry is released once its last request is done (`drain`).
+    """
+
+    def __init__(self, reload_fn, check_fn,
+                 drain_timeout=MODEL_RELOAD_DRAIN_TIMEOUT):
+        self.reload_fn = reload_fn
+        self.check_fn = check_fn
+        self.drain_timeout = drain_timeout
+        self._status = dict()
+        self._threads = dict()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition()
+
+    @contextlib.contextmanager
+    def in_use(self, entries):
+        """Counts a request on model entries for the with block"""
+        entries = list(entries)
+        with self._idle:
+            for entry in entries:
+                entry['in_flight'] = entry.get('in_flight', 0) + 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                for entry in entries:
+                    entry['in_flight'] -= 1
+                self._idle.notify_all()
+
+    def drain(self, entry, timeout=None):
+        """
+        Waits until no request uses an entry
+
+        Args:
+            timeout (float): seconds to wait, `drain_timeout` if None
+
+        Returns:
+            bool: False if requests still used the entry after the timeout
+        """
+        if timeout is None:
+            timeout = self.drain_timeout
+        with self._idle:
+            return self._idle.wait_for(
+                lambda: not entry.get('in_flight'), timeout
+            )
+
+    def reload(self, model_name):
+        """
+        Starts reloading a model, unless it is already being reloaded
+
+        Returns:
+            bool: True if a reload was started
+        """
+        with self._lock:
+            thread = self._threads.get(model_name)
+            if thread is not None and thread.is_alive():
+                return False
+            self._status[model_name] = {
+                'state': 'reloading', 'started_at': time.time(),
+            }
+            thread = self._threads[model_name] = threading.Thread(
+                target=self._run, args=(model_name,),
+                name=f'model-reload-{model_name}', daemon=True,
+            )
+        thread.start()
+        return True
+
+    def _run(self, model_name):
+        reloads_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            versions = self.reload_fn(model_name)
+        except Exception as e:
+            logger.error(f'Unable to reload model {model_name}: {str(e)}')
+            reloads.inc(model=model_name, outcome='failed')
+            status = {'state': 'failed', 'error': str(e)}
+        else:
+            reloads.inc(model=model_name, outcome='swapped')
+            status = {'state': 'swapped', **versions}
+        finally:
+            reloads_in_flight.dec()
+        seconds = time.perf_counter() - start
+        reload_seconds.observe(seconds, model=model_name)
+        with self._lock:
+            self._status[model_name].update(status, seconds=seconds)
+
+    def check(self, model_names):
+        """
+        Starts reloading the models that have a newer published version
+
+        Returns:
+            list: the models being reloaded
+        """
+        started = []
+        for model_name in model_names:
+            try:
+                newer = self.check_fn(model_name)
+            except Exception as e:
+                logger.error(f'Unable to check the version of {model_name}: '
+                             f'{str(e)}')
+                continue
+            if newer and self.reload(model_name):
+                logger.info(f'New version of {model_name} published, '
+                            f'reloading it')
+                started.append(model_name)
+        return started
+
+    def wait(self, model_names, timeout=None):
+        """Waits for the reloads of models to finish"""
+        with self._lock:
+            threads = [
+                self._threads[name] for name in model_names
+                if name in self._threads
+            ]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+
+    def status(self):
+        """
+        Returns:
+            dict: the state of the last reload of each model, with the
+                versions it swapped or the error it failed with
+        """
+        with self._lock:
+            return {name: dict(status) for name, status in self._status.items()}
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .worker_logger import create_logger
+from .worker_metrics import REGISTRY
+
+logger = create_logger(__name__)
+
+# maximum number of cached results, 0 disables the cache
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE') or 0)
+# seconds a cached result is served, 0 keeps results until evicted
+RESULT_CACHE_TTL = float(os.getenv('RESULT_CACHE_TTL') or 3600)
+
+result_cache_hits = REGISTRY.counter(
+    'worker_result_cache_hits_total',
+    'Model outputs served from the result cache',
+    ['cache', 'model'],
+)
+result_cache_misses = REGISTRY.counter(
+    'worker_result_cache_misses_total',
+    'Model outputs not found in the result cache',
+    ['cache', 'model'],
+)
+result_cache_entries = REGISTRY.gauge(
+    'worker_result_cache_entries',
+    'Model outputs held in the result cache',
+    ['cache'],
+)
+
+
+def text_digest(text):
+    """
+    Args:
+        text (str): a request text
+
+    Returns:
+        str: the hex SHA-256 digest of the text
+    """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Bounded cache of raw model outputs
+
+    Entries are keyed by (text digest, model name, model version) and hold
+    the formatted model output before sorting and filtering, so requests
+    with different `min_confidence`/`max_classes` share an entry. The least
+    recently used entry is dropped once `max_entries` is reached, and entries
+    older than `ttl` seconds are not served.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 name='results'):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_model = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest, model_name, version):
+        """
+        Returns:
+            list: the cached model output, or None
+        """
+        key = (digest, model_name, version)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                stored_at, results = item
+                if self.ttl and time.monotonic() - stored_at > self.ttl:
+                    self._remove(key)
+                    item = None
+                else:
+                    self._entries.move_to_end(key)
+        if item is None:
+            result_cache_misses.inc(cache=self.name, model=model_name)
+            return None
+        result_cache_hits.inc(cache=self.name, model=model_name)
+        return results
+
+    def put(self, digest, model_name, version, results):
+        key = (digest, model_name, version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (time.monotonic(), results)
+            self._keys_by_model.setdefault(model_name, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+            result_cache_entries.set(len(self._entries), cache=self.name)
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._keys_by_model.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_model[key[1]]
+
+    def invalidate_model(self, model_name):
+        """Drops every cached output of a model, e.g. when it is reloaded"""
+        with self._lock:
+            for key in list(self._keys_by_model.get(model_name, ())):
+                self._remove(key)
+            result_cache_entries.set(len(self._entries), cache=self.name)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_model.clear()
+            result_cache_entries.set(0, cache=self.name)
@@ -16,7 +16,16 @@ def get_services_put_body(api):
                 "id": "fake_classify",
                 "description": "A fake model that randomly returns classes",
             },
-        ]
+        ],
+        "load": {
+            "in_flight": 3,
+            "queue_depth": 12,
+            "loading": 0,
+            "loaded_models": 2,
+            "model_memory_bytes": 524288000,
+            "waiting": 4,
+            "wait_ms": 120
+        }
     }
 
     Args:
@@ -53,6 +62,44 @@ def get_services_put_body(api):
                     )
                 ),
             ),
+            "load": fields.Nested(
+                api.model(
+                    'worker_load',
+                    {
+                        "in_flight": fields.Integer(
+                            description="Requests currently being handled",
+                            example=3,
+                        ),
+                        "queue_depth": fields.Integer(
+                            description="Texts waiting in micro-batch queues",
+                            example=12,
+                        ),
+                        "loading": fields.Integer(
+                            description="Models currently being loaded",
+                            example=0,
+                        ),
+                        "loaded_models": fields.Integer(
+                            description="Models currently loaded",
+                            example=2,
+                        ),
+                        "model_memory_bytes": fields.Integer(
+                            description="Estimated memory of the loaded models",
+                            example=524288000,
+                        ),
+                        "waiting": fields.Integer(
+                            description="Requests waiting for admission",
+                            example=4,
+                        ),
+                        "wait_ms": fields.Integer(
+                            description="How long the longest waiting "
+                                        "request has waited so far",
+                            example=120,
+                        ),
+                    }
+                ),
+                required=False,
+                description="Current load of the worker, for load-based routing",
+            ),
         }
     )
     return services_put_body
@@ -0,0 +1,161 @@
+import os
+import threading
+
+import numpy as np
+
+from .worker_logger import create_logger
+
+logger = create_logger(__name__)
+
+# cached text embeddings per worker, keyed by (text digest, model, version)
+EMBEDDING_CACHE_SIZE = int(os.getenv('EMBEDDING_CACHE_SIZE') or 10000)
+# directory of <model name>.txt files, one reference text per line
+REFERENCE_DIR = os.getenv('REFERENCE_DIR') or ''
+# texts embedded at once when building a reference matrix
+REFERENCE_BATCH_SIZE = int(os.getenv('REFERENCE_BATCH_SIZE') or 256)
+DEFAULT_TOP_K = int(os.getenv('SIMILARITY_TOP_K') or 10)
+
+
+def format_vector(doc):
+    """
+    Formats the vector of a processed Doc for cosine similarity
+
+    Args:
+        doc (SpaCy Doc): a processed Doc, with word vectors or a tensor
+
+    Returns:
+        numpy.ndarray: the L2 normalised float32 vector of the doc, all zeros
+            if the doc has no vector
+    """
+    vector = np.asarray(doc.vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+def stack_vectors(vectors):
+    """
+    Args:
+        vectors (list): format_vector outputs
+
+    Returns:
+        numpy.ndarray: a (len(vectors), width) float32 matrix
+    """
+    if not len(vectors):
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack(vectors).astype(np.float32, copy=False)
+
+
+def pair_scores(a, b):
+    """
+    Cosine similarity of each row of `a` with the same row of `b`
+
+    Args:
+        a (numpy.ndarray): (n, width) normalised vectors
+        b (numpy.ndarray): (n, width) normalised vectors
+
+    Returns:
+        numpy.ndarray: the n scores
+    """
+    return np.einsum('ij,ij->i', a, b)
+
+
+def top_k_scores(query, matrix, top_k=DEFAULT_TOP_K):
+    """
+    Scores one normalised vector against every row of a matrix
+
+    Args:
+        query (numpy.ndarray): a (width,) normalised vector
+        matrix (numpy.ndarray): (n, width) normalised reference vectors
+        top_k (int): the number of best matches to return
+
+    Returns:
+        list: (row index, score) of the best matches, best first
+    """
+    if matrix.shape[0] == 0:
+        return []
+    scores = matrix @ query
+    top_k = min(top_k, scores.shape[0])
+    # argpartition finds the top k in O(n), only those are sorted
+    best = np.argpartition(-scores, top_k - 1)[:top_k]
+    best = best[np.argsort(-scores[best])]
+    return [(int(i), float(scores[i])) for i in best]
+
+
+def read_reference_texts(model_name, reference_dir=REFERENCE_DIR):
+    """
+    Reads the reference texts of a model from REFERENCE_DIR
+
+    Returns:
+        list: the non empty lines of <reference_dir>/<model_name>.txt, or None
+            if there is no such file
+    """
+    if not reference_dir:
+        return None
+    path = os.path.join(reference_dir, f'{model_name}.txt')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+
+class ReferenceIndex:
+    """
+    Reference texts of one model and their embedding matrix
+
+    The matrix is built with the model's batch model and rebuilt when the
+    model version changes, so a query is scored against every reference
+    text with a single matrix-vector product.
+    """
+
+    def __init__(self, texts):
+        self.texts = list(texts)
+        self.matrix = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.texts)
+
+    def matrix_for(self, entry):
+        """
+        Returns the embedding matrix for the loaded version of the model
+
+        Args:
+            entry (dict): the model_mapping entry of the model
+
+        Returns:
+            numpy.ndarray: (len(texts), width) normalised vectors
+        """
+        with self._lock:
+            if self.matrix is None or self.version != entry['version']:
+                vectors = entry['batch_model'](
+                    self.texts, batch_size=REFERENCE_BATCH_SIZE
+                )
+                self.matrix = stack_vectors(vectors)
+                self.version = entry['version']
+                logger.info(f'Built reference matrix {self.matrix.shape}')
+            return self.matrix
+
+    def release(self):
+        """Frees the matrix, it is rebuilt on the next search"""
+        with self._lock:
+            self.matrix = None
+            self.version = None
+
+    def search(self, entry, query, top_k=DEFAULT_TOP_K):
+        """
+        Args:
+            entry (dict): the model_mapping entry of the model
+            query (numpy.ndarray): the normalised query vector
+            top_k (int): the number of best matches to return
+
+        Returns:
+            list: a {'index', 'text', 'score'} dict per match, best first
+        """
+        matrix = self.matrix_for(entry)
+        return [
+            {'index': i, 'text': self.texts[i], 'score': score}
+            for i, score in top_k_scores(query, matrix, top_k)
+        ]
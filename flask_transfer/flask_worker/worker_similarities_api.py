@@ -1,9 +1,18 @@
 from flask_restx import fields
 
-def get_body(api):
+def get_similarities_body(api):
     """
     Registers a model to the input api and returns the model
 
+    The model is for the body of a POST to /similarities/
+
+    Example:
+    {
+        "a": "Example A",
+        "b": "Example B",
+        "c": ["x"]
+    }
+
     Args:
         api (flask_restx.api): The api that will handle the request
 
@@ -30,23 +39,41 @@ def get_body(api):
             description="List of types",
         ),
     }
-    return api.model('body', body)
+    return api.model('similarities_body', body)
 
-def get_post_response(api):
+def get_similarities_post_response(api):
     """
     Registers a model to the input api and returns the model
 
+    The model is for the response of a POST to /similarities/
+
+    Example:
+    {
+        "c": [
+            {
+                "type": "x",
+                "result": [
+                    {
+                        "score": 0.75
+                    }
+                ]
+            }
+        ],
+        "a": "Example A",
+        "b": "Example B"
+    }
+
     Args:
         api (flask_restx.api): The api that will handle the request
     Returns:
         flask_restx.model: The model registered to the api
     """
     post_response = api.model(
-        'post_response',
+        'similarities_post_response',
         {
             "c": fields.List(fields.Nested(
                 api.model(
-                    'type_results',
+                    'similarities_type_results',
                     {
                         "type": fields.String(
                             description="Type",
@@ -55,7 +82,7 @@ def get_post_response(api):
                         "result": fields.List(
                             fields.Nested(
                                 api.model(
-                                    'result',
+                                    'similarities_result',
                                     {
                                         "score": fields.Float(
                                             description="Score",
@@ -79,3 +106,152 @@ def get_post_response(api):
         }
     )
     return post_response
+
+def get_similarities_search_body(api):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the body of a POST to /similarities/search
+
+    Example:
+    {
+        "text": "Example A",
+        "c": ["x"],
+        "top_k": 3
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+
+    body = {
+        "text": fields.String(
+            required=True,
+            description="The string scored against the reference texts",
+            example="Example A",
+        ),
+        "c": fields.List(
+            fields.String(
+                example="x"
+            ),
+            required=True,
+            description="List of types",
+        ),
+        "top_k": fields.Integer(
+            required=False,
+            description="The number of best matches returned per type",
+            example=3,
+            min=1,
+            max=1000,
+        ),
+    }
+    return api.model('similarities_search_body', body)
+
+def get_similarities_search_response(api):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the response of a POST to /similarities/search
+
+    Example:
+    {
+        "c": [
+            {
+                "type": "x",
+                "result": [
+                    {
+                        "index": 4,
+                        "text": "Example B",
+                        "score": 0.75
+                    }
+                ]
+            }
+        ],
+        "text": "Example A"
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+    search_response = api.model(
+        'similarities_search_response',
+        {
+            "c": fields.List(fields.Nested(
+                api.model(
+                    'similarities_search_type_results',
+                    {
+                        "type": fields.String(
+                            description="Type",
+                            example="x",
+                        ),
+                        "result": fields.List(
+                            fields.Nested(
+                                api.model(
+                                    'similarities_search_result',
+                                    {
+                                        "index": fields.Integer(
+                                            description="Position of the reference text",
+                                            example=4
+                                        ),
+                                        "text": fields.String(
+                                            description="The reference text",
+                                            example="Example B"
+                                        ),
+                                        "score": fields.Float(
+                                            description="Score",
+                                            example=0.75
+                                        ),
+                                    }
+                                )
+                            )
+                        )
+                    }
+                )
+            )),
+            "text": fields.String(
+                description="The string scored against the reference texts",
+                example="Example A",
+            ),
+        }
+    )
+    return search_response
+
+def get_similarities_references_body(api):
+    """
+    Registers a model to the input api and returns the model
+
+    The model is for the body of a PUT to /similarities/references
+
+    Example:
+    {
+        "type": "x",
+        "texts": ["Example B", "Example C"]
+    }
+
+    Args:
+        api (flask_restx.api): The api that will handle the request
+
+    Returns:
+        flask_restx.model: The model registered to the api
+    """
+
+    body = {
+        "type": fields.String(
+            required=True,
+            description="The type whose reference texts are replaced",
+            example="x",
+        ),
+        "texts": fields.List(
+            fields.String(
+                example="Example B"
+            ),
+            required=True,
+            description="The reference texts",
+        ),
+    }
+    return api.model('similarities_references_body', body)
@@ -0,0 +1,247 @@
+import json
+import os
+
+import numpy
+import spacy
+import thinc
+from thinc.api import Model
+
+from .worker_logger import create_logger
+
+logger = create_logger(__name__)
+
+# components kept by prune_pipeline for each route, others are removed.
+# Components are matched by name or by factory.
+ROUTE_COMPONENTS = {
+    'classes': {
+        'tok2vec', 'transformer', 'textcat', 'textcat_multilabel',
+    },
+    'entities': {
+        'tok2vec', 'transformer', 'ner', 'beam_ner', 'entity_ruler',
+        'span_ruler', 'span_finder', 'spancat', 'spancat_singlelabel',
+    },
+}
+# Doc attributes each route reads, see the `assigns` of the factories.
+# prune_pipeline never removes a component that assigns them.
+ROUTE_OUTPUTS = {
+    'classes': {'doc.cats'},
+    'entities': {'doc.ents', 'doc.spans'},
+}
+
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_NAME = 'snapshot.json'
+WEIGHTS_NAME = 'weights.bin'
+# the spaCy pipeline, without its weights
+PIPELINE_DIR = 'pipeline'
+# weight arrays start on cache line boundaries in weights.bin
+ALIGNMENT = 64
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def prune_pipeline(nlp, route):
+    """
+    Removes the pipeline components that the route does not use
+
+    Removed components are not run and their weights can be freed. Routes
+    without an entry in ROUTE_COMPONENTS keep the whole pipeline.
+
+    Args:
+        nlp (SpaCy Pipeline): the loaded pipeline
+        route (str): the worker route
+
+    Raises:
+        ValueError: a component that is not in ROUTE_COMPONENTS assigns
+            the doc attributes the route reads, nothing is removed
+
+    Returns:
+        list: the names of the removed components
+    """
+    keep = ROUTE_COMPONENTS.get(route)
+    if keep is None:
+        return []
+    removed = [
+        name for name in nlp.pipe_names
+        if name not in keep and nlp.get_pipe_meta(name).factory not in keep
+    ]
+    outputs = ROUTE_OUTPUTS.get(route, set())
+    for name in removed:
+        meta = nlp.get_pipe_meta(name)
+        assigned = outputs.intersection(meta.assigns)
+        if assigned:
+            raise ValueError(
+                f'Component {name} ({meta.factory}) assigns '
+                f'{", ".join(sorted(assigned))}, which the {route} route '
+                f'reads, add its factory to ROUTE_COMPONENTS'
+            )
+        if not meta.assigns:
+            logger.warning(f'Removing component {name} ({meta.factory}), '
+                           f'which does not declare what it assigns')
+    for name in removed:
+        nlp.remove_pipe(name)
+    return removed
+
+
+def is_snapshot(path):
+    return os.path.isfile(os.path.join(path, SNAPSHOT_NAME))
+
+
+def component_models(nlp):
+    """
+    Yields:
+        tuple: (component name, thinc Model) of each component with a model
+    """
+    for name, component in nlp.pipeline:
+        model = getattr(component, 'model', None)
+        if isinstance(model, Model):
+            yield name, model
+
+
+def make_snapshot(model_path, path, route):
+    """
+    Writes a fast-loading snapshot of a spaCy model for a worker route
+
+    The components the route does not use are removed. The weights of the
+    remaining components and the static vectors are written to one
+    weights.bin file, which load_snapshot memory-maps, and the pipeline is
+    saved without them. The tokenizer is left out when it is the one the
+    config builds anyway, as loading it again is most of spacy.load.
+
+    Args:
+        model_path (str): the spaCy model directory
+        path (str): the directory to write the snapshot to
+        route (str): the worker route the snapshot is for
+
+    Returns:
+        dict: the content of snapshot.json
+    """
+    nlp = spacy.load(model_path)
+    removed = prune_pipeline(nlp, route)
+    os.makedirs(path, exist_ok=True)
+
+    weights = []
+    vectors = None
+    seen = set()
+    offset = 0
+    with open(os.path.join(path, WEIGHTS_NAME), 'wb') as f:
+
+        def write(array):
+            nonlocal offset
+            array = numpy.ascontiguousarray(array)
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            start = offset + padding
+            f.write(array.data)
+            offset = start + array.nbytes
+            return start
+
+        for name, model in component_models(nlp):
+            for index, node in enumerate(model.walk()):
+                # layers shared between components are stored once
+                if node.id in seen:
+                    continue
+                seen.add(node.id)
+                for param in node.param_names:
+                    if not node.has_param(param):
+                        continue
+                    array = numpy.asarray(node.get_param(param))
+                    weights.append({
+                        'component': name,
+                        'node': index,
+                        'param': param,
+                        'dtype': array.dtype.str,
+                        'shape': list(array.shape),
+                        'offset': write(array),
+                    })
+                    # keeps the dims and the param in the pipeline's msgpack
+                    node.set_param(
+                        param, numpy.zeros((0,) * array.ndim, array.dtype)
+                    )
+
+        table = nlp.vocab.vectors
+        if table.mode == 'default' and table.data.size:
+            data = numpy.asarray(table.data)
+            vectors = {
+                'dtype': data.dtype.str,
+                'shape': list(data.shape),
+                'offset': write(data),
+            }
+            table.data = numpy.zeros((0, data.shape[1]), data.dtype)
+
+    exclude = []
+    default = spacy.util.load_model_from_config(nlp.config, auto_fill=False)
+    if default.tokenizer.to_bytes(exclude=['vocab']) == \
+            nlp.tokenizer.to_bytes(exclude=['vocab']):
+        exclude.append('tokenizer')
+    nlp.to_disk(os.path.join(path, PIPELINE_DIR), exclude=exclude)
+
+    snapshot = {
+        'format': SNAPSHOT_FORMAT,
+        'route': route,
+        'removed': removed,
+        'exclude': exclude,
+        'spacy_version': spacy.__version__,
+        'thinc_version': thinc.__version__,
+        'weights': weights,
+        'vectors': vectors,
+    }
+    with open(os.path.join(path, SNAPSHOT_NAME), 'w') as f:
+        json.dump(snapshot, f)
+    return snapshot
+
+
+def load_snapshot(path):
+    """
+    Loads a model written by make_snapshot
+
+    The weights are copy-on-write memory maps of weights.bin: loading them
+    reads nothing, pages are read on first use, and processes that load
+    the same snapshot share them in the page cache.
+
+    Args:
+        path (str): the snapshot directory
+
+    Raises:
+        SnapshotError: the snapshot does not match the installed spaCy
+
+    Returns:
+        SpaCy Pipeline: the model
+    """
+    with open(os.path.join(path, SNAPSHOT_NAME)) as f:
+        snapshot = json.load(f)
+    if snapshot.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError(f'Unknown snapshot format: {snapshot.get("format")}')
+
+    nlp = spacy.load(
+        os.path.join(path, PIPELINE_DIR), exclude=snapshot['exclude']
+    )
+    if not snapshot['weights'] and not snapshot['vectors']:
+        return nlp
+    buffer = numpy.memmap(os.path.join(path, WEIGHTS_NAME), mode='c')
+
+    def view(entry):
+        return numpy.ndarray(
+            tuple(entry['shape']), dtype=numpy.dtype(entry['dtype']),
+            buffer=buffer, offset=entry['offset'],
+        )
+
+    nodes = {name: list(model.walk()) for name, model in component_models(nlp)}
+    for entry in snapshot['weights']:
+        try:
+            node = nodes[entry['component']][entry['node']]
+        except (KeyError, IndexError):
+            node = None
+        if node is None or not node.has_param(entry['param']) or \
+                node.get_param(entry['param']).ndim != len(entry['shape']):
+            raise SnapshotError(
+                f'{entry["component"]} does not match the snapshot, it was '
+                f'written with spaCy {snapshot["spacy_version"]} and thinc '
+                f'{snapshot["thinc_version"]}'
+            )
+        node.set_param(entry['param'], view(entry))
+
+    if snapshot['vectors']:
+        nlp.vocab.vectors.data = view(snapshot['vectors'])
+    return nlp
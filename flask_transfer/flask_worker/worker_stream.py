@@ -0,0 +1,228 @@
+import os
+import queue
+import threading
+
+from werkzeug.exceptions import HTTPException
+
+from .worker_fastjson import dumps, loads
+from .worker_metrics import REGISTRY
+
+# lines of a stream passed to the models at once
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE') or 64)
+# batches buffered between the reading, inference and writing stages
+STREAM_QUEUE_SIZE = int(os.getenv('STREAM_QUEUE_SIZE') or 2)
+# longer lines are answered with a 413 error line
+MAX_STREAM_LINE_BYTES = int(os.getenv('MAX_STREAM_LINE_BYTES') or 1024 * 1024)
+
+stream_lines = REGISTRY.counter(
+    'worker_stream_lines_total',
+    'Lines of NDJSON streams handled, by outcome',
+    ['outcome'],
+)
+
+_DONE = object()
+
+
+def error_line(line, code, message, **fields):
+    """
+    Example:
+        {"line": 3, "error": {"code": 404, "message": "No such model: x"}}
+
+    Returns:
+        dict: the response line reporting the error of an input line
+    """
+    return {'line': line, 'error': {'code': code, 'message': message, **fields}}
+
+
+def http_error_line(line, error):
+    """
+    Returns:
+        dict: the error line of an HTTPException raised for an input line,
+            with the validation errors of flask_restx if any
+    """
+    data = getattr(error, 'data', None) or {}
+    fields = {'errors': data['errors']} if 'errors' in data else {}
+    return error_line(
+        line, error.code, data.get('message') or error.description, **fields
+    )
+
+
+def read_lines(stream, max_bytes=MAX_STREAM_LINE_BYTES):
+    """
+    Reads the lines of a binary stream, holding at most one line in memory
+
+    Args:
+        stream: a readable binary stream, e.g. request.stream
+        max_bytes (int): the maximum line length
+
+    Yields:
+        tuple: (line number, line) of each non-blank line, the line is None
+            when it is longer than max_bytes
+    """
+    number = 0
+    while True:
+        line = stream.readline(max_bytes + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_bytes and not line.endswith(b'\n'):
+            # skips the rest of the line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_bytes + 1)
+            yield number, None
+        elif line.strip():
+            yield number, line
+
+
+def parse_lines(lines, parse):
+    """
+    Parses NDJSON lines into requests
+
+    Args:
+        lines (iterable): (line number, line) pairs, see read_lines
+        parse (callable): validates a decoded line and returns the request,
+            raising an HTTPException if it is invalid
+
+    Yields:
+        tuple: (line number, request id, request, error line), with either
+            the request or the error line set. The id is the optional `id`
+            field of the line, returned with its response.
+    """
+    for number, line in lines:
+        if line is None:
+            yield number, None, None, error_line(
+                number, 413, f'Line longer than {MAX_STREAM_LINE_BYTES} bytes'
+            )
+            continue
+        try:
+            document = loads(line)
+        except ValueError as e:
+            yield number, None, None, error_line(
+                number, 400, f'Invalid JSON: {str(e)}'
+            )
+            continue
+        if not isinstance(document, dict):
+            yield number, None, None, error_line(
+                number, 400, 'Each line must be a JSON object'
+            )
+            continue
+        try:
+            request = parse(document)
+        except HTTPException as e:
+            yield number, document.get('id'), None, http_error_line(number, e)
+            continue
+        yield number, document.get('id'), request, None
+
+
+def batched(items, size):
+    """Yields lists of up to `size` consecutive items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode_lines(responses):
+    """
+    Returns:
+        bytes: the responses as NDJSON
+    """
+    return b''.join(dumps(response) for response in responses)
+
+
+class ClosingIterator:
+    """
+    Iterates over `iterable` and calls `on_close` once, when it is
+    exhausted, fails or is closed, even if it was never iterated
+
+    A generator that is closed before its first item does not run its
+    finally blocks, so resources taken before the response starts are
+    released here instead.
+    """
+
+    def __init__(self, iterable, on_close):
+        self._iterator = iter(iterable)
+        self._on_close = on_close
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            on_close, self._on_close = self._on_close, None
+        if on_close is None:
+            return
+        try:
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            on_close()
+
+
+def in_thread(iterable, maxsize=STREAM_QUEUE_SIZE, name='stream'):
+    """
+    Iterates over `iterable` in a background thread, at most `maxsize` items
+    ahead of the consumer
+
+    Chaining these makes the stages of a stream run concurrently while
+    bounding the memory they hold. An exception of the iterable is raised
+    to the consumer. Closing the returned generator, e.g. when the client
+    disconnects, stops the thread and closes the iterable.
+
+    Args:
+        iterable: the items, produced in the background thread
+        maxsize (int): the number of items buffered
+        name (str): the thread name
+
+    Yields:
+        the items of the iterable
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,136 @@
+import contextlib
+import contextvars
+import functools
+import os
+import time
+
+# add a Server-Timing header with the duration of each stage to responses
+SERVER_TIMING = (os.getenv('SERVER_TIMING') or 'true').lower() in ('1', 'true')
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+class Timings:
+    """
+    Durations of the stages of one request, on a monotonic clock
+
+    Stages entered several times in a request, e.g. the model load of each
+    requested model, are summed.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.handler_ended = None
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0) + seconds
+
+    def header(self):
+        """
+        Example:
+            'marshal;dur=0.052, catalog;dur=0.003, inference;dur=4.617'
+
+        Returns:
+            str: the Server-Timing header value, durations in milliseconds
+        """
+        return ', '.join(
+            f'{name};dur={seconds * 1000:.3f}'
+            for name, seconds in self.stages.items()
+        )
+
+
+def start():
+    """
+    Starts timing the request handled by the current thread
+
+    Returns:
+        Timings: the timings of the request, or None if SERVER_TIMING is off
+    """
+    timings = Timings() if SERVER_TIMING else None
+    _current.set(timings)
+    return timings
+
+
+def current():
+    """
+    Returns:
+        Timings: the timings of the current request, or None
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Adds the time spent in the with block to a stage of the current request
+
+    Does nothing outside of a timed request, e.g. during warm-up.
+
+    Args:
+        name (str): the stage name, a Server-Timing metric name
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def timed_handler(handler):
+    """
+    Decorates a resource method, under marshal_with
+
+    The time from the start of the request to the call is the `validate`
+    stage: routing, JSON parsing and payload validation. The end of the call
+    is kept so that finish() can time the response serialization.
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        timings = _current.get()
+        if timings is None:
+            return handler(*args, **kwargs)
+        timings.add('validate', time.perf_counter() - timings.started)
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            timings.handler_ended = time.perf_counter()
+    return wrapper
+
+
+def finish_header():
+    """
+    Adds the serialize and total stages and stops timing the request
+
+    Returns:
+        str: the Server-Timing header value of the current request, or None
+    """
+    timings = _current.get()
+    if timings is None:
+        return None
+    now = time.perf_counter()
+    if timings.handler_ended is not None:
+        timings.add('serialize', now - timings.handler_ended)
+    timings.add('total', now - timings.started)
+    _current.set(None)
+    return timings.header()
+
+
+def finish(response):
+    """
+    Adds the serialize and total stages and the Server-Timing header
+
+    Args:
+        response (flask.Response): the response of the current request
+
+    Returns:
+        flask.Response: the response
+    """
+    header = finish_header()
+    if header is not None:
+        response.headers['Server-Timing'] = header
+    return response
@@ -1,8 +1,266 @@
+"""
+script to save a spacy model to s3
+
+By default the model is loaded and handed to utils.save_to_s3. With --stream
+the model directory is packed straight from disk instead: the files go into
+a gzipped tarball with a MANIFEST.json of their SHA-256 hashes, and the
+tarball is uploaded in parallel multipart chunks while it is written. A
+small <key>.meta.json object (description, version, size, SHA-256) is then
+written next to it, which the worker reads without downloading the model.
+--snapshot ROUTE publishes the fast-loading snapshot of the model for a
+worker route instead of the model directory.
+
+    python -m flask_transfer.save_to_s3 --stream -p ./topic_model -n topic
+"""
 import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import spacy
 
 from scripts import utils
 
+# multipart chunk size, S3 needs at least 5MB for every part but the last
+UPLOAD_PART_SIZE_MB = int(os.getenv('UPLOAD_PART_SIZE_MB') or 16)
+# chunks uploaded at once, twice as many may wait in memory
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS') or 4)
+UPLOAD_PART_RETRIES = int(os.getenv('UPLOAD_PART_RETRIES') or 3)
+MANIFEST_NAME = 'MANIFEST.json'
+# read by the worker's ArtifactStore
+META_SUFFIX = '.meta.json'
+
+
+class HashingReader:
+    """Reads a file and computes the SHA-256 of what was read"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class MultipartWriter(io.RawIOBase):
+    """
+    A write-only file that uploads its content as an S3 multipart upload
+
+    Every `part_size` bytes written are uploaded as one part on a thread
+    pool, so the archive never needs to fit in memory or on disk. Writes
+    block while `2 * workers` parts are waiting to be uploaded.
+
+    Attributes:
+        sha256: the SHA-256 of everything written
+        size (int): the number of bytes written
+    """
+
+    def __init__(self, client, bucket, key, part_size, workers,
+                 retries=UPLOAD_PART_RETRIES):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.retries = retries
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._buffer = bytearray()
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(2 * workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='upload'
+        )
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key
+        )['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self.sha256.update(data)
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _submit(self, data):
+        # fail fast instead of packing the rest of the model
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        self._futures.append(
+            self._executor.submit(self._upload_part, part_number, data)
+        )
+
+    def _upload_part(self, part_number, data):
+        try:
+            for attempt in range(1, self.retries + 1):
+                try:
+                    response = self.client.upload_part(
+                        Bucket=self.bucket, Key=self.key,
+                        PartNumber=part_number, UploadId=self.upload_id,
+                        Body=data,
+                    )
+                    return {'PartNumber': part_number, 'ETag': response['ETag']}
+                except Exception as e:
+                    if attempt == self.retries:
+                        raise
+                    print(f'Retrying part {part_number} after: {str(e)}')
+                    time.sleep(0.5 * 2 ** attempt)
+        finally:
+            self._slots.release()
+
+    def complete(self):
+        """
+        Uploads the last part and completes the upload
+
+        Returns:
+            int: the number of parts
+        """
+        if self._buffer or not self._futures:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        parts = [future.result() for future in self._futures]
+        self._executor.shutdown()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts},
+        )
+        return len(parts)
+
+    def abort(self):
+        self._executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def pack_model(model_path, fileobj):
+    """
+    Writes a model directory as a gzipped tarball, reading each file once
+
+    The files are stored relative to the model directory, followed by a
+    MANIFEST.json with the path, size and SHA-256 of each of them.
+
+    Args:
+        model_path (str): the spaCy model directory
+        fileobj: a writable file, e.g. a MultipartWriter
+
+    Returns:
+        list: the manifest entries
+    """
+    files = []
+    with tarfile.open(fileobj=fileobj, mode='w|gz') as tar:
+        for root, dirs, names in os.walk(model_path):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                arcname = os.path.relpath(path, model_path)
+                info = tar.gettarinfo(path, arcname)
+                if not info.isfile():
+                    continue
+                with open(path, 'rb') as f:
+                    reader = HashingReader(f)
+                    tar.addfile(info, reader)
+                files.append({
+                    'path': arcname,
+                    'size': info.size,
+                    'sha256': reader.sha256.hexdigest(),
+                })
+        manifest = json.dumps({'files': files}, indent=2).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(manifest))
+    return files
+
+
+def read_model_meta(model_path):
+    """
+    Returns:
+        dict: the meta.json of a spaCy model directory or snapshot, empty if
+            it has none
+    """
+    for path in ('meta.json', os.path.join('pipeline', 'meta.json')):
+        try:
+            with open(os.path.join(model_path, path)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    return {}
+
+
+def publish_model(client, model_path, model_name, bucket,
+                  s3_model_dir=utils.DEFAULT_S3_PROD_MODEL_DIR,
+                  part_size=UPLOAD_PART_SIZE_MB * 1024 * 1024,
+                  workers=UPLOAD_WORKERS, version=None, description=None):
+    """
+    Streams a model directory to S3 and writes its metadata object
+
+    The metadata is written after the upload completed, so it never
+    describes a partial archive.
+
+    Args:
+        client: a boto3 S3 client
+        model_path (str): the spaCy model directory
+        model_name (str): the model name, used in the S3 key
+        bucket (str): the S3 bucket
+        s3_model_dir (str): the S3 directory of the models
+        part_size (int): the multipart chunk size in bytes
+        workers (int): the number of chunks uploaded at once
+        version (str): the model version, from meta.json if None
+        description (str): the model description, from meta.json if None
+
+    Returns:
+        dict: the metadata written to <key>.meta.json
+    """
+    key = f'{s3_model_dir}/{model_name}.tar.gz'
+    model_meta = read_model_meta(model_path)
+
+    writer = MultipartWriter(client, bucket, key, part_size, workers)
+    try:
+        files = pack_model(model_path, writer)
+        parts = writer.complete()
+    except BaseException:
+        writer.abort()
+        raise
+
+    metadata = {
+        'name': model_name,
+        'version': version or model_meta.get('version') or writer.sha256.hexdigest()[:12],
+        'description': description or model_meta.get('description', ''),
+        'lang': model_meta.get('lang'),
+        'spacy_version': model_meta.get('spacy_version'),
+        'size': writer.size,
+        'sha256': writer.sha256.hexdigest(),
+        'files': len(files),
+        'snapshot': os.path.isfile(os.path.join(model_path, 'snapshot.json')),
+        'parts': parts,
+        'manifest': MANIFEST_NAME,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+    client.put_object(
+        Bucket=bucket, Key=key + META_SUFFIX,
+        Body=json.dumps(metadata).encode(), ContentType='application/json',
+    )
+    return metadata
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='script to save a spacy model to s3'
@@ -24,10 +282,77 @@ if __name__ == '__main__':
         default=utils.DEFAULT_S3_PROD_MODEL_DIR
     )
 
+    parser.add_argument(
+        '--stream', action='store_true',
+        help='pack the model directory from disk and upload it in parallel '
+             'chunks, without loading it',
+    )
+
+    parser.add_argument(
+        '-b', '--bucket',
+        help='S3 bucket, with --stream',
+        default=utils.DEFAULT_S3_BUCKET
+    )
+
+    parser.add_argument(
+        '--version',
+        help='model version, with --stream (default: from meta.json)',
+    )
+
+    parser.add_argument(
+        '--description',
+        help='model description, with --stream (default: from meta.json)',
+    )
+
+    parser.add_argument(
+        '--part-size-mb', type=int, default=UPLOAD_PART_SIZE_MB,
+        help='multipart chunk size, with --stream',
+    )
+
+    parser.add_argument(
+        '--workers', type=int, default=UPLOAD_WORKERS,
+        help='chunks uploaded at once, with --stream',
+    )
+
+    parser.add_argument(
+        '--local-s3',
+        help='upload to this directory through the local S3 stand-in '
+             'instead of S3, with --stream',
+    )
+
+    parser.add_argument(
+        '--snapshot', metavar='ROUTE',
+        help='publish a memory-mapped snapshot of the model with the '
+             'components of this worker route, with --stream',
+    )
+
     args = parser.parse_args()
 
-    nlp = spacy.load(args.model_path)
+    if args.stream:
+        if args.local_s3:
+            from flask_transfer.stubs.s3 import LocalS3Client
+            client = LocalS3Client(args.local_s3)
+        else:
+            import boto3
+            client = boto3.client('s3')
+
+        with tempfile.TemporaryDirectory() as snapshot_path:
+            model_path = args.model_path
+            if args.snapshot:
+                from flask_transfer.flask_worker.worker_snapshot import make_snapshot
+                make_snapshot(model_path, snapshot_path, args.snapshot)
+                model_path = snapshot_path
+            output = publish_model(
+                client, model_path, args.model_name, args.bucket,
+                s3_model_dir=args.model_dir,
+                part_size=args.part_size_mb * 1024 * 1024,
+                workers=args.workers, version=args.version,
+                description=args.description,
+            )
+        print(json.dumps(output, indent=2))
+    else:
+        nlp = spacy.load(args.model_path)
 
-    output = utils.save_to_s3(nlp, args.model_name, s3_model_dir=args.model_dir)
+        output = utils.save_to_s3(nlp, args.model_name, s3_model_dir=args.model_dir)
 
-    print(output)
+        print(output)
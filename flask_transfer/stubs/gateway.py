@@ -0,0 +1,113 @@
+"""
+A local stand-in for the gateway that workers register with
+
+It accepts PUT /worker and records every body it receives. It can be told
+to fail a number of requests first, to exercise the worker's retries.
+
+Run it on its own with:
+    python -m flask_transfer.stubs.gateway --port 5000
+and point the worker at it with GATEWAY_URL=http://localhost:5000/worker
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubGateway:
+    """
+    Records worker registrations on a local HTTP server
+
+    Attributes:
+        registrations (list): the JSON bodies of the accepted PUT requests
+        adminkeys (list): the adminkey header of each accepted PUT request
+        fail_next (int): the number of upcoming PUT requests answered with 503
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, path='/worker'):
+        self.path = path
+        self.registrations = []
+        self.adminkeys = []
+        self.fail_next = 0
+        self.received = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{self.path}'
+
+    def _handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                if self.path != gateway.path:
+                    self.send_error(404)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                with gateway.received:
+                    if gateway.fail_next > 0:
+                        gateway.fail_next -= 1
+                        self.send_error(503)
+                        return
+                    gateway.registrations.append(json.loads(body))
+                    gateway.adminkeys.append(self.headers.get('adminkey'))
+                    gateway.received.notify_all()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def wait_for(self, count, timeout=10):
+        """
+        Waits until `count` registrations were received
+
+        Returns:
+            bool: True if they were received within `timeout` seconds
+        """
+        with self.received:
+            return self.received.wait_for(
+                lambda: len(self.registrations) >= count, timeout
+            )
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name='stub-gateway', daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local stand-in gateway')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    gateway = StubGateway(args.host, args.port)
+    print(f'Stub gateway listening on {gateway.url}')
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for registration in gateway.registrations:
+            print(json.dumps(registration))
@@ -0,0 +1,135 @@
+"""
+A local stand-in for the boto3 S3 client, backed by a directory
+
+Objects are files under <root>/<bucket>/<key>. The methods take and return
+the same fields as boto3's, so code written against the S3 client can be
+run against it, e.g. the worker's ArtifactStore:
+    from flask_transfer.stubs.s3 import LocalS3Client
+    store = ArtifactStore(client=LocalS3Client('/tmp/s3'), bucket='models')
+
+It also takes the multipart uploads of `save_to_s3.py --stream`. Failures
+can be injected to exercise retries and resumed downloads.
+"""
+import hashlib
+import io
+import os
+import shutil
+import threading
+import uuid
+
+
+class LocalS3Error(Exception):
+    """Carries a boto3 style `response` with the error code"""
+
+    def __init__(self, code, message):
+        super().__init__(f'{code}: {message}')
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class LocalS3Client:
+    """
+    Attributes:
+        fail_next_gets (int): the number of upcoming get_object calls that
+            raise a ConnectionError
+        get_requests (list): (key, Range) of every get_object call
+        uploaded_parts (list): (key, part number, size) of every uploaded part
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.fail_next_gets = 0
+        self.get_requests = []
+        self.uploaded_parts = []
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _etag(self, path):
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise LocalS3Error('404', f'{Bucket}/{Key}')
+        return {
+            'ContentLength': os.path.getsize(path),
+            'ETag': self._etag(path),
+        }
+
+    def get_object(self, Bucket, Key, Range=None):
+        with self._lock:
+            self.get_requests.append((Key, Range))
+            if self.fail_next_gets > 0:
+                self.fail_next_gets -= 1
+                raise ConnectionError(f'Injected failure for {Key}')
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise LocalS3Error('NoSuchKey', f'{Bucket}/{Key}')
+        with open(path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                first, _, last = Range[len('bytes='):].partition('-')
+                f.seek(int(first))
+                data = f.read(int(last) - int(first) + 1)
+        return {
+            'Body': io.BytesIO(data),
+            'ContentLength': len(data),
+            'ETag': self._etag(path),
+        }
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': self._etag(path)}
+
+    def _upload_dir(self, upload_id):
+        return os.path.join(self.root, '.multipart', upload_id)
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._upload_dir(upload_id))
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body):
+        directory = self._upload_dir(UploadId)
+        if not os.path.isdir(directory):
+            raise LocalS3Error('NoSuchUpload', UploadId)
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with open(os.path.join(directory, str(PartNumber)), 'wb') as f:
+            f.write(data)
+        with self._lock:
+            self.uploaded_parts.append((Key, PartNumber, len(data)))
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        directory = self._upload_dir(UploadId)
+        parts = MultipartUpload['Parts']
+        numbers = [part['PartNumber'] for part in parts]
+        if numbers != sorted(numbers):
+            raise LocalS3Error('InvalidPartOrder', UploadId)
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digests = b''
+        with open(path, 'wb') as out:
+            for part in parts:
+                with open(os.path.join(directory, str(part['PartNumber'])), 'rb') as f:
+                    data = f.read()
+                if f'"{hashlib.md5(data).hexdigest()}"' != part['ETag']:
+                    raise LocalS3Error('InvalidPart', str(part['PartNumber']))
+                digests += hashlib.md5(data).digest()
+                out.write(data)
+        shutil.rmtree(directory)
+        # the ETag S3 gives multipart objects
+        return {'ETag': f'"{hashlib.md5(digests).hexdigest()}-{len(parts)}"'}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        shutil.rmtree(self._upload_dir(UploadId), ignore_errors=True)
+        return {}
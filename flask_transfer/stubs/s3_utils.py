@@ -0,0 +1,198 @@
+"""
+A local-directory stand-in for scripts.utils, for benchmarks and local runs
+
+Each model is a JSON file, STUB_MODEL_DIR/<name>.json:
+    {
+        "labels": ["sports", "politics"],
+        "cost_ms": 2.0,
+        "batch_overhead_ms": 1.0,
+        "load_ms": 200,
+        "version": "1.0.0",
+        "description": "topic model"
+    }
+
+LazyModel builds a blank English pipeline whose only component is a fake
+textcat. The fake scores are derived from a digest of the text, so the same
+text always gets the same scores. The component spends `cost_ms` of CPU per
+text and `batch_overhead_ms` per call, and the load sleeps `load_ms`.
+
+The worker imports `scripts.utils`; call install() before importing it:
+    from flask_transfer.stubs import s3_utils
+    s3_utils.install()
+    from flask_transfer.flask_worker import worker_flask_app
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+import types
+
+import spacy
+from spacy.language import Language
+
+DEFAULT_S3_BUCKET = 'local-stub'
+DEFAULT_S3_PROD_MODEL_DIR = 'prod_models'
+STUB_MODEL_DIR = os.getenv('STUB_MODEL_DIR') or os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'models'
+)
+
+
+def spin(ms):
+    """Keeps the CPU busy for `ms` milliseconds, holding the GIL like inference"""
+    deadline = time.perf_counter() + ms / 1000
+    while time.perf_counter() < deadline:
+        pass
+
+
+def fake_scores(text, labels):
+    """
+    Args:
+        text (str): the text to score
+        labels (list): the textcat labels
+
+    Returns:
+        dict: a score per label, summing to 1, the same for the same text
+    """
+    raw = [
+        int.from_bytes(
+            hashlib.blake2b(f'{label}\0{text}'.encode(), digest_size=4).digest(),
+            'big',
+        ) + 1
+        for label in labels
+    ]
+    total = sum(raw)
+    return {label: value / total for label, value in zip(labels, raw)}
+
+
+class FakeTextCategorizer:
+    """Sets doc.cats like a trained textcat, without a model"""
+
+    def __init__(self, labels, cost_ms, batch_overhead_ms):
+        self.labels = list(labels)
+        self.cost_ms = cost_ms
+        self.batch_overhead_ms = batch_overhead_ms
+
+    def _score(self, doc):
+        spin(self.cost_ms)
+        doc.cats = fake_scores(doc.text, self.labels)
+        return doc
+
+    def __call__(self, doc):
+        spin(self.batch_overhead_ms)
+        return self._score(doc)
+
+    def pipe(self, docs, batch_size=128):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == batch_size:
+                spin(self.batch_overhead_ms)
+                yield from (self._score(d) for d in batch)
+                batch = []
+        if batch:
+            spin(self.batch_overhead_ms)
+            yield from (self._score(d) for d in batch)
+
+
+@Language.factory(
+    'fake_textcat',
+    default_config={'labels': [], 'cost_ms': 0.0, 'batch_overhead_ms': 0.0},
+)
+def create_fake_textcat(nlp, name, labels, cost_ms, batch_overhead_ms):
+    return FakeTextCategorizer(labels, cost_ms, batch_overhead_ms)
+
+
+def _spec_path(model_name, model_dir=None):
+    return os.path.join(model_dir or STUB_MODEL_DIR, f'{model_name}.json')
+
+
+def _read_spec(model_name, model_dir=None):
+    with open(_spec_path(model_name, model_dir)) as f:
+        return json.load(f)
+
+
+def write_model(model_name, labels, cost_ms=1.0, batch_overhead_ms=0.5,
+                load_ms=0, version='1.0.0', description=None, model_dir=None):
+    """
+    Writes the JSON spec of a fake model
+
+    Returns:
+        str: the path of the spec
+    """
+    model_dir = model_dir or STUB_MODEL_DIR
+    os.makedirs(model_dir, exist_ok=True)
+    path = _spec_path(model_name, model_dir)
+    with open(path, 'w') as f:
+        json.dump({
+            'labels': list(labels),
+            'cost_ms': cost_ms,
+            'batch_overhead_ms': batch_overhead_ms,
+            'load_ms': load_ms,
+            'version': version,
+            'description': description or f'{model_name} model',
+        }, f)
+    return path
+
+
+def scrape_bucket(s3_bucket=DEFAULT_S3_BUCKET,
+                  s3_model_dir=DEFAULT_S3_PROD_MODEL_DIR):
+    """
+    Returns:
+        list: an S3 style key, <model dir>/<name>.tar.gz, per model spec
+    """
+    try:
+        names = sorted(os.listdir(STUB_MODEL_DIR))
+    except OSError:
+        return []
+    return [
+        f'{s3_model_dir}/{name[:-len(".json")]}.tar.gz'
+        for name in names if name.endswith('.json')
+    ]
+
+
+def LazyModel(model_name):
+    """
+    Builds the fake pipeline of a model spec
+
+    Raises:
+        FileNotFoundError: there is no spec for the model
+    """
+    spec = _read_spec(model_name)
+    # a download waits on the network, it does not hold the GIL
+    time.sleep(spec.get('load_ms', 0) / 1000)
+    nlp = spacy.blank('en')
+    nlp.add_pipe('fake_textcat', name='textcat', config={
+        'labels': spec['labels'],
+        'cost_ms': spec.get('cost_ms', 0.0),
+        'batch_overhead_ms': spec.get('batch_overhead_ms', 0.0),
+    })
+    nlp.meta['name'] = model_name
+    nlp.meta['version'] = spec.get('version', '1.0.0')
+    return nlp
+
+
+def get_description(model_name):
+    try:
+        return _read_spec(model_name).get('description', '')
+    except OSError:
+        return ''
+
+
+def save_to_s3(nlp, model_name, s3_model_dir=DEFAULT_S3_PROD_MODEL_DIR):
+    """Writes a fake spec with the labels of the pipeline's textcat"""
+    labels = []
+    if 'textcat' in nlp.pipe_names:
+        labels = list(nlp.get_pipe('textcat').labels)
+    write_model(model_name, labels, version=nlp.meta.get('version', '1.0.0'))
+    return f'{s3_model_dir}/{model_name}.tar.gz'
+
+
+def install():
+    """Makes `import scripts.utils` return this module"""
+    package = sys.modules.get('scripts')
+    if package is None:
+        package = sys.modules['scripts'] = types.ModuleType('scripts')
+        package.__path__ = []
+    package.utils = sys.modules[__name__]
+    sys.modules['scripts.utils'] = sys.modules[__name__]
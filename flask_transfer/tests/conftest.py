@@ -0,0 +1,4 @@
+# the worker imports scripts.utils, which the stub stands in for
+from flask_transfer.stubs import s3_utils
+
+s3_utils.install()
@@ -0,0 +1,165 @@
+import io
+import math
+import threading
+import time
+
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from flask_transfer.flask_worker import worker_logic
+from flask_transfer.flask_worker.worker_admission import (
+    Admission, AdmissionError, Limiter,
+)
+
+
+def hold(limiter, started, release):
+    """Takes a slot of `limiter` in a thread until `release` is set"""
+    def run():
+        with limiter.slot():
+            started.set()
+            release.wait()
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert started.wait(1)
+    return thread
+
+
+def wait_for(condition, timeout=1):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_full_queue_is_rejected_with_429():
+    limiter = Limiter('requests', 1, max_queue=1, timeout=5, retry_after=2)
+    release = threading.Event()
+    holder = hold(limiter, threading.Event(), release)
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    wait_for(lambda: limiter.waiting == 1)
+
+    with pytest.raises(AdmissionError) as error:
+        limiter.acquire()
+
+    assert error.value.code == 429
+    assert error.value.retry_after == 2
+    release.set()
+    holder.join()
+    waiter.join()
+    assert limiter.active == 1
+
+
+def test_wait_timeout_is_rejected_with_503():
+    limiter = Limiter('requests', 1, timeout=0.05, retry_after=3)
+    release = threading.Event()
+    holder = hold(limiter, threading.Event(), release)
+
+    started = time.monotonic()
+    with pytest.raises(AdmissionError) as error:
+        limiter.acquire()
+
+    assert error.value.code == 503
+    assert time.monotonic() - started >= 0.05
+    assert limiter.waiting == 0
+    release.set()
+    holder.join()
+    assert limiter.active == 0
+
+
+def test_admit_aborts_with_retry_after():
+    limiter = Limiter('requests', 1, timeout=0.01, retry_after=4)
+    limiter.acquire()
+
+    with pytest.raises(HTTPException) as error:
+        worker_logic.admit(limiter.acquire)
+
+    response = error.value.get_response()
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '4'
+
+
+def test_released_slot_goes_to_the_waiter_not_a_newcomer():
+    limiter = Limiter('requests', 1, timeout=0.05)
+    limiter.acquire()
+    waiter = threading.Thread(target=limiter.acquire, args=(math.inf,))
+    waiter.start()
+    wait_for(lambda: limiter.waiting == 1)
+
+    # the newcomer finds the slot free before the woken waiter can take it
+    with limiter._condition:
+        limiter.release()
+        with pytest.raises(AdmissionError) as error:
+            limiter.acquire()
+
+    assert error.value.code == 503
+    waiter.join()
+    assert limiter.active == 1
+
+
+def test_model_slots_are_taken_in_name_order():
+    admission = Admission(model_max_in_flight=1, timeout=2)
+    errors = []
+
+    def run(model_names):
+        try:
+            for _ in range(50):
+                slots = admission.acquire_models(model_names)
+                assert slots == [admission.model('a'), admission.model('b')]
+                admission.release_models(slots)
+        except Exception as e:
+            errors.append(e)
+
+    # opposite request orders would deadlock without the name order
+    threads = [
+        threading.Thread(target=run, args=(names,))
+        for names in (['a', 'b'], ['b', 'a']) * 2
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert admission.model('a').active == admission.model('b').active == 0
+
+
+def test_model_slots_taken_are_released_on_failure():
+    admission = Admission(model_max_in_flight=1, timeout=0.05)
+    admission.model('b').acquire()
+
+    with pytest.raises(AdmissionError):
+        admission.acquire_models(['a', 'b'])
+
+    assert admission.model('a').active == 0
+
+
+@pytest.fixture
+def worker():
+    worker = worker_logic.Worker(
+        'http://worker', 'classes', preload_async=False,
+        start_background=False,
+    )
+    worker.admission = Admission(max_in_flight=1, timeout=0.05)
+    return worker
+
+
+def test_stream_holds_its_request_slot(worker):
+    lines = worker.handle_stream(io.BytesIO(b''), lambda document: document)
+    assert worker.admission.requests.active == 1
+
+    with pytest.raises(HTTPException) as error:
+        worker.handle_stream(io.BytesIO(b''), lambda document: document)
+    assert error.value.code == 503
+
+    assert list(lines) == []
+    assert worker.admission.requests.active == 0
+
+
+def test_stream_closed_before_its_first_line_releases_its_slot(worker):
+    lines = worker.handle_stream(io.BytesIO(b''), lambda document: document)
+
+    lines.close()
+    lines.close()
+
+    assert worker.admission.requests.active == 0
@@ -0,0 +1,179 @@
+import json
+import os
+import time
+
+import pytest
+import spacy
+
+from flask_transfer.flask_worker.worker_artifacts import (
+    ArtifactError, ArtifactStore, META_SUFFIX,
+)
+from flask_transfer.save_to_s3 import publish_model
+from flask_transfer.stubs.s3 import LocalS3Client
+
+BUCKET = 'models'
+PREFIX = 'prod_models'
+PART_SIZE = 16 * 1024
+
+
+@pytest.fixture
+def client(tmp_path):
+    return LocalS3Client(str(tmp_path / 's3'))
+
+
+def publish(client, tmp_path, model_name, version='1.0.0', padding=100_000):
+    """Publishes a blank pipeline with `padding` random bytes next to it"""
+    path = tmp_path / 'src' / model_name / version
+    nlp = spacy.blank('en')
+    nlp.meta['name'] = model_name
+    nlp.meta['version'] = version
+    path.mkdir(parents=True)
+    nlp.to_disk(path)
+    # random bytes do not compress, the artifact spans several parts
+    (path / 'padding.bin').write_bytes(os.urandom(padding))
+    return publish_model(
+        client, str(path), model_name, BUCKET, s3_model_dir=PREFIX,
+        part_size=5 * 1024 * 1024, workers=1,
+    )
+
+
+def make_store(client, tmp_path, **kwargs):
+    kwargs.setdefault('part_size', PART_SIZE)
+    kwargs.setdefault('workers', 4)
+    return ArtifactStore(
+        client=client, bucket=BUCKET, prefix=PREFIX,
+        cache_dir=str(tmp_path / 'cache'), **kwargs
+    )
+
+
+def ranged_gets(client):
+    return [rng for key, rng in client.get_requests if rng is not None]
+
+
+def test_ranged_parallel_download(client, tmp_path):
+    meta = publish(client, tmp_path, 'topic')
+    store = make_store(client, tmp_path)
+
+    nlp = store.load('topic')
+
+    parts = -(-meta['size'] // PART_SIZE)
+    assert parts > 1
+    assert len(ranged_gets(client)) == parts
+    assert nlp.meta['name'] == 'topic'
+    assert store.fetched['topic']['sha256'] == meta['sha256']
+    path = store.fetch('topic')
+    with open(os.path.join(path, 'padding.bin'), 'rb') as f:
+        assert len(f.read()) == 100_000
+
+
+def test_cache_hit_skips_download(client, tmp_path):
+    publish(client, tmp_path, 'topic')
+    first = make_store(client, tmp_path).fetch('topic')
+    client.get_requests.clear()
+
+    second = make_store(client, tmp_path).fetch('topic')
+
+    assert second == first
+    assert ranged_gets(client) == []
+    assert [key for key, _ in client.get_requests] == \
+        [f'{PREFIX}/topic.tar.gz{META_SUFFIX}']
+
+
+def test_failed_download_resumes_with_missing_parts(client, tmp_path,
+                                                    monkeypatch):
+    meta = publish(client, tmp_path, 'topic')
+    parts = -(-meta['size'] // PART_SIZE)
+    get_object = client.get_object
+
+    def fail_first_part(Bucket, Key, Range=None):
+        if Range is not None and Range.startswith('bytes=0-'):
+            # lets the other download threads start their parts
+            time.sleep(0.2)
+            raise ConnectionError('Injected failure')
+        return get_object(Bucket=Bucket, Key=Key, Range=Range)
+
+    # one attempt per part: the first part fails, the parts finished
+    # meanwhile are recorded
+    store = make_store(client, tmp_path, retries=1)
+    monkeypatch.setattr(client, 'get_object', fail_first_part)
+    with pytest.raises(ArtifactError):
+        store.fetch('topic')
+    assert 'topic' not in store.fetched
+    progress = os.path.join(
+        store.cache_dir, 'topic', '1.0.0', 'artifact.tar.gz.part.json'
+    )
+    with open(progress) as f:
+        done = json.load(f)['done']
+    assert done and 0 not in done
+
+    monkeypatch.setattr(client, 'get_object', get_object)
+    client.get_requests.clear()
+    store.fetch('topic')
+
+    assert len(ranged_gets(client)) == parts - len(done)
+    assert ranged_gets(client)[0] == f'bytes=0-{PART_SIZE - 1}'
+    assert store.fetched['topic']['sha256'] == meta['sha256']
+
+
+def test_retried_metadata_and_parts(client, tmp_path):
+    publish(client, tmp_path, 'topic')
+    store = make_store(client, tmp_path, workers=1, retries=3)
+    client.fail_next_gets = 2
+
+    assert os.path.isdir(store.fetch('topic'))
+
+
+def test_hash_mismatch_fails_and_discards_download(client, tmp_path):
+    publish(client, tmp_path, 'topic')
+    meta_path = os.path.join(
+        client.root, BUCKET, PREFIX, f'topic.tar.gz{META_SUFFIX}'
+    )
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['sha256'] = '0' * 64
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    store = make_store(client, tmp_path)
+
+    with pytest.raises(ArtifactError, match='SHA-256'):
+        store.fetch('topic')
+
+    directory = os.path.join(store.cache_dir, 'topic', '1.0.0')
+    assert sorted(os.listdir(directory)) == []
+    assert 'topic' not in store.fetched
+
+
+def test_eviction_removes_least_recently_used(client, tmp_path):
+    for model_name in ('first', 'second', 'third'):
+        meta = publish(client, tmp_path, model_name)
+    # room for two extracted models
+    store = make_store(client, tmp_path, max_bytes=int(meta['size'] * 2.5))
+
+    for model_name in ('first', 'second', 'third'):
+        store.fetch(model_name)
+
+    assert sorted(os.listdir(store.cache_dir)) == \
+        ['.locks', 'first', 'second', 'third']
+    assert os.listdir(os.path.join(store.cache_dir, 'first')) == []
+    assert os.listdir(os.path.join(store.cache_dir, 'third')) == ['1.0.0']
+
+
+def test_eviction_keeps_versions_in_use_or_being_loaded(client, tmp_path):
+    for model_name in ('first', 'second', 'third'):
+        meta = publish(client, tmp_path, model_name)
+    first = os.path.join(str(tmp_path / 'cache'), 'first', '1.0.0')
+    store = make_store(
+        client, tmp_path, max_bytes=int(meta['size'] * 1.5),
+        in_use=lambda: {first},
+    )
+    store.fetch('first')
+
+    # second is locked while it loads, when third is fetched
+    with store.fetching('second'):
+        store.fetch('third')
+        assert os.path.isdir(os.path.join(store.cache_dir, 'second', '1.0.0'))
+
+    assert os.path.isdir(first)
+    store.evict()
+    assert not os.path.isdir(os.path.join(store.cache_dir, 'second', '1.0.0'))
+    assert os.path.isdir(first)
@@ -0,0 +1,38 @@
+import numpy
+import spacy
+
+from flask_transfer.flask_worker.worker_fanout import FanOut
+
+# tokenizer exceptions set the norms of ca/n't, y'/all and gon/na
+TEXT = "I can't say y'all are gonna like it, but it's fine."
+
+
+def build_entry(seed):
+    spacy.util.fix_random_seed(seed)
+    nlp = spacy.blank('en')
+    textcat = nlp.add_pipe('textcat')
+    for label in ('positive', 'negative', 'neutral'):
+        textcat.add_label(label)
+    nlp.initialize()
+    # the output layer starts at zero, which scores every text the same
+    rng = numpy.random.default_rng(seed)
+    for node in textcat.model.walk():
+        for param in node.param_names:
+            if node.has_param(param):
+                array = node.get_param(param)
+                node.set_param(param, (
+                    rng.standard_normal(array.shape) * 0.5
+                ).astype(array.dtype))
+    return {'nlp': nlp, 'format_doc': lambda doc: dict(doc.cats)}
+
+
+def test_fanout_matches_sequential_with_contractions():
+    entries = [('first', build_entry(0)), ('second', build_entry(1))]
+    sequential = {
+        model_name: entry['format_doc'](entry['nlp'](TEXT))
+        for model_name, entry in entries
+    }
+
+    outputs = FanOut(workers=2).run(TEXT, entries)
+
+    assert outputs == sequential